@@ -14,7 +14,9 @@ class Config:
     def get_path(self, key):
         return self._config['paths'][key]
     
-    def get(self, key, param):
+    def get(self, key, param, default=None):
+        if default is not None:
+            return self._config.get(key, {}).get(param, default)
         return self._config[key][param]
     def get_all_paths(self):
         return self._config.get('paths', {})
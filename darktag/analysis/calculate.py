@@ -1,10 +1,108 @@
 import numpy as np
+import scipy.sparse
 import pynbody
 import pynbody.filt as f
 from pynbody.analysis.luminosity import get_current_ssp_table
 #from pynbody.analysis.luminosity import SSPTable
+from darktag.tagging.iord_index import IordIndex
 from ...config import config 
 
+
+# metallicity the tagged stars are given (-2 dex, 1/100 Z_sun)
+tagged_metallicity = 3*10**(-4)
+
+# number of log ages in the fixed metallicity lookup of SSP tables that do not expose their grid of ages
+ssp_lookup_points = 2000
+
+# SSP table in use and the log age -> V band magnitude per solar mass lookup built from it
+_ssp_table = None
+_ssp_lookups = {}
+
+
+def ssp_table():
+
+    '''
+
+    Returns pynbody's current SSP table. The V band lookups made from it are kept until the table in use changes
+    (e.g. with pynbody.analysis.luminosity.use_custom_ssp_table)
+
+    '''
+
+    global _ssp_table
+
+    table = get_current_ssp_table()
+
+    if table is not _ssp_table:
+        _ssp_table = table
+        _ssp_lookups.clear()
+
+    return _ssp_table
+
+
+def _ssp_log_ages(table, band):
+
+    # the log ages of the table grid (MultiSSPTable keeps one table per band)
+    if hasattr(table, '_bandpass_to_table'):
+        bands = {b.lower():t for b, t in table._bandpass_to_table.items()}
+        table = bands.get(band.lower(), table)
+
+    ages = getattr(table, '_ages', None)
+
+    return np.asarray(ages, dtype=np.float64) if ages is not None else None
+
+
+def ssp_lookup(metallicity=tagged_metallicity, band='V'):
+
+    '''
+
+    Inputs:
+
+    metallicity - metal mass fraction of the stars
+    band - bandpass
+
+    Returns:
+
+    log10 ages (yr) and the magnitudes per solar mass at them, for stars of a single metallicity. The 2D (age,
+    metallicity) interpolation of the SSP table is done once here, at the ages of the table grid, and the stars
+    are then interpolated in 1D in log age (np.interp). The table is linear in log age between its ages, so this
+    gives the magnitudes of SSPTable.interpolate, and ages beyond the table are clamped to its edges in the same
+    way. Tables that do not expose their ages are sampled on ssp_lookup_points log ages instead.
+
+    '''
+
+    table = ssp_table()
+
+    key = (float(metallicity), band)
+
+    if key not in _ssp_lookups:
+
+        log_ages = _ssp_log_ages(table, band)
+
+        if type(log_ages) == type(None):
+            log_ages = np.linspace(5.0, 10.5, ssp_lookup_points)
+
+        mags = np.asarray(table.interpolate(log_ages, np.full(len(log_ages), np.log10(metallicity)), band), dtype=np.float64)
+
+        _ssp_lookups[key] = (log_ages, mags)
+
+    return _ssp_lookups[key]
+
+
+def ssp_mags(particle_ages, metallicity=tagged_metallicity, band='V'):
+
+    '''
+
+    Returns the magnitudes per solar mass of stars of ages particle_ages (yr) and a single metallicity,
+    interpolated from ssp_lookup
+
+    '''
+
+    log_ages, mags = ssp_lookup(metallicity, band)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.interp(np.log10(np.asarray(particle_ages, dtype=np.float64)), log_ages, mags)
+
+
 def calc_3D_cm(particles,masses):
 
     x_cm = sum(particles['x']*masses)/sum(masses)
@@ -52,7 +150,6 @@ def calc_luminosity(particle_ages,masses):
     #### (see https://pynbody.github.io/pynbody/_modules/pynbody/analysis/luminosity.html)
 
     # Assumes stars have a metallicity of -2 (1/100 L_sun)
-    metals = np.ones(len(particle_ages))*(3*10**(-4))
     # Age in yrs
     particle_ages = particle_ages * (10**9)
 
@@ -62,10 +159,6 @@ def calc_luminosity(particle_ages,masses):
     #lums = {'ages':np.log10(lums_data[:,0]), 'mets': np.log10(lums_data[:,1]), 'v':lums_data[:,5]}
     
     #lums = np.load('/scratch/dp191/shared/python/anaconda3/envs/py311/lib/python3.11/site-packages/pynbody/analysis/cmdlum.npz')
-    lums = get_current_ssp_table()
-
-    age_star = pynbody.array.SimArray(particle_ages, units = 'yr')
-    age_star[age_star<1.0] = 1.0
 
     '''
     age_grid = lums['ages']*(10**(-9))
@@ -85,7 +178,8 @@ def calc_luminosity(particle_ages,masses):
     output_mags = pynbody.analysis.interpolate.interpolate2d(metals,age_star, met_grid, age_grid, mag_grid)
     #output_mags = pynbody.analysis.interpolate.interpolate2d(metals,age_star, met_grid, age_grid, mag_grid)
     '''
-    output_mags = lums.interpolate(np.log10(particle_ages) , np.log10(metals), 'V')
+    # the table interpolated once at the metallicity of the tagged stars (see ssp_lookup)
+    output_mags = ssp_mags(particle_ages, tagged_metallicity, 'V')
     # calculating luminosities
 
     vals = output_mags - 2.5 * np.log10(masses)
@@ -104,23 +198,17 @@ def calc_mags_tagged(particle_ages,masses,band='V'):
 
 
     # Assumes stars have a metallicity of -2 (1/100 L_sun)
-    metals = np.ones(len(particle_ages))*(3*10**(-4))
     # Age in yrs
     particle_ages = particle_ages * (10**9)
 
-    ## calculating v-band mags
+    ## calculating mags in band
 
     #lums_data = np.load(pynbody.analysis.luminosity._default_ssp_file[0])
     #lums = {'ages':np.log10(lums_data[:,0]), 'mets': np.log10(lums_data[:,1]), 'v':lums_data[:,5]}
 
     #lums = np.load('/scratch/dp191/shared/python/anaconda3/envs/py311/lib/python3.11/site-packages/pynbody/analysis/cmdlum.npz')
-    lums = get_current_ssp_table()
 
-    age_star = pynbody.array.SimArray(particle_ages, units = 'yr')
-    age_star[age_star<1.0] = 1.0
-
-
-    output_mags = lums.interpolate(np.log10(particle_ages) , np.log10(metals), 'V')
+    output_mags = ssp_mags(particle_ages, tagged_metallicity, band)
     # calculating luminosities
 
     vals = output_mags - 2.5 * np.log10(masses)
@@ -229,7 +317,7 @@ def calc_lum_hydro(ages_h,masses_h,metals_h):
     #lums = {'ages':np.log10(lums_data[:,0]), 'mets': np.log10(lums_data[:,1]), 'v': lums_data[:,5]}
     #lums = np.load('/scratch/dp191/shared/python/anaconda3/envs/py311/lib/python3.11/site-packages/pynbody/analysis/cmdlum.npz')
     
-    lums = get_current_ssp_table()
+    lums = ssp_table()
     
     age_star = ages_h 
     #pynbody.array.SimArray(ages_h , units = 'yr')
@@ -281,7 +369,7 @@ def calc_mags_hydro(ages_h,masses_h,metals_h):
     #lums = {'ages':np.log10(lums_data[:,0]), 'mets': np.log10(lums_data[:,1]), 'v': lums_data[:,5]}
     #lums = np.load('/scratch/dp191/shared/python/anaconda3/envs/py311/lib/python3.11/site-packages/pynbody/analysis/cmdlum.npz')
 
-    lums = get_current_ssp_table()
+    lums = ssp_table()
 
     age_star = pynbody.array.SimArray(ages_h , units = 'yr')
 
@@ -339,7 +427,7 @@ def produce_lums_grouped(df,present_iords,t_snap):
 
     lums_df = df.groupby(['iords']).sum()['lums']
 
-    lums_for_part = np.asarray([lums_df.loc[iord] for iord in present_iords])
+    lums_for_part = IordIndex.from_series(lums_df).gather('lums', present_iords)
     '''
     for particle_id_tag in present_iords:
 
@@ -362,6 +450,120 @@ def produce_lums_grouped(df,present_iords,t_snap):
     return lums_for_part 
 
 
+
+class LuminosityHistory:
+
+    '''
+
+    V band luminosities of the tagged particles at every snapshot of a reff time series.
+
+    produce_lums_grouped works out the luminosity of every tagging event (t_snap - t) at one snapshot and sums
+    them over the iords with a groupby, so a reff run over T snapshots interpolates the events T times and
+    groups them T times. The particles are tagged at the snapshots, so the events only have a few distinct
+    tagging times: here the V band luminosity per solar mass of each tagging time is evaluated on all the
+    snapshot times at once (chunk_size pairs of them at a time). The luminosities of the particles at a snapshot
+    are the product of the stellar mass each iord was given at each tagging time (a sparse iords x tagging times
+    matrix) with that snapshot's column, so no (iords x snapshots) array is held and the memory used grows with
+    the number of tagging events.
+
+    As with tagged_by, a particle only shines at a snapshot from the events tagged at or before its time
+    (compared at the precision the 't' column is stored at).
+
+    '''
+
+    def __init__(self, df, times, chunk_size=2**22):
+
+        '''
+
+        Inputs:
+
+        df - tagged particles (iords, mstar, t), e.g. as returned by read_tagged_particles, or a TaggedCatalog
+        times - times (Gyr) of the snapshots, e.g. t_all of the reff functions
+        chunk_size - number of (tagging time, snapshot) pairs evaluated at once
+
+        '''
+
+        self.times = np.asarray(times, dtype=np.float64)
+
+        self.iords, iord_idx = np.unique(np.asarray(df['iords']), return_inverse=True)
+
+        # tagging times as stored (float32 in columnar stores), and the tagging time of each event
+        self.tagging_times, t_idx = np.unique(np.asarray(df['t']), return_inverse=True)
+
+        self.index = IordIndex(self.iords)
+
+        # stellar mass given to each iord at each tagging time (repeated events are summed)
+        self.masses = scipy.sparse.csr_matrix((np.asarray(df['mstar'], dtype=np.float64), (iord_idx.ravel(), t_idx.ravel())),
+                                              shape=(len(self.iords), len(self.tagging_times)))
+
+        # V band luminosity per solar mass of each tagging time at each snapshot (0 before it)
+        self.lums_per_msol = np.zeros((len(self.tagging_times), len(self.times)))
+
+        if len(self.iords) == 0 or len(self.times) == 0:
+            return
+
+        snapshots_per_chunk = max(1, int(chunk_size) // len(self.tagging_times))
+
+        v_mag_sun = 4.8
+
+        for first in range(0, len(self.times), snapshots_per_chunk):
+
+            times_chunk = self.times[first:first+snapshots_per_chunk]
+
+            tagged = self.tagging_times[:, None] <= np.asarray(times_chunk, dtype=self.tagging_times.dtype)[None, :]
+
+            # ages in Gyr, as in produce_lums_grouped, but those of the particles tagged at the snapshot are zero
+            # rather than just below (their tagging time rounded up to float32), which gave them no luminosity
+            ages = np.maximum(times_chunk[None, :] - self.tagging_times[:, None], 0.0)
+
+            mags = ssp_mags(ages.ravel()*(10**9), tagged_metallicity, 'V').reshape(ages.shape)
+
+            self.lums_per_msol[:, first:first+snapshots_per_chunk] = np.where(tagged, 10.0 ** ((v_mag_sun - mags)/2.5), 0.0)
+
+    def __repr__(self):
+        return '<LuminosityHistory '+str(len(self.iords))+' particles, '+str(len(self.times))+' snapshots>'
+
+    def __len__(self):
+        return len(self.times)
+
+    def at(self, snapshot):
+
+        '''
+
+        Returns the luminosities (L_sun) of all the particles (in the order of self.iords) at snapshot, the index
+        of its time in times
+
+        '''
+
+        return self.masses @ self.lums_per_msol[:, snapshot]
+
+    def gather(self, snapshot, iords):
+
+        '''
+
+        Inputs:
+
+        snapshot - index of the snapshot time in times
+        iords - particle iords
+
+        Returns:
+
+        the luminosities of iords at snapshot, in the order of iords (as produce_lums_grouped, raising a KeyError
+        for iords that were never tagged)
+
+        '''
+
+        idx, found = self.index.positions(iords)
+
+        if np.all(found) == False:
+            raise KeyError(str(np.asarray(iords)[np.logical_not(found)][:10])+' were never tagged')
+
+        return self.masses[idx] @ self.lums_per_msol[:, snapshot]
+
+    def total(self, snapshot):
+        return float(np.asarray(self.masses.sum(axis=0)).ravel() @ self.lums_per_msol[:, snapshot])
+
+
 def calc_tot_lum(particle_ages,masses):
     
 
@@ -372,111 +574,75 @@ def calc_tot_lum(particle_ages,masses):
     return halo_luminosity 
 
 
-def calc_halflight(sim,lum_for_each_iord,band='v',cylindrical=False):
-    #### function adapted from pynbody pynbody.analysis.luminosity 
-    #### (see https://pynbody.github.io/pynbody/_modules/pynbody/analysis/luminosity.html)
+def calc_enclosed_light_radii(radii, lums, fractions=[0.5]):
 
-
-    '''
-    Assumes ordering of ages_st is the same as sim_particles
     '''
-    
-    half_l = np.sum(lum_for_each_iord) * 0.5
-
-    if cylindrical:
-        coord = 'rxy'
-    else:
-        coord = 'r'
+    Returns the radii enclosing the given fractions of the total luminosity: for each fraction, the radius of the
+    innermost particle at which the cumulative luminosity (sorted by radius) reaches that fraction of the total.
 
-    max_high_r = np.max(sim.dm[coord])
-    test_r = 0.5 * max_high_r
-    
-    testrf = f.LowPass(coord, test_r)
-    min_low_r = 0.0
+    radii = radial distances of the particles
+    lums = luminosity of each particle, in the same order as radii
+    fractions = enclosed fractions of the luminosity (e.g. [0.1,0.25,0.5,0.75,0.9])
 
-    #chosen_particle_ages = ages_st[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-    #chosen_particle_masses = masses[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-    
-    test_l = np.sum(lum_for_each_iord[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])])
-    
-    it = 0
+    All the fractions come from one sort of the radii and one cumulative sum (nan if there is no light).
+    '''
 
-    while ((np.abs(test_l - half_l) / half_l) > 0.01):
-        it = it + 1
-        if (it > 20):
-            break
+    radii = radii if isinstance(radii, np.ndarray) else np.asarray(radii)
+    lums = np.asarray(lums, dtype=np.float64)
+    fractions = np.atleast_1d(np.asarray(fractions, dtype=np.float64))
 
-        if (test_l > half_l):
-            test_r = 0.5 * (min_low_r + test_r)
-        else:
-            test_r = (test_r + max_high_r) * 0.5
+    if len(lums) == 0 or np.sum(lums) <= 0:
+        return np.full(len(fractions), np.nan)
 
-        testrf = f.LowPass(coord, test_r)
-        #chosen_particle_ages = ages_st[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-        #chosen_particle_masses = masses[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-        test_l = np.sum(lum_for_each_iord[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])])
-            
-        if (test_l > half_l):
-            max_high_r = test_r
-        else:
-            min_low_r = test_r
-    
-    return test_r
+    order = np.argsort(np.asarray(radii), kind='stable')
 
+    cumulative_lums = np.cumsum(lums[order])
 
+    # first particle at which the enclosed luminosity reaches each fraction of the total
+    idxs = np.searchsorted(cumulative_lums, fractions * cumulative_lums[-1], side='left')
 
+    return radii[order[np.clip(idxs, 0, len(lums)-1)]]
 
-def calc_halflight_hydro(sim,lum_for_each_iord,band='v',cylindrical=False):
 
+def calc_halflight(sim,lum_for_each_iord,band='v',cylindrical=False,fractions=None):
     #### function adapted from pynbody pynbody.analysis.luminosity 
     #### (see https://pynbody.github.io/pynbody/_modules/pynbody/analysis/luminosity.html)
 
-    
+
     '''
-    Assumes ordering of ages_st is the same as sim_particles
+    Assumes ordering of lum_for_each_iord is the same as sim.dm
+
+    Returns the (exact) half-light radius of the dark matter particles of sim, in 3D or in projection (cylindrical),
+    or with fractions (e.g. [0.1,0.25,0.5,0.75,0.9]) the radii enclosing each of these fractions of the light
     '''
 
-    half_l = np.sum(lum_for_each_iord) * 0.5
+    coord = 'rxy' if cylindrical else 'r'
 
-    if cylindrical:
-        coord = 'rxy'
-    else:
-        coord = 'r'
+    radii = calc_enclosed_light_radii(sim.dm[coord], lum_for_each_iord, [0.5] if type(fractions) == type(None) else fractions)
 
-    max_high_r = np.max(sim.st[coord])
-    test_r = 0.5 * max_high_r
+    return radii[0] if type(fractions) == type(None) else radii
 
-    testrf = f.LowPass(coord, test_r)
-    min_low_r = 0.0
 
-    #chosen_particle_ages = ages_st[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-    #chosen_particle_masses = masses[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
 
-    test_l = np.sum(lum_for_each_iord[np.isin(sim.st['iord'],sim.st[testrf]['iord'])])
 
-    it = 0
+def calc_halflight_hydro(sim,lum_for_each_iord,band='v',cylindrical=False,fractions=None):
 
-    while ((np.abs(test_l - half_l) / half_l) > 0.01):
-        it = it + 1
-        if (it > 20):
-            break
+    #### function adapted from pynbody pynbody.analysis.luminosity 
+    #### (see https://pynbody.github.io/pynbody/_modules/pynbody/analysis/luminosity.html)
 
-        if (test_l > half_l):
-            test_r = 0.5 * (min_low_r + test_r)
-        else:
-            test_r = (test_r + max_high_r) * 0.5
+    
+    '''
+    Assumes ordering of lum_for_each_iord is the same as sim.st
+
+    Returns the (exact) half-light radius of the star particles of sim, in 3D or in projection (cylindrical),
+    or with fractions the radii enclosing each of these fractions of the light
+    '''
 
-        testrf = f.LowPass(coord, test_r)
-        #chosen_particle_ages = ages_st[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-        #chosen_particle_masses = masses[np.isin(sim.dm['iord'],sim.dm[testrf]['iord'])]
-        test_l = np.sum(lum_for_each_iord[np.isin(sim.st['iord'],sim.st[testrf]['iord'])])
+    coord = 'rxy' if cylindrical else 'r'
 
-        if (test_l > half_l):
-            max_high_r = test_r
-        else:
-            min_low_r = test_r
+    radii = calc_enclosed_light_radii(sim.st[coord], lum_for_each_iord, [0.5] if type(fractions) == type(None) else fractions)
 
-    return test_r
+    return radii[0] if type(fractions) == type(None) else radii
 
 
 
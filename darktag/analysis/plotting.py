@@ -14,6 +14,9 @@ import matplotlib as mpl
 import seaborn as sns
 from darktag.tagging.utils import *
 from darktag.analysis.calculate import *
+from darktag.tagging.extract import load_extract
+from darktag.tagging.tagged_storage import read_tagged_particles
+from darktag.tagging.iord_index import IordIndex
 import edge_tangos_properties as etp
 from ...config import config 
 
@@ -22,7 +25,7 @@ from ...config import config
 pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
 
 
-def edge_plot_tagged_vs_hydro_mass_dist(name_of_DMO_simulation, name_of_HYDRO_simulation, file_with_tagged_particles, time_to_plot, plot_type='2D Mass Distribution',label=None):
+def edge_plot_tagged_vs_hydro_mass_dist(name_of_DMO_simulation, name_of_HYDRO_simulation, file_with_tagged_particles, time_to_plot, plot_type='2D Mass Distribution',label=None,extract_dir=None):
     
     # Get paths from config
     pynbody_path = config.get_path("pynbody_path")
@@ -47,25 +50,32 @@ def edge_plot_tagged_vs_hydro_mass_dist(name_of_DMO_simulation, name_of_HYDRO_si
     
     output_number = np.where(times_tangos <= time_to_plot)[0][-1]
   
-    d = pd.read_csv(file_with_tagged_particles)
+    # only the particles tagged by time_to_plot are read (file_with_tagged_particles can be a columnar store or a CSV file)
+    d = read_tagged_particles(file_with_tagged_particles, columns=['iords','mstar','t'], t_max=time_to_plot)
 
-    dt = d[ d['t'] <= time_to_plot ].groupby(['iords']).sum()
+    dt = d.groupby(['iords']).sum()
 
     tagged_iords = dt.index.values
     tagged_m = dt['mstar'].values
     
-    print(os.path.join(pynbody_path,name_of_DMO_simulation,outputs[output_number]))
-    s = pynbody.load(os.path.join(pynbody_path,name_of_DMO_simulation,outputs[output_number]))
+    if extract_dir != None:
+        # the extract (see darktag.tagging.extract) is already centred on the halo
+        h_r200 = load_extract(extract_dir,outputs[output_number],halonums[output_number])
+        h_r200 = h_r200.within(h_r200.r200)
+
+    else:
+        print(os.path.join(pynbody_path,name_of_DMO_simulation,outputs[output_number]))
+        s = pynbody.load(os.path.join(pynbody_path,name_of_DMO_simulation,outputs[output_number]))
     
-    h = s.halos()[int(halonums[output_number] - 1)]
+        h = s.halos()[int(halonums[output_number] - 1)]
     
-    s.physical_units()
-    pynbody.analysis.halo.center(h.dm)
-    #pynbody.analysis.angmom.faceon(h.dm)
-    r200_DMO = pynbody.analysis.halo.virial_radius(h, overden=200, r_max=None, rho_def='critical')
+        s.physical_units()
+        pynbody.analysis.halo.center(h.dm)
+        #pynbody.analysis.angmom.faceon(h.dm)
+        r200_DMO = pynbody.analysis.halo.virial_radius(h, overden=200, r_max=None, rho_def='critical')
     
-    print('DMO R200:',r200_DMO)
-    h_r200 = h.dm[h.dm['r'] < r200_DMO]
+        print('DMO R200:',r200_DMO)
+        h_r200 = h.dm[h.dm['r'] < r200_DMO]
 
     selected_parts = h_r200[np.isin(h_r200['iord'],tagged_iords)]
 
@@ -77,12 +87,12 @@ def edge_plot_tagged_vs_hydro_mass_dist(name_of_DMO_simulation, name_of_HYDRO_si
     selected_parts['pos'] -= calc_3D_cm(selected_parts,selected_masses)
 
 
-    st_ages = time_to_plot - (d[ d['t'] <= time_to_plot ]['t'].values)
+    st_ages = time_to_plot - d['t'].values
     
 
     #grouped_first = d[ d['t'] <= time_to_plot ].groupby(['iords']).first()
     
-    ages_df = pd.DataFrame({'ages':st_ages , 'iords':d[ d['t']<=time_to_plot]['iords'].values, 'mstar': d[ d['t']<=time_to_plot]['mstar'].values})
+    ages_df = pd.DataFrame({'ages':st_ages , 'iords':d['iords'].values, 'mstar': d['mstar'].values})
 
     #ordered_ages = np.asarray([ ages_df.loc[part_id]['ages'] for part_id in selected_parts['iord'] ])
     
@@ -431,9 +441,7 @@ def edge_plot_tagged_vs_hydro_mass_dist(name_of_DMO_simulation, name_of_HYDRO_si
 
 def plot_tagged_vs_hydro_mass_dist(DMO_halo_particles, HYDRO_halo_particles, file_with_tagged_particles, time_to_plot, plot_type='2D Mass Distribution'):
 
-    d = pd.read_csv(file_with_tagged_particles)
-
-    dt = d[ d['t'] <= time_to_plot ].groupby(['iords']).last()
+    dt = read_tagged_particles(file_with_tagged_particles, columns=['iords','mstar'], t_max=time_to_plot).groupby(['iords']).last()
 
     tagged_iords = dt.index.values
     tagged_m = dt['mstar'].values
@@ -446,10 +454,7 @@ def plot_tagged_vs_hydro_mass_dist(DMO_halo_particles, HYDRO_halo_particles, fil
 
     selected_parts = h.dm[np.isin(h.dm['iord'],tagged_iords)]
 
-
-    idxs_m = [np.where(tagged_iords == i)[0][0] for i in selected_parts['iord']]
-
-    selected_masses = [tagged_m[i] for i in idxs_m]
+    selected_masses = IordIndex(tagged_iords, mstar=tagged_m).gather('mstar', selected_parts['iord'])
 
     data_all_tagged = pd.DataFrame({'x':selected_parts['x'],'y':selected_parts['y'], 'masses':np.asarray(selected_masses)})
 
@@ -544,8 +549,7 @@ def plot_tagged_vs_hydro_angmom_dist(DMO_halo_particles,HYDRO_halo_particles,fil
 
     # Stellar Mass weighted median at each radial distance  for tagged particles                                                                                                                                                                                   
     
-    d = pd.read_csv(file_with_tagged_particles)
-    dt = d[ d['t'] <= time_to_plot ].groupby(['iords']).last()
+    dt = read_tagged_particles(file_with_tagged_particles, columns=['iords','mstar'], t_max=time_to_plot).groupby(['iords']).last()
     
     tagged_iords = dt.index.values
     
@@ -560,7 +564,7 @@ def plot_tagged_vs_hydro_angmom_dist(DMO_halo_particles,HYDRO_halo_particles,fil
     rtagged = np.sqrt(tagged_particles['x']**2+tagged_particles['y']**2+tagged_particles['z']**2)
     
     #print(tagged_stars['j'].units)                                                                                                                                                                                                                                
-    mstar_tagged = [dt.loc[i]['mstar'] for i in tagged_particles['iord']]
+    mstar_tagged = IordIndex.from_frame(dt, ['mstar']).gather('mstar', tagged_particles['iord'])
     
     dftagged = pd.DataFrame({'r':rtagged,'j':jtagged, 'mass':mstar_tagged })
                                                                                                                                             
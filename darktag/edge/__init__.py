@@ -1,3 +1,4 @@
 from .spatial_tagging import *
 from .angular_momentum_tagging import *
 from .binding_energy_tagging import *
+from .batch import *
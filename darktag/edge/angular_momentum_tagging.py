@@ -27,6 +27,9 @@ import sys
 import pandas as pd
 import darktag.tagging.angular_momentum_tagging as dtag
 from darktag.tagging.utils import *
+from darktag.tagging.snapshot_cache import load_snapshot
+from darktag.tagging.tagged_storage import read_tagged_particles
+from darktag.tagging.mass_ledger import MassLedger
 from darktag.analysis.calculate import *
 from sklearn.cluster import DBSCAN
 from collections import Counter
@@ -237,7 +240,7 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
         
     if ( len(red_all) != len(outputs) ):
         print('output array length does not match redshift and time arrays')
-        data_particles = pd.read_csv(particles_tagged)
+        data_particles = read_tagged_particles(particles_tagged, columns=['iords','mstar','t'])
         data_t = np.asarray(data_particles['t'].values)
         return 0 
 
@@ -252,6 +255,12 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
     PE_energy = np.array([])
     lum_based_halflight = np.array([])
 
+    # luminosities of the tagged particles at every output, evaluated once for the whole run
+    lum_history = LuminosityHistory(data_particles, t_all)
+
+    # stellar mass of each tagged particle as of any output
+    mass_ledger = MassLedger.from_frame(data_particles)
+
     PrevBGMMIords = np.array([]) 
         
         
@@ -263,19 +272,15 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
             continue
 
             
-        dt_all = data_particles[data_particles['t']<=t_all[i]]
-
-            
-        data_grouped = dt_all.groupby(['iords']).sum()
-            
+        mass_index = mass_ledger.index_at(t_all[i])
 
-        selected_iords_tot = data_grouped.index.values
+        selected_iords_tot = mass_index.iords
 
             
         if selected_iords_tot.shape[0]==0:
             continue
             
-        mstars_at_current_time = data_grouped['mstar'].values
+        mstars_at_current_time = mass_index.columns['mstar']
             
         half_mass = float(mstars_at_current_time.sum())/2
             
@@ -296,17 +301,13 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
             
         # try to load in the data from this snapshot
         try:  
-            DMOparticles = pynbody.load(simfn)
+            DMOparticles = load_snapshot(simfn)
 
         # where this data isn't available, notify the user.
         except Exception as err_load:
             print('--> DMO particle data exists but failed to read it, skipping!',err_load)
             continue
             
-        # once the data from the snapshot has been loaded, .physical_units()
-        # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-        #DMOparticles.physical_units()
-            
         children_dm = np.array([])
 
         children_st = np.array([])
@@ -462,7 +463,8 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
             continue
         else:
                 
-            masses = [ data_grouped.loc[n]['mstar'] for n in particle_selection_reff_tot['iord']]
+            # stellar masses of the selected particles, gathered by iord
+            masses = mass_index.gather('mstar', particle_selection_reff_tot['iord'])
                                 
                 
             # new cutoff calc begins 
@@ -473,17 +475,17 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = Fa
 
             sorted_distances = np.sort(distances)
 
-            distance_ordered_iords = np.asarray([particle_selection_reff_tot['iord'][number] for number in idxs_distances_sorted])
+            distance_ordered_iords = np.asarray(particle_selection_reff_tot['iord'][idxs_distances_sorted])
                 
             print('array lengths',len(set(distance_ordered_iords)),len(distance_ordered_iords))
 
-            sorted_massess = [data_grouped.loc[n]['mstar'] for n in distance_ordered_iords]
+            sorted_massess = mass_index.gather('mstar', distance_ordered_iords)
 
             cumilative_sum = np.cumsum(sorted_massess)
 
             R_half = sorted_distances[np.where(cumilative_sum >= (cumilative_sum[-1]/2))[0][0]]
 
-            lum_for_each_part = produce_lums_grouped( dt_all, particle_selection_reff_tot['iord'], t_all[i])
+            lum_for_each_part = lum_history.gather(i, particle_selection_reff_tot['iord'])
             hlight_r = calc_halflight(particle_selection_reff_tot, lum_for_each_part, band='v', cylindrical=False)
                 
             print(hlight_r)
@@ -0,0 +1,311 @@
+
+# batch runner for tagging many simulations / halos of the EDGE suite on one node
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from contextlib import redirect_stdout, redirect_stderr
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import tangos
+
+from darktag.tagging.tagging_wrapper_func import tag_particles
+from ...config import config
+
+
+# the DMO runs of the EDGE suite, named as in the tangos databases (Halo<n>.db)
+edge_dmo_sims = ['Halo383_DMO', 'Halo383_DMO_late', 'Halo383_DMO_early', 'Halo383_DMO_288',
+                 'Halo600_DMO', 'Halo600_DMO_later_mergers',
+                 'Halo605_DMO',
+                 'Halo624_DMO', 'Halo624_DMO_higher_finalmass',
+                 'Halo1445_DMO',
+                 'Halo1459_DMO', 'Halo1459_DMO_Mreionx02', 'Halo1459_DMO_Mreionx03', 'Halo1459_DMO_Mreionx12']
+
+batch_methods = ['angular momentum', 'angular momentum recursive', 'binding energy', 'spatial']
+
+manifest_columns = ['simulation', 'halonumber', 'method', 'ftag']
+
+
+def edge_suite_manifest(sims=None, halonumber=1, methods=['angular momentum'], ftags=None):
+
+    '''
+
+    Inputs:
+
+    sims - simulation names (defaults to edge_dmo_sims)
+    halonumber - halo number of the main halo at the final timestep
+    methods - tagging methods, one of batch_methods each
+    ftags - tagging fractions (defaults to ftag in config.json)
+
+    Returns:
+
+    manifest (dataframe with columns simulation, halonumber, method, ftag) of every combination
+
+    '''
+
+    sims = edge_dmo_sims if sims == None else sims
+    ftags = [config.get("tagging","ftag")] if ftags == None else ftags
+
+    return pd.DataFrame([(sim, int(halonumber), method, float(ftag)) for sim in sims for method in methods for ftag in ftags], columns=manifest_columns)
+
+
+def read_manifest(manifest):
+
+    '''
+
+    Inputs:
+
+    manifest - csv file (or dataframe) with a simulation column and optionally halonumber, method and ftag columns,
+               one tagging job per row. Missing values default to halo 1 and the method and ftag in config.json
+
+    Returns:
+
+    manifest as a dataframe with all four columns
+
+    '''
+
+    jobs = pd.read_csv(manifest) if isinstance(manifest, str) else pd.DataFrame(manifest).copy()
+
+    if 'simulation' not in jobs.columns:
+        raise ValueError('the manifest needs a simulation column')
+
+    defaults = {'halonumber':1, 'method':config.get("tagging","method").replace('_',' '), 'ftag':config.get("tagging","ftag")}
+
+    for column, default in defaults.items():
+        jobs[column] = jobs[column].fillna(default) if column in jobs.columns else default
+
+    jobs['halonumber'] = jobs['halonumber'].astype(int)
+    jobs['ftag'] = jobs['ftag'].astype(float)
+
+    unknown = set(jobs['method']) - set(batch_methods)
+
+    if len(unknown) > 0:
+        raise ValueError('unknown tagging methods in the manifest: '+str(sorted(unknown)))
+
+    return jobs[manifest_columns].reset_index(drop=True)
+
+
+def job_name(job):
+    return str(job['simulation'])+'_halo'+str(int(job['halonumber']))+'_'+str(job['method']).replace(' ','_')+'_ftag'+str(float(job['ftag']))
+
+
+def estimate_snapshot_memory_gb(simname, pynbody_path=None):
+
+    '''
+
+    Estimates the memory (GB) needed to tag a simulation from its largest output on disk, times memory_factor
+    in the "batch" section of config.json. Falls back to default_job_memory_gb where the outputs can't be listed.
+
+    '''
+
+    pynbody_path = config.get_path("pynbody_path") if pynbody_path == None else pynbody_path
+
+    sim_dir = join(pynbody_path, str(simname))
+
+    try:
+        outputs = [join(sim_dir, f) for f in os.listdir(sim_dir) if f[:6] == 'output']
+    except OSError:
+        outputs = []
+
+    if len(outputs) == 0:
+        return float(config.get("batch","default_job_memory_gb",16))
+
+    largest = 0
+
+    for output in outputs:
+        if os.path.isdir(output):
+            largest = max(largest, sum(os.path.getsize(join(output, f)) for f in os.listdir(output) if os.path.isfile(join(output, f))))
+        else:
+            largest = max(largest, os.path.getsize(output))
+
+    return float(config.get("batch","memory_factor",2.0)) * largest / 1024**3
+
+
+def run_job(job, particle_storage_filename, pynbody_path=None):
+
+    '''
+
+    Tags one manifest job in this process (with its own tangos database, Halo<n>.db in tangos_path) and writes
+    the tagged particles to particle_storage_filename. Angular momentum and binding energy jobs are checkpointed
+    after every snapshot in particle_storage_filename.checkpoint, so running the batch again resumes them where they
+    were killed. Spatial jobs are not checkpointed and are tagged again from the start.
+
+    Returns:
+
+    number of particles tagged
+
+    '''
+
+    pynbody_path = config.get_path("pynbody_path") if pynbody_path == None else pynbody_path
+
+    simname = str(job['simulation'])
+
+    tangos.init_db(join(config.get_path("tangos_path"), simname.split('_')[0]+'.db'))
+
+    DMOsim = tangos.get_simulation(simname)
+
+    # the spatial tagger has no checkpoints
+    checkpoint_dir = particle_storage_filename+'.checkpoint' if job['method'] != 'spatial' else None
+
+    # each job runs on one core, the batch runner spreads the jobs over the node
+    df_tagged = tag_particles(DMOsim, path_to_particle_data=pynbody_path, tagging_method=job['method'], free_param_val=float(job['ftag']), halonumber=int(job['halonumber']),
+                              particle_storage_filename=particle_storage_filename, processes=1, checkpoint_dir=checkpoint_dir)
+
+    return len(df_tagged)
+
+
+def _run_job_in_process(job, output_dir, pynbody_path):
+
+    name = job_name(job)
+
+    result = {'job':name, 'status':'failed', 'n_particles':0}
+
+    start = time.time()
+
+    # everything the taggers print goes to the job's log (appended to when a killed job is resumed)
+    with open(join(output_dir, name+'.log'), 'a', buffering=1) as log, redirect_stdout(log), redirect_stderr(log):
+
+        try:
+            result['n_particles'] = run_job(job, join(output_dir, name), pynbody_path)
+            result['status'] = 'done'
+
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = str(e)
+
+    result['elapsed_s'] = time.time() - start
+
+    with open(join(output_dir, name+'.result.json'), 'w') as f:
+        json.dump(result, f, indent=1)
+
+
+def node_memory_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+
+def run_batch(manifest, output_dir, processes=None, memory_gb=None, pynbody_path=None, poll_interval=5.):
+
+    '''
+
+    Runs every job of a manifest (see read_manifest), each in its own process, spreading them over the node.
+    A job is started once a core is free and its estimated memory (see estimate_snapshot_memory_gb) fits in
+    what the running jobs leave of memory_gb. The largest jobs are started first and smaller ones fill the gaps;
+    a job larger than memory_gb runs on its own. Each job writes its tagged particles to output_dir/<job name>,
+    its log to <job name>.log and its status to <job name>.result.json.
+
+    Inputs:
+
+    manifest - csv file or dataframe of jobs
+    output_dir - directory for the tagged particles, logs and batch_summary.csv
+    processes - maximum number of jobs running at once (defaults to the number of cores)
+    memory_gb - memory available to the jobs (defaults to memory_gb in the "batch" section of config.json, 0 for the node's memory)
+
+    Returns:
+
+    dataframe of the jobs with their estimated memory, status, run time and number of tagged particles
+
+    '''
+
+    jobs = read_manifest(manifest)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    processes = os.cpu_count() if processes == None else int(processes)
+
+    if memory_gb == None:
+        memory_gb = config.get("batch","memory_gb",0)
+
+    memory_gb = node_memory_gb() if memory_gb <= 0 else float(memory_gb)
+
+    estimates = {}
+
+    for sim in jobs['simulation'].unique():
+        estimates[sim] = estimate_snapshot_memory_gb(sim, pynbody_path)
+
+    jobs['memory_gb'] = [estimates[sim] for sim in jobs['simulation']]
+    jobs['job'] = [job_name(job) for i, job in jobs.iterrows()]
+
+    print('running',len(jobs),'jobs over',processes,'processes with',round(memory_gb,1),'GB')
+
+    # largest first
+    pending = list(jobs.sort_values('memory_gb', ascending=False, kind='stable').index)
+    running = {}
+
+    while len(pending) > 0 or len(running) > 0:
+
+        for idx in list(pending):
+
+            if len(running) >= processes:
+                break
+
+            in_use = sum(jobs.loc[i, 'memory_gb'] for i in running)
+
+            if len(running) == 0 or in_use + jobs.loc[idx, 'memory_gb'] <= memory_gb:
+
+                process = multiprocessing.Process(target=_run_job_in_process, args=(jobs.loc[idx, manifest_columns].to_dict(), output_dir, pynbody_path))
+                process.start()
+
+                running[idx] = process
+                pending.remove(idx)
+
+                print('started',jobs.loc[idx, 'job'],'(',round(jobs.loc[idx, 'memory_gb'],1),'GB )')
+
+        wait([process.sentinel for process in running.values()], timeout=poll_interval)
+
+        for idx, process in list(running.items()):
+
+            if process.is_alive():
+                continue
+
+            process.join()
+            del running[idx]
+
+            print('finished',jobs.loc[idx, 'job'],'exit code',process.exitcode)
+
+    results = []
+
+    for name in jobs['job']:
+        try:
+            with open(join(output_dir, name+'.result.json')) as f:
+                results.append(json.load(f))
+        except OSError:
+            # the process died before writing its status (e.g. killed for running out of memory)
+            results.append({'job':name, 'status':'killed', 'n_particles':0})
+
+    summary = jobs.merge(pd.DataFrame(results), on='job', how='left')
+
+    summary.to_csv(join(output_dir, 'batch_summary.csv'), index=False)
+
+    print(summary['status'].value_counts().to_string())
+
+    return summary
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Tag the jobs of a manifest (simulation, halonumber, method, ftag) concurrently on this node')
+    parser.add_argument('manifest', help="csv file of jobs, or 'edge' for every DMO run of the EDGE suite")
+    parser.add_argument('output_dir')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--memory-gb', type=float, default=None)
+    parser.add_argument('--methods', nargs='+', default=['angular momentum'], help="methods of the 'edge' manifest")
+    parser.add_argument('--ftags', nargs='+', type=float, default=None, help="tagging fractions of the 'edge' manifest")
+
+    args = parser.parse_args(argv)
+
+    manifest = edge_suite_manifest(methods=args.methods, ftags=args.ftags) if args.manifest == 'edge' else args.manifest
+
+    summary = run_batch(manifest, args.output_dir, processes=args.processes, memory_gb=args.memory_gb)
+
+    return 0 if np.all(summary['status'] == 'done') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
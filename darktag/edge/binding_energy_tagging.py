@@ -27,6 +27,9 @@ import sys
 import pandas as pd
 import darktag.tagging.binding_energy_tagging as dtag
 from darktag.tagging.utils import *
+from darktag.tagging.snapshot_cache import load_snapshot
+from darktag.tagging.tagged_storage import read_tagged_particles
+from darktag.tagging.mass_ledger import MassLedger
 from darktag.analysis.calculate import *
 from ...config import config
 
@@ -312,11 +315,19 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
         if ( len(red_all) != len(outputs) ) : 
             print('output array length does not match redshift and time arrays')
 
-        data_particles = pd.read_csv(particles_tagged)
+        # particles_tagged can be a columnar store or a CSV file (see darktag.tagging.tagged_storage)
+        data_particles = read_tagged_particles(particles_tagged, columns=['iords','mstar','t','type'])
 
         #print('data parts',data_particles['t'])
 
         data_t = np.asarray(data_particles['t'].values)
+
+        # luminosities of the tagged particles at every output, evaluated once for the whole run
+        lum_history = LuminosityHistory(data_particles, t_all)
+
+        # stellar mass of each tagged particle (all of them and in situ only) as of any output
+        mass_ledger = MassLedger.from_frame(data_particles)
+        mass_ledger_insitu = MassLedger.from_frame(data_particles, types=['insitu'])
         
         stored_reff = np.array([])
         stored_reff_acc = np.array([])
@@ -339,24 +350,20 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
                 continue
 
             
-            dt_all = data_particles[data_particles['t']<=t_all[i]]
+            mass_index = mass_ledger.index_at(t_all[i])
 
-            
-            data_grouped = dt_all.groupby(['iords']).sum()
-            
+            selected_iords_tot = mass_index.iords
 
-            selected_iords_tot = data_grouped.index.values
-
-            data_insitu = dt_all[dt_all['type'] == 'insitu'].groupby(['iords']).sum()
+            insitu_index = mass_ledger_insitu.index_at(t_all[i])
             
-            selected_iords_insitu_only = data_insitu.index.values
+            selected_iords_insitu_only = insitu_index.iords
             
             
             if selected_iords_tot.shape[0]==0:
                 continue
 
             
-            mstars_at_current_time = data_grouped['mstar'].values
+            mstars_at_current_time = mass_index.columns['mstar']
             
             half_mass = float(mstars_at_current_time.sum())/2
             
@@ -372,16 +379,12 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
             simfn = join(pynbody_path,DMOname,outputs[i])
             
             # try to load in the data from this snapshot
-            try:  DMOparticles = pynbody.load(simfn)
+            try:  DMOparticles = load_snapshot(simfn)
 
             # where this data isn't available, notify the user.
             except:
                 print('--> DMO particle data exists but failed to read it, skipping!')
                 continue
-            
-            # once the data from the snapshot has been loaded, .physical_units()
-            # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-            DMOparticles.physical_units()
 
             
 
@@ -444,16 +447,19 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
             else:
 
         
-                masses = [ data_grouped.loc[n]['mstar'] for n in particle_selection_reff_tot['iord']]
+                # stellar masses of the selected particles, gathered by iord
+                masses = mass_index.gather('mstar', particle_selection_reff_tot['iord'])
 
-                masses_insitu = [data_insitu.loc[iord]['mstar'] for iord in particles_only_insitu['iord']]
+                masses_insitu = insitu_index.gather('mstar', particles_only_insitu['iord'])
                     
                 cen_stars = calc_3D_cm(particles_only_insitu,masses_insitu)
                 
-                particle_selection_reff_tot['pos'] -= cen_stars
+                # positions about the in situ stars, as a copy: the particles are a view of the cached snapshot, which other
+                # halos and passes over this output share
+                pos = np.asarray(particle_selection_reff_tot['pos']) - cen_stars
                 
                 # new cutoff calc begins 
-                distances = np.sqrt(particle_selection_reff_tot['x']**2+particle_selection_reff_tot['y']**2) #+ particle_selection_reff_tot['z']**2)                
+                distances = np.sqrt(pos[:,0]**2+pos[:,1]**2) #+ pos[:,2]**2)                
                             
                 idxs_distances_sorted = np.argsort(distances)
 
@@ -463,14 +469,14 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
                 
                 print('array lengths',len(set(distance_ordered_iords)),len(distance_ordered_iords))
 
-                sorted_massess = [data_grouped.loc[n]['mstar'] for n in distance_ordered_iords]
+                sorted_massess = mass_index.gather('mstar', distance_ordered_iords)
 
                 cumilative_sum = np.cumsum(sorted_massess)
 
                 R_half = sorted_distances[np.where(cumilative_sum >= (cumilative_sum[-1]/2))[0][0]]
 
-                lum_for_each_part = produce_lums_grouped( dt_all, particle_selection_reff_tot['iord'], t_all[i])
-                hlight_r = calc_halflight(particle_selection_reff_tot, lum_for_each_part, band='v', cylindrical=False)
+                lum_for_each_part = lum_history.gather(i, particle_selection_reff_tot['iord'])
+                hlight_r = calc_enclosed_light_radii(np.sqrt(np.sum(pos**2, axis=1)), lum_for_each_part, [0.5])[0]
                 
                 print(hlight_r)
                 
@@ -483,8 +489,6 @@ def angmom_calculate_reffs(sim_name, particles_tagged,reffs_fname,AHF_centers_fi
                 kravtsov = hDMO['r200c']*0.02
                 kravtsov_r = np.append(kravtsov_r,kravtsov)
 
-                particle_selection_reff_tot['pos'] += cen_stars
-
                 print('halfmass radius:',R_half)
                 print('Kravtsov_radius:',kravtsov)
                 
@@ -14,6 +14,7 @@ import tangos
 import numpy as np
 from numpy import sqrt
 from darklight import DarkLight
+from darktag.tagging.darklight_cache import cached_darklight
 import darklight 
 from os import listdir
 from os.path import *
@@ -24,6 +25,9 @@ import sys
 import pandas as pd
 from darktag.tagging.spatial_tagging import *
 from darktag.tagging.utils import *
+from darktag.tagging.snapshot_cache import load_snapshot
+from darktag.tagging.simulation_index import simulation_index
+from darktag.tagging.tagged_storage import read_tagged_particles, write_tagged_particles
 from ...config import config
 
 
@@ -127,10 +131,11 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
         DMOsim,main_halo,halonums,outputs = load_indexing_data_and_halo_object(DMOname,1)
             
         #darklight stellar masses used for the selection of insitu particles
-        t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = DarkLight(main_halo,DMO=True,mergers=False,poccupied=occupation_fraction)
+        t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = cached_darklight(main_halo,DMO=True,mergers=False,poccupied=occupation_fraction)
         
-        #calculate when the mergers took place (zmerge) and grab all the halo objects involved in the merger (hmerge)
-        zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+        # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+        # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
+        merger_index = simulation_index(DMOsim).merger_index(main_halo)
         
         red_all = main_halo.calculate_for_progenitors('z()')[0][::-1]
        
@@ -140,12 +145,6 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
 
             print('output array length does not match redshift and time arrays')
 
-        # group_mergers() groups all the non-main halo objects that take part in mergers according to the merger redshift.
-        # this array gets stored in hmerge_added in the form -> len = no. of unique zmerges (redshifts of mergers),
-        # elements = all the halo objects of halos merging at this redshift
-        
-        hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
-
         #print the total amount of the (insitu) stellar mass that is to be associated with particles at this snap
         print('dkl',np.array(mstar_s_insitu))
 
@@ -166,13 +165,6 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
             # take a tally of all the particles chosen before this snap
             print('This is how many particles have been chosen:',len(chosen_parts))
             
-            # was particle data loaded in the insitu cycle of tagging ?
-            decision=False
-        
-            # was particle data loaded in the accreted cycle of tagging ?
-            decision2=False
-            decl = False
-            
             # Garbage collection
             gc.collect()
             
@@ -228,14 +220,11 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
             mass_select = int(msn-msp) if msn > 0 else 0
             
             if mass_select>1112:
-                decision=True
                 # try to load in the data from this snapshot
                 
                 try:
-                    DMOparticles = pynbody.load(simfn)
-                    # once the data from the snapshot has been loaded, .physical_units()
-                    # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                    DMOparticles.physical_units()
+                    # shared with the merger branch below through the snapshot cache
+                    DMOparticles = load_snapshot(simfn)
                     #print('Mass units ----------------------------------------------------->',DMOparticles['mass'].in_units('1.00e+10 Msol h**-1'))
                     print('loaded data insitu')
                     
@@ -289,32 +278,24 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
             #get mergers ----------------------------------------------------------------------------------------------------------------
             
                 
-            # check whether current the snapshot has a the redshift just before the merger occurs.
-            if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-                
-                #if particles have already been loaded in, loading them in again is not required
-                decision2 = False if decision==True else True
+            # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
+            if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
                 
                 # The chosen particles from the accreting halo
                 chosen_merger_particles = np.array([])
                 
-                decl=False
-                
-                # the index where the merger's redshift matches the redshift of the snapshot
-                # we perform the selection one redhshift after - so that the accretion has definately taken place
-                t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
-                
                 print('chosen merger particles ----------------------------------------------',len(chosen_merger_particles))
                 
                 #loop over the merging halos and collect particles from each of them
-                for hDM in hmerge_added[t_id][0]:
+                for merger in merger_index.at_output(outputs[i+1]):
                     
                     gc.collect()
+                    hDM = merger_index.halo(merger)
                     print('halo:',hDM)
 
-                    if (np.isin('dm_mass_profile',hDM.keys())):
-                        
-                        prob_occupied = calculate_poccupied(hDM,occupation_fraction)
+                    prob_occupied = merger_index.p_occupied(merger,occupation_fraction,hDM)
+
+                    if prob_occupied != None:
                         print('successfully calculated poccupied')
                         
                     else:
@@ -327,7 +308,7 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
                                                                                                                                                                             
                     try:
                         # loading in the properties of the halo from darklight as above
-                        t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = DarkLight(hDM,DMO=True,mergers=True,poccupied=occupation_fraction)
+                        t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,DMO=True,mergers=True,poccupied=occupation_fraction)
                         print(len(mstar_merging))
                         
                     except Exception as e :
@@ -345,23 +326,15 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
                         leftover+=mstar_merging[-1]
                         continue
                     
-                    # if the particle data is to be loaded in abd halo is predicted to have stellar mass
-                    if float(mass_select_merge) >=1 and decision2==True:
-                        
-                        # try to load in the data from this snapshot
-                        try:
-                            DMOparticles = pynbody.load(simfn).d
-                            DMOparticles.physical_units()
-                            print('loaded data in mergers')
-                        
-                        # where this data isn't available, notify the user.
-                        except:
-                            print('--> DMO particle data exists but failed to read it, skipping!')
-                            continue
-                            
-                        #reset the decision booleans (data has been loaded in now)
-                        decision2 = False
-                        decl=True
+                    # try to load in the data from this snapshot (a cache hit if the insitu step already loaded it)
+                    try:
+                        DMOparticles = load_snapshot(simfn).d
+                        print('loaded data in mergers')
+                    
+                    # where this data isn't available, notify the user.
+                    except:
+                        print('--> DMO particle data exists but failed to read it, skipping!')
+                        continue
                         
                     
                     if int(mass_select_merge) > 0:
@@ -410,10 +383,6 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
 
                         
                             print('triggered , -------------------------------------------------------------------------------------- we selected',len(choose_parts_merger),'particles ------------')
-                 
-            # If particle data has been loaded in, delete this before the next snapshot is analysed
-            if decision==True or decl==True:
-                del DMOparticles
             
             
             print("Done with iteration",i)
@@ -425,7 +394,7 @@ def spatial_tag_particles(sim_name_input,occupation_fraction,filename_for_run,me
         
         df_spatially_tagged_particles = pd.DataFrame({'iords':chosen_parts , 'z':redshift_of_choice, 't':time_of_choice, 'type':part_typ, 'mstar':1112*np.ones(len(chosen_parts))})
         
-        df_spatially_tagged_particles.to_csv(filename_for_run)
+        write_tagged_particles(df_spatially_tagged_particles,filename_for_run)
         
     return df_spatially_tagged_particles
     
@@ -542,7 +511,7 @@ def spatial_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = F
         t_all = main_halo.calculate_for_progenitors('t()')[0][::-1]
 
         #load in the two files containing the particle data
-        data_particles = pd.read_csv(particles_tagged) if from_file==True else particles_tagged
+        data_particles = read_tagged_particles(particles_tagged, columns=['iords','z','type']) if from_file==True else particles_tagged
         data_redshift = data_particles['z']
         
         stored_reff = np.array([])
@@ -556,11 +525,14 @@ def spatial_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = F
 
             gc.collect()
             
-            selected_iords_tot = np.array(data_particles['iords'][data_particles['z']>=red_all[i]])
+            # compared at the precision z is stored at (float32 in columnar stores)
+            z_i = np.asarray(red_all[i], dtype=data_particles['z'].dtype)
+
+            selected_iords_tot = np.array(data_particles['iords'][data_particles['z']>=z_i])
 
-            selected_iords_insitu = np.array(data_particles['iords'][data_particles['z']>=red_all[i]][data_particles['type']=='insitu'])
+            selected_iords_insitu = np.array(data_particles['iords'][data_particles['z']>=z_i][data_particles['type']=='insitu'])
 
-            selected_iords_acc = np.array(data_particles['iords'][data_particles['z']>=red_all[i]][ data_particles['type']=='accreted'])
+            selected_iords_acc = np.array(data_particles['iords'][data_particles['z']>=z_i][ data_particles['type']=='accreted'])
             
             #get the main halo object at the given timestep if its not available then inform the user.
             hDMO = tangos.get_halo(DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]))
@@ -570,6 +542,8 @@ def spatial_calculate_reffs(sim_name, particles_tagged,reffs_fname,from_file = F
             simfn = join(pynbody_path,DMOname,outputs[i])
         
             # try to load in the data from this snapshot
+            # (not taken from the snapshot cache: the positions are shifted in place by the tangos
+            # shrink center below, which assumes the snapshot's original coordinates)
             try:  
                 DMOparticles = pynbody.load(simfn)
            
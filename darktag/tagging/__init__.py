@@ -5,5 +5,17 @@ from .angular_momentum_tagging import *
 #from .angular_momentum_tagging_HYDRO_ARRAYS import *
 #from .angular_momentum_tagging_HYDRO_DM import *
 from .binding_energy_tagging import *
+from .multi_method_tagging import *
 from .utils import * 
+from .snapshot_cache import *
+from .potential import *
+from .potential_store import *
+from .parallel import *
+from .checkpoint import *
+from .halo_registry import *
+from .structure import *
+from .simulation_index import *
+from .darklight_cache import *
 
+from .extract import *
+from .tagged_storage import *
@@ -14,7 +14,7 @@ import sys
 import numpy as np 
 import pandas as pd 
 
-from darklight import DarkLight
+from .darklight_cache import cached_darklight
 
 import tangos
 
@@ -29,13 +29,24 @@ from numpy import sqrt
 import random
 import pynbody
 from .utils import *
-
-def rank_order_particles_by_angmom(particles):
+from .snapshot_cache import load_snapshot, load_halo_snapshot, is_region_snapshot, region_halo
+from .extract import load_extract
+from .tagged_storage import TaggedCatalog, FreeParamSweep, TaggedParticleWriter
+from .parallel import worker_settings, process_pool, SubtreePool, resume_subtrees
+from .checkpoint import TaggingCheckpoint
+from .simulation_index import simulation_index
+from .halo_registry import TaggedHaloRegistry
+from .structure import ReffSweep
+from collections import OrderedDict
+
+def rank_order_particles_by_angmom(particles, tagging_fraction=None):
     
     '''
     Inputs: 
 
     particles - Particle data from pynbody
+    tagging_fraction - if given, only the int(N*tagging_fraction) lowest angular momentum particles (the ones
+                       assign_stars_to_particles tags) are put in order, the rest of the IDs follow unordered
     
     Returns: 
     
@@ -45,11 +56,13 @@ def rank_order_particles_by_angmom(particles):
     
     print('this is how many DMOparticles were passed',len(particles))
 
-    # makes the array 1D via sqrt(jx^2 + jy^2 +jz^2)
-    angular_momenta = get_dist(particles['j'])
+    # makes the array 1D via jx^2 + jy^2 + jz^2 (orders the particles the same way as |j|)
+    angular_momenta = get_dist2(particles['j'])
+
+    n_select = len(angular_momenta) if tagging_fraction == None else int(len(angular_momenta)*tagging_fraction)
 
-    #values arranged in ascending order
-    sorted_indicies = np.argsort(angular_momenta.flatten())
+    #values arranged in ascending order (up to n_select)
+    sorted_indicies = partial_argsort(angular_momenta, n_select)
 
     # particle ids sorted by angular momentum
     particles_ordered_by_angmom = np.asarray(particles['iord'])[sorted_indicies] if sorted_indicies.shape[0] != 0 else np.array([]) 
@@ -68,7 +81,7 @@ def assign_stars_to_particles(snapshot_stellar_mass,particles_sorted_by_angmom,t
     Inputs: 
     
     snapshot_stellar_mass - stellar mass to be tagged in given snapshot 
-    particles_sorted_by_angmom - list of particle dark matter IDs sorted by their angular momenta. 
+    particles_sorted_by_angmom - list of particle dark matter IDs sorted by their angular momenta (only the first int(N*tagging_fraction) need to be in order, see rank_order_particles_by_angmom)
     tagging_fraction - defines the size of the free paramter used to perform tagging 
     
     
@@ -123,13 +136,174 @@ def tag(DMOparticles, hDMO, snapshot_stellar_mass,free_param_value = 0.01, previ
     
     '''
     
-    particles_ordered_by_angmom = rank_order_particles_by_angmom(DMOparticles)
+    particles_ordered_by_angmom = rank_order_particles_by_angmom(DMOparticles, tagging_fraction=free_param_value)
 
     return assign_stars_to_particles(snapshot_stellar_mass,particles_ordered_by_angmom, free_param_value)
     
 
 
-def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, particle_storage_filename=None, mergers = True):
+def load_insitu_particles(simfn, halo_path, halonumber, output, extract_dir = None, AHF_centers = None):
+
+    '''
+
+    Loads the particles of the main halo at one snapshot, centred on it, within r200 and without the particles
+    of its AHF children. These are the particles tag_insitu_snapshot ranks, and those the reffs of a run with
+    compute_reffs=True are measured on (see structure.ReffTable).
+
+    Inputs:
+
+    simfn - path to the snapshot
+    halo_path - tangos path of the main halo at this snapshot
+    halonumber - halo number of the main halo at this snapshot
+    output - name of the snapshot
+    extract_dir - if given, particles are read from the halo extract instead of the snapshot
+    AHF_centers - if given, dataframe matching the main halo to its AHF halo number at each snapshot
+
+    Returns:
+
+    the particles (None if the snapshot has to be skipped)
+
+    '''
+
+    if extract_dir != None:
+
+        # the extract is already centred on the halo
+        try:
+            DMOparticles_insitu_only = load_extract(extract_dir,output,halonumber)
+        except Exception as e:
+            print(e)
+            print('--> halo extract unavailable, skipping!')
+            return None
+
+        DMOparticles_insitu_only = DMOparticles_insitu_only.within(DMOparticles_insitu_only.r200)
+
+        subhalo_iords = np.array([])
+
+    else:
+
+        # loading in the main halo object at this snapshot from tangos 
+        hDMO = tangos.get_halo(halo_path)
+
+        # try to load in the data from this snapshot
+        try:
+            print(simfn)
+            print('loading in DMO particles')
+            
+            # shared with the merger branch (and any other tagging run in this process) through the snapshot cache,
+            # the AHF cross-match needs the full box
+            DMOparticles = load_halo_snapshot(simfn, hDMO) if type(AHF_centers) == type(None) else load_snapshot(simfn)
+            
+            print('loaded data insitu')
+        
+        # where this data isn't available, notify the user.
+        except Exception as e:
+            print(e)
+            print('--> DMO particle data exists but failed to read it, skipping!')
+            return None
+
+        
+        try:
+            hDMO['r200c']
+        except:
+            print("Couldn't load in the R200 at snapshot:" , output)
+            return None
+    
+        subhalo_iords = np.array([])
+        
+        if is_region_snapshot(DMOparticles):
+            # halo catalogues index the full box, so the halo is cut out around the tangos centre instead
+            h = region_halo(DMOparticles, hDMO)
+
+        elif type(AHF_centers) == type(None):
+            print(int(halonumber)-1)
+            h = DMOparticles.halos()[int(halonumber)-1]
+        
+        else:
+            pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
+            
+            AHF_crossref = AHF_centers[AHF_centers['snapshot'] == output]['AHF halonum'].values[0]
+            
+            h = DMOparticles.halos(halo_numbers="v1")[int(AHF_crossref)] 
+            
+            # the "children" are subhalos that need to be removed before centering on the main halo
+            children_ahf_int = h.properties['children']
+        
+            halo_catalogue = DMOparticles.halos(halo_numbers="v1")
+            
+            for ch in children_ahf_int:
+                
+                if ch != AHF_crossref: 
+                    subhalo_iords = np.append(subhalo_iords,halo_catalogue[int(ch)].dm['iord'])
+                                                                                                                                    
+            h = h[np.logical_not(np.isin(h['iord'],subhalo_iords))] if len(subhalo_iords) >0 else h
+
+        pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
+        
+        pynbody.analysis.halo.center(h)
+    
+        try:
+            r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')
+        except:
+            print('could not calculate R200c')
+            return None
+                    
+        DMOparticles_insitu_only = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn ] #hDMO['r200c']]
+
+    # will only be non empty if using AHF catalog
+    DMOparticles_insitu_only = DMOparticles_insitu_only[np.logical_not(np.isin(DMOparticles_insitu_only['iord'],subhalo_iords))]
+
+    return DMOparticles_insitu_only
+
+
+
+def tag_insitu_snapshot(simfn, halo_path, halonumber, output, snapshot_stellar_mass, free_param_values, extract_dir = None, AHF_centers = None, particles = None):
+
+    '''
+
+    Selects the particles of the main halo tagged with the stellar mass formed in situ at one snapshot. This only
+    depends on the snapshot's particles and the stellar mass to be tagged, so the snapshots can be tagged in any
+    order (angmom_tag_over_full_sim hands them to worker processes in parallel mode).
+
+    Inputs:
+
+    simfn - path to the snapshot
+    halo_path - tangos path of the main halo at this snapshot
+    halonumber - halo number of the main halo at this snapshot
+    output - name of the snapshot
+    snapshot_stellar_mass - stellar mass to be tagged in this snapshot
+    free_param_values - list of tagging fractions to select particles for
+    extract_dir - if given, particles are read from the halo extract instead of the snapshot
+    AHF_centers - if given, dataframe matching the main halo to its AHF halo number at each snapshot
+    particles - particles of the main halo as returned by load_insitu_particles (loaded here if not given)
+
+    Returns:
+
+    None if the snapshot has to be skipped, otherwise a dictionary of the output of assign_stars_to_particles
+    (particle IDs and stellar masses) keyed by tagging fraction
+
+    '''
+
+    if type(particles) == type(None):
+        particles = load_insitu_particles(simfn, halo_path, halonumber, output, extract_dir, AHF_centers)
+
+    if type(particles) == type(None):
+        return None
+
+    print('mass to be tagged insitu:',snapshot_stellar_mass)
+
+    DMOparticles_insitu_only = particles
+
+    # ranked once, up to the largest tagging fraction
+    particles_sorted_by_angmom = rank_order_particles_by_angmom( DMOparticles_insitu_only, tagging_fraction=max(free_param_values))
+    
+    if particles_sorted_by_angmom.shape[0] == 0:
+        return None
+
+    return OrderedDict((value, assign_stars_to_particles(snapshot_stellar_mass,particles_sorted_by_angmom,value)) for value in free_param_values)
+
+
+
+def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pynbody_path  = None, particle_storage_filename=None, mergers = True, extract_dir = None, occupation_frac = 'all', AHF_centers_file = None, processes = None, memory_per_worker_gb = None, checkpoint_dir = None, compute_reffs = False):
     
     '''
 
@@ -139,37 +313,53 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
 
     DMOsim - tangos simulation 
     free_param_value - specifies the size of the 'tagging fraction' when tagging dm particles with stellar mass (bigger values correspond to a larger spread of angmom.)
+                       A list of values tags all of them in one pass over the simulation (see tagged_storage.FreeParamSweep)
     pynbody_path - path to particle data 
     occupation_frac - One of 'nadler20' , 'all' , 'edge1' or 'edgert' (controls the occupation regime followed by darklight)
+    particle_storage_filename - if given, tagged particles are written here as they are tagged (a columnar store, or CSV if the name ends in .csv, see tagged_storage)
+                                For a list of free_param_value values, one file per value is written (see tagged_storage.ftag_filename)
     mergers - Whether to include merging/accreting halos or not. 
+    extract_dir - if given, particles are read from the halo extracts written by extract_halo_regions instead of the snapshots
+    AHF_centers_file - if given, the main halo is centred using the AHF halo numbers in the manual_halonum_path file of config.json
+    processes - number of worker processes the in situ tagging of the snapshots is spread over (defaults to the "parallel"
+                section of config.json). The snapshots are tagged in parallel (see tag_insitu_snapshot) while the mergers
+                are tagged in time order in this process.
+    memory_per_worker_gb - memory cap of each worker process in GB (0 for none, defaults to config)
+    checkpoint_dir - if given, the run is checkpointed there after every snapshot (see checkpoint.TaggingCheckpoint) and
+                     resumed from the checkpoint if there is one, after the last snapshot it had done
+    compute_reffs - if True, the projected half-mass, half-light and Kravtsov radii of the stars tagged so far are measured
+                    after each snapshot's tagging, on the particles of the main halo already in memory (see structure.ReffTable),
+                    instead of in a second pass over the snapshots with calculate_reffs_over_full_sim. They are written next
+                    to particle_storage_filename (see structure.reffs_filename)
     
     Returns: 
     
-    dataframe with tagged particle masses at given times, redshifts and associated particle IDs  
+    dataframe with tagged particle masses at given times, redshifts and associated particle IDs 
+    (a dictionary of them keyed by value when free_param_value is a list), and with compute_reffs the dataframe
+    (or dictionary) of reffs
     
     '''
     
+    # Use config path if pynbody_path not provided
+    if pynbody_path is None:
+        pynbody_path = config.get_path("pynbody_path")
+
     # Name of simulation
     DMOname = DMOsim.path
 
     t_all,red_all,main_halo,halonums,outputs = load_indexing_data(DMOsim,halonumber)
 
     # Get stellar masses at each redshift using darklight for insitu tagging (mergers = False excludes accreted mass)
-    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total =DarkLight(main_halo,DMO=True,n=config.get("darklight","n"),mergers=False)
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total =cached_darklight(main_halo,DMO=True,n=config.get("darklight","n"),mergers=False)
 
-    #calculate when the mergers took place and grab all the tangos halo objects involved in the merger (zmerge = merger redshift, hmerge = merging halo objects,qmerge = merger ratio)
-    zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+    # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+    # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
+    merger_index = simulation_index(DMOsim).merger_index(main_halo)
     
     if ( len(red_all) != len(outputs) ) : 
 
         print('output array length does not match redshift and time arrays')
     
-    # group_mergers groups all merging objects by redshift.
-    # this array gets stored in hmerge_added in the form => len = no. of unique zmerges, 
-    # elements = all the hmerges of halos merging at each zmerge
-    
-    hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
-    
     mstars_total_darklight_l = [] 
     
     # number of stars left over after selection (per iteration)
@@ -181,197 +371,106 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
     
     # if an AHF centering file is provided use the centers stored within it
     AHF_centers = pd.read_csv(config.get_path("manual_halonum_path")) if AHF_centers_file != None else None
-    df_header = pd.DataFrame({'iords':[], 'mstar':[],'t':[],'z':[],'type':[]})
-    
-    df_header.to_csv(particle_storage_filename,mode="w",header=True)
 
     accreted_only_particle_ids = np.array([])
     insitu_only_particle_ids   = np.array([])
     
-    tagged_iords_to_write  = np.array([])
-    tagged_types_to_write  = np.array([])
-    tagged_mstars_to_write = np.array([])
-    
-    ts_to_write = np.array([])
-    zs_to_write = np.array([])
-    
-    # looping over all snapshots  
-    for i in range(len(outputs)):
-        gc.collect()
-        
-        # was particle data loaded in (insitu) 
-        decision=False
+    # all tagged particles (iords, mstars, times, redshifts and types) of each free parameter value,
+    # appended to particle_storage_filename snapshot by snapshot if it is given
+    tagged_particles = FreeParamSweep(free_param_value, particle_storage_filename)
+
+    checkpoint = TaggingCheckpoint(checkpoint_dir, run={'simulation':DMOname, 'halonumber':int(halonumber), 'method':'angular momentum', 'free_param_value':tagged_particles.values}) if checkpoint_dir != None else None
+
+    # first snapshot to tag (after the last one done by a previous run)
+    i_start = 0
+
+    if checkpoint != None and checkpoint.exists():
+
+        resumed = checkpoint.load()
 
-        # was particle data loaded in through the accreted tagging part
-        decision2=False
-        decl = False
+        tagged_particles.restore(resumed['catalogs'])
+
+        i_start = checkpoint.resume_index(outputs, resumed['output'])
+
+        print('resuming from the checkpoint after',resumed['output'],':',len(outputs)-i_start,'snapshots left')
+
+    # reffs of the stars tagged so far, measured after each snapshot and written next to the tagged particles
+    reffs = ReffSweep(tagged_particles) if compute_reffs == True else None
+
+    if reffs != None:
+
+        # r200c of the main halo at each snapshot (for the Kravtsov radius), in the order of t_all
+        r200c_all = simulation_index(DMOsim).branch(main_halo)['r200c'][::-1]
+
+        reffs.restore(t_all[i_start-1] if i_start > 0 else -np.inf)
     
-        print('Current snapshot -->',outputs[i])
+    processes, memory_per_worker_gb = worker_settings(processes, memory_per_worker_gb)
 
-        # loading in the main halo object at this snapshot from tangos 
-        hDMO = tangos.get_halo(DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]))
+    # stellar mass to be tagged in situ at each snapshot (None where darklight has no stars yet)
+    mass_selects = insitu_stellar_mass_to_tag(t, mstar_s_insitu, t_all)
 
-        # value of redshift at the current timestep 
-        z_val = red_all[i]
-                
-        # time in gyr
-        t_val = t_all[i]
+    # in parallel mode the in-situ tagging of the snapshots is handed to a pool of worker processes up front,
+    # and the results are collected (and the mergers tagged) in time order below
+    insitu_results = {}
 
-        # 't' is the darklight time array 
-        # idrz is thus the index of the mstar value calculated at the closest time to that of the snap
-        idrz = np.argmin(abs(t - t_val))
+    pool = process_pool(processes, memory_per_worker_gb) if processes > 1 else None
 
-        # index of previous snap's mstar value in darklight array
-        idrz_previous = np.argmin(abs(t - t_all[i-1])) if idrz>0 else None 
+    if pool != None:
 
-        # current snap's darklight calculated stellar mass 
-        msn = mstar_s_insitu[idrz]              
+        print('tagging in situ particles of',sum(1 for m in mass_selects if m != None and m > 0),'snapshots over',processes,'processes')
 
-        # msp = previous snap's darklight calculated stellar mass 
-        if msn != 0:
-            # if there wasn't a previous snap msp = 0 
-            
-            if idrz_previous==None:
-                msp = 0
-                
-            # else msp = previous snap's mstar value
-            elif idrz_previous >= 0:
-                msp = mstar_s_insitu[idrz_previous]
-        else:
+        for i in range(i_start, len(outputs)):
+            if mass_selects[i] != None and mass_selects[i] > 0:
+                insitu_results[i] = pool.submit(tag_insitu_snapshot, join(pynbody_path,DMOname,outputs[i]), DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]), halonums[i], outputs[i], mass_selects[i], tagged_particles.values, extract_dir, AHF_centers)
+
+    # looping over all snapshots  
+    for i in range(i_start, len(outputs)):
+        gc.collect()
+        
+        print('Current snapshot -->',outputs[i])
+
+        # particles of the main halo, kept for the reffs when they are loaded in this process
+        insitu_particles = None
+
+        if mass_selects[i] == None:
             print('There is no stellar mass at current timestep')
             continue
 
-                                                                    
-        #calculate the difference in mass between the two mstar's
-        mass_select = int(msn-msp)
+        #difference in mass between the darklight mstar's of this and the previous snap
+        mass_select = mass_selects[i]
         print('stellar mass to be tagged in this snap -->',mass_select)
         print('tagging for t (gyr) = ',t_all[i])
 
-        # if stellar mass is to be tagged then load in particle data 
+        # if stellar mass is to be tagged then select the particles (or collect them from the pool)
         if mass_select>0:
-            
-            # try to load in the data from this snapshot
-            
-            try:
-                simfn = join(config.get_path("pynbody_path"),DMOname,outputs[i])
-                
-                print(simfn)
-                print('loading in DMO particles')
-                
-                DMOparticles = pynbody.load(simfn)
-                
-                # once the data from the snapshot has been loaded, .physical_units()
-                # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                DMOparticles.physical_units()
-                
-                #print('total energy  ---------------------------------------------------->',DMOparticles['te'])
-                print('loaded data insitu')
-            
-            # where this data isn't available, notify the user.
-            except Exception as e:
-                print(e)
-                print('--> DMO particle data exists but failed to read it, skipping!')
-                continue
-
-            # data was loaded in
-            decision=True
 
-            print('mass to be tagged insitu:',mass_select)
-            
-            try:
-                hDMO['r200c']
-            except:
-                print("Couldn't load in the R200 at timestep:" , i)
-                continue
-        
-            subhalo_iords = np.array([])
-            
-            if type(AHF_centers_file) == type(None):
-                print(int(halonums[i])-1)
-                h = DMOparticles.halos()[int(halonums[i])-1]
-            
-            elif type(AHF_centers_file) != type(None):
-                pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
-                
-                AHF_crossref = AHF_centers[AHF_centers['snapshot'] == outputs[i]]['AHF halonum'].values[0]
-                
-                h = DMOparticles.halos(halo_numbers="v1")[int(AHF_crossref)] 
-                
-                # the "children" are subhalos that need to be removed before centering on the main halo
-                children_ahf_int = h.properties['children']
-            
-                halo_catalogue = DMOparticles.halos(halo_numbers="v1")
-            
-                subhalo_iords = np.array([])
-                
-                for ch in children_ahf_int:
-                    
-                    if ch != AHF_crossref: 
-                        subhalo_iords = np.append(subhalo_iords,halo_catalogue[int(ch)].dm['iord'])
-                                                                                                                                        
-                h = h[np.logical_not(np.isin(h['iord'],subhalo_iords))] if len(subhalo_iords) >0 else h
+            if i in insitu_results:
+                try:
+                    selections = insitu_results.pop(i).result()
+                except Exception as e:
+                    print(e)
+                    print('--> in situ tagging failed in the worker process, skipping!')
+                    continue
 
-            
-            pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
-            
-            pynbody.analysis.halo.center(h)
-        
-            try:                                                                                                                                                                                              
-                r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')                                                                                             
-                                                                                                                                                                                                              
-            except:                                                                                                                                                                                           
-                print('could not calculate R200c')                                                                                                                                                            
-                continue                                                                                                                                                                                      
-                                                                                                                                                                            
-                        
-            DMOparticles_insitu_only = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn ] #hDMO['r200c']]
+            else:
+                if reffs != None:
+                    insitu_particles = load_insitu_particles(join(pynbody_path,DMOname,outputs[i]), DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]), halonums[i], outputs[i], extract_dir, AHF_centers)
 
-            # will only be non empty if using AHF catalog
-            DMOparticles_insitu_only = DMOparticles_insitu_only[np.logical_not(np.isin(DMOparticles_insitu_only['iord'],subhalo_iords))]
+                selections = tag_insitu_snapshot(join(pynbody_path,DMOname,outputs[i]), DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]), halonums[i], outputs[i], mass_select, tagged_particles.values, extract_dir, AHF_centers, insitu_particles)
 
-            
-            particles_sorted_by_angmom = rank_order_particles_by_angmom( DMOparticles_insitu_only)
-            
-            if particles_sorted_by_angmom.shape[0] == 0:
+            if selections == None:
                 continue
             
-            array_to_write = assign_stars_to_particles(mass_select,particles_sorted_by_angmom,float(free_param_value))
+            array_to_write = tagged_particles.record(selections,t_all[i],red_all[i],'insitu')
             
             print('writing insitu particles to output file')
             
-            tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write[0])
-            tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('insitu',len(array_to_write[0])))
-            tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write[1])
-
-            ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write[0])))
-            zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write[0])))
-
-            row_to_write = pd.DataFrame({'iords':array_to_write[0],
-                                         'mstar':array_to_write[1],
-                                         't':np.repeat(t_all[i],len(array_to_write[0])),
-                                         'z':np.repeat(red_all[i],len(array_to_write[0])),
-                                         'type':np.repeat('insitu',len(array_to_write[0]))})
-
-            if particle_storage_filename != None:
-                row_to_write.to_csv(particle_storage_filename,mode='a',header=False)
             insitu_only_particle_ids = np.append(insitu_only_particle_ids,np.asarray(array_to_write[0]))
             
-            #pynbody.analysis.halo.center(h,mode='hyb').revert()
-
-            del DMOparticles_insitu_only
-            
             #get mergers ----------------------------------------------------------------------------------------------------------------
-            # check whether current the snapshot has a the redshift just before the merger occurs.
+            # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
         
-        if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-
-            # do not load in data again if loaded in through the insitu tagging part
-            decision2 = False if decision==True else True
-
-            # loaded data in this snap
-            decl=False
-            
-            t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
+        if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
 
             #print('chosen merger particles ----------------------------------------------',len(chosen_merger_particles))
             #loop over the merging halos and collect particles from each of them
@@ -379,16 +478,15 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
             #mstars_total_darklight = np.array([])
             DMO_particles = 0 
             
-            for hDM in hmerge_added[t_id][0]:
+            for merger in merger_index.at_output(outputs[i+1]):
                 gc.collect()
+                hDM = merger_index.halo(merger)
                 print('halo:',hDM)
                 
                 if (occupation_frac != 'all'):
-                    try:
-                        prob_occupied = calculate_poccupied(hDM,2.5e7)
+                    prob_occupied = merger_index.p_occupied(merger,2.5e7,hDM)
 
-                    except Exception as e:
-                        print(e)
+                    if prob_occupied == None:
                         print("poccupied couldn't be calculated")
                         continue
                     
@@ -398,7 +496,7 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
                         
                 
                 try:
-                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging =DarkLight(hDM,DMO=True,n=config.get("darklight","n"),mergers=True)
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging =cached_darklight(hDM,DMO=True,n=config.get("darklight","n"),mergers=True)
 
                     if len(mstar_merging)==0:
                         print("halo has not yet formed stars")
@@ -424,26 +522,27 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
                     continue
                 
                 
-                simfn = join(config.get_path("pynbody_path"),DMOname,outputs[i])
+                simfn = join(pynbody_path,DMOname,outputs[i])
 
-                if float(mass_select_merge) >0 and decision2==True:
-                    # try to load in the data from this snapshot
-                    try:
-                        DMOparticles = pynbody.load(simfn)
-                        DMOparticles.physical_units()
-                    
-                        print('loaded data in mergers')
-                    # where this data isn't available, notify the user.
-                    except:
-                        print('--> DMO particle data exists but failed to read it, skipping!')
-                        continue
-                    decision2 = False
-                    decl=True
+                # try to load in the data from this snapshot (a cache hit if the insitu step already loaded it)
+                try:
+                    DMOparticles = load_extract(extract_dir,outputs[i],hDM.calculate('halo_number()')) if extract_dir != None else load_halo_snapshot(simfn, hDM)
+                
+                    print('loaded data in mergers')
+                # where this data isn't available, notify the user.
+                except:
+                    print('--> DMO particle data exists but failed to read it, skipping!')
+                    continue
              
-                if int(mass_select_merge) > 0:
+                if int(mass_select_merge) > 0 and extract_dir != None:
+
+                    # the extract is already centred on the merging halo
+                    DMOparticles_acc_only = DMOparticles.within(DMOparticles.r200)
+
+                elif int(mass_select_merge) > 0:
 
                     try:
-                        h_merge = DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
+                        h_merge = region_halo(DMOparticles, hDM) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
                         pynbody.analysis.halo.center(h_merge.dm)
                         
                     except Exception as ex:
@@ -453,53 +552,58 @@ def angmom_tag_over_full_sim(DMOsim, halonumber = 1 ,free_param_value = 0.01, pa
                     r200c_pyn_acc = pynbody.analysis.halo.virial_radius(h_merge.d, overden=200, r_max=None, rho_def='critical')
                     DMOparticles_acc_only = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn_acc] 
 
+                if int(mass_select_merge) > 0:
                                             
                     try:
-                        accreted_particles_sorted_by_angmom = rank_order_particles_by_angmom(DMOparticles_acc_only)
+                        accreted_particles_sorted_by_angmom = rank_order_particles_by_angmom(DMOparticles_acc_only, tagging_fraction=tagged_particles.max_value)
                     except:
                         continue
                     
         
                     print('assinging stars to accreted particles')
 
-                    array_to_write_accreted = assign_stars_to_particles(mass_select_merge,accreted_particles_sorted_by_angmom,float(free_param_value))
-                    tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write_accreted[0])
-                    tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('accreted',len(array_to_write_accreted[0])))
-                    tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write_accreted[1])
-                    ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write_accreted[0])))
-                    zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write_accreted[0])))
-                    
-                    row_to_write = pd.DataFrame({'iords':array_to_write_accreted[0], 
-                                  'mstar':array_to_write_accreted[1],
-                                  't':np.repeat(t_all[i],len(array_to_write_accreted[0])),
-                                  'z':np.repeat(red_all[i],len(array_to_write_accreted[0])),
-                                  'type':np.repeat('accreted',len(array_to_write_accreted[0]))})
-
-                    if particle_storage_filename != None:
-                        row_to_write.to_csv(particle_storage_filename,mode='a',header=False)
+                    array_to_write_accreted = tagged_particles.tag(assign_stars_to_particles,mass_select_merge,accreted_particles_sorted_by_angmom,t_all[i],red_all[i],'accreted')
         
                     accreted_only_particle_ids = np.append(accreted_only_particle_ids,np.asarray(array_to_write_accreted[0]))
                     print('writing accreted particles to output file')
           
                     del DMOparticles_acc_only
-        
-                  
-                            
-        if decision==True or decl==True:
-            del DMOparticles
     
+        if reffs != None:
+
+            # the merging halos were centred on in the same snapshot, but the reffs are measured about the centre of
+            # the tagged stars, so the particles loaded for the in situ tagging can still be used
+            if type(insitu_particles) == type(None):
+                insitu_particles = load_insitu_particles(join(pynbody_path,DMOname,outputs[i]), DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]), halonums[i], outputs[i], extract_dir, AHF_centers)
+
+            reffs.measure(insitu_particles, t_all[i], red_all[i], r200c_all[i])
+
+            del insitu_particles
     
         print("Done with iteration",i)
 
-        df_tagged_particles = pd.DataFrame({'iords':tagged_iords_to_write, 'mstar':tagged_mstars_to_write,'t':ts_to_write,'z':zs_to_write,'type':tagged_types_to_write})
+        if checkpoint != None:
+            checkpoint.save(outputs[i], tagged_particles.named_catalogs())
+
+            if reffs != None:
+                reffs.write()
 
-        if particle_storage_filename != None:
-            df_tagged_particles.to_csv(particle_storage_filename)
+    if pool != None:
+        pool.shutdown()
+
+    if checkpoint != None and len(outputs) > 0:
+        checkpoint.save(outputs[-1], tagged_particles.named_catalogs())
+
+    tagged_particles.close()
+
+    if reffs != None:
+        reffs.write()
+        return tagged_particles.to_dataframes(), reffs.to_dataframes()
             
-    return df_tagged_particles
+    return tagged_particles.to_dataframes()
 
 
-def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value = 0.001,free_param_value_acc = None ,pynbody_path  = None, particle_storage_filename=None, AHF_centers_filepath=None, mergers = True, df_tagged_particles=None ,tag_typ='insitu',acc_halo_path_tagged=None,main_halo_paths=None):
+def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value = 0.001,free_param_value_acc = None ,pynbody_path  = None, particle_storage_filename=None, AHF_centers_filepath=None, mergers = True, df_tagged_particles=None ,tag_typ='insitu',acc_halo_path_tagged=None,main_halo_paths=None,return_catalog=False, processes = None, memory_per_worker_gb = None, checkpoint_dir = None):
 
     '''
 
@@ -513,10 +617,22 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
     pynbody_path - path to particle data 
     occupation_frac - One of 'nadler20' , 'all' , 'edge1' or 'edgert' (controls the occupation regime followed by darklight)
     mergers - Whether to include merging/accreting halos or not. 
+    df_tagged_particles - particles tagged so far (TaggedCatalog or dataframe), new particles are appended to it
+    particle_storage_filename - if given (top level call only), the tagged particles are written here as they are tagged, the new rows
+                                appended after every snapshot (a columnar store, or CSV if the name ends in .csv, see tagged_storage)
+    return_catalog - return the TaggedCatalog itself rather than a dataframe (used by the recursive calls)
+    processes - number of worker processes the accreted halos are tagged over (defaults to the "parallel" section of config.json).
+                With more than one, each accreted halo not tagged yet is tagged over its full lifetime as a separate task
+                (see parallel.SubtreePool) and the results are appended after the halo's own particles.
+    memory_per_worker_gb - memory cap of each worker process in GB (0 for none, defaults to config)
+    checkpoint_dir - if given (top level call only), the run is checkpointed there after every snapshot (see checkpoint.TaggingCheckpoint)
+                     and resumed from the checkpoint if there is one, after the last snapshot it had done
+    acc_halo_path_tagged - TaggedHaloRegistry of the halos tagged and skipped so far, shared down the merger tree (recursive calls)
     
     Returns: 
     
-    dataframe with tagged particle masses at given times, redshifts and associated particle IDs  
+    dataframe (or TaggedCatalog) with tagged particle masses at given times, redshifts and associated particle IDs,
+    and the TaggedHaloRegistry of the halos tagged over their full lifetimes and of the merging halos skipped (with the reason)
     
     '''
 
@@ -533,22 +649,20 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
     
     print(config.get("darklight","n"))
 
-    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = DarkLight(main_halo,DMO=True,n=config.get("darklight","n"),mergers=False) 
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = cached_darklight(main_halo,DMO=True,n=config.get("darklight","n"),mergers=False) 
     
     mstar_s_insitu = np.asarray(mstar_s_insitu[0])
     print("t,z:",t,redshift)
 
-    # calculate when the mergers took place and grab all the tangos halo objects involved in the merger (zmerge = merger redshift, hmerge = merging halo objects,qmerge = merger ratio)
+    # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+    # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
     # these are based on the HOP catalogue by default 
     
-    zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+    merger_index = simulation_index(DMOsim).merger_index(main_halo)
 
     # check time and output array have same size 
     if ( len(red_all) != len(outputs) ) : 
         print('output array length does not match redshift and time arrays')
-    
-    # group_mergers groups all merging halo objects by redshift.
-    hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
 
     mstars_total_darklight_l = []
     
@@ -565,54 +679,76 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
     AHF_centers = pd.read_csv(os.path.join(AHF_centers_filepath,str(DMOname)+"_rec.csv")) if type(AHF_centers_filepath) != type(None) else None
     AHF_centers_acc = pd.read_csv(os.path.join(AHF_centers_filepath,str(DMOname)+"_accreted_rec.csv")) if type(AHF_centers_filepath) != type(None) else None
     
-    tagged_iords_to_write = np.array([])
-    tagged_types_to_write = np.array([])
-    tagged_mstars_to_write = np.array([])
-    
-    ts_to_write = np.array([])
-    zs_to_write = np.array([])
-    
-    # record of tagged objects for the recursive run where the loop goes through all merging objects 
-    acc_halo_path_tagged = np.array([]) if (type(acc_halo_path_tagged) == type(None)) else acc_halo_path_tagged 
+    # record of tagged (and skipped) objects for the recursive run where the loop goes through all merging objects 
+    acc_halo_path_tagged = TaggedHaloRegistry.from_paths(acc_halo_path_tagged)
+
+    # the top level call starts from an empty registry
+    top_level = len(acc_halo_path_tagged) == 0
     
+    # one catalog is passed down the merger tree and appended to in place
     if  type(df_tagged_particles) == type(None):    
-        df_tagged_particles = pd.DataFrame({'iords':tagged_iords_to_write, 'mstar':tagged_mstars_to_write,'t':ts_to_write,'z':zs_to_write,'type':tagged_types_to_write})
+        df_tagged_particles = TaggedCatalog()
+
+    elif isinstance(df_tagged_particles, pd.DataFrame):
+        df_tagged_particles = TaggedCatalog.from_dataframe(df_tagged_particles)
     
     #if (particle_storage_filename != None): 
     #    df_tagged_particles.to_csv(particle_storage_filename)
     
     if len(acc_halo_path_tagged) > 0:
 
-        halo_path = main_halo.calculate_for_progenitors('path()')
+        halo_path = [simulation_index(DMOsim).branch(main_halo)['path']]
         print("halopath:",halo_path)
-        main_halo_paths = np.array([])
-        main_halo_paths = np.append(main_halo_paths,halo_path[0][0])
+        main_halo_paths = [halo_path[0][0]]
 
-        if ( len(np.where(np.isin(main_halo_paths,acc_halo_path_tagged) == True)[0]) > 0):
+        if acc_halo_path_tagged.any_tagged(main_halo_paths):
 
-            print("overlap at : ",main_halo_paths[np.where(np.isin(main_halo_paths,acc_halo_path_tagged) == True)])
+            print("overlap at : ",main_halo_paths[0])
             print("for halo : ",acc_halo_path_tagged )
-            return df_tagged_particles,acc_halo_path_tagged
+            acc_halo_path_tagged.skip(main_halo_paths[0],'already tagged')
+            return (df_tagged_particles if return_catalog == True else df_tagged_particles.to_dataframe()),acc_halo_path_tagged
+
 
+    halo_path = [simulation_index(DMOsim).branch(main_halo)['path']]
+    acc_halo_path_tagged.add(halo_path[0][0])
 
-    halo_path = main_halo.calculate_for_progenitors('path()')
-    acc_halo_path_tagged = np.append(acc_halo_path_tagged,halo_path[0][0])
+    processes, memory_per_worker_gb = worker_settings(processes, memory_per_worker_gb)
 
+    # in parallel mode the accreted halos are handed to worker processes rather than recursed into
+    subtrees = SubtreePool(processes, memory_per_worker_gb) if processes > 1 else None
+
+    checkpoint = TaggingCheckpoint(checkpoint_dir, run={'simulation':DMOname, 'halonumber':int(halonumber), 'method':'angular momentum recursive', 'free_param_value':float(free_param_value), 'free_param_value_acc':float(free_param_value_acc)}) if checkpoint_dir != None else None
+
+    # first snapshot to tag (after the last one done by a previous run)
+    i_start = 0
+
+    if checkpoint != None and checkpoint.exists():
+
+        resumed = checkpoint.load()
+
+        df_tagged_particles = resumed['catalogs']['catalog']
+        acc_halo_path_tagged = resumed['acc_halo_path_tagged']
+
+        i_start = checkpoint.resume_index(outputs, resumed['output'])
+
+        print('resuming from the checkpoint after',resumed['output'],':',len(outputs)-i_start,'snapshots left')
+
+        # accreted halos that were still being tagged by worker processes
+        df_tagged_particles,acc_halo_path_tagged = resume_subtrees(subtrees,angmom_tag_over_full_sim_recursive,DMOsim,resumed['state']['subtrees'],df_tagged_particles,acc_halo_path_tagged)
+
+    # the particles tagged so far are written once, then each snapshot's new rows are appended to the same store
+    writer = TaggedParticleWriter(particle_storage_filename) if particle_storage_filename != None else None
+
+    if writer != None:
+        writer.append_catalog(df_tagged_particles)
 
     # looping over all snapshots  
-    for i in range(len(outputs)):
+    for i in range(i_start, len(outputs)):
         
         gc.collect()
 
         if len(t) == 0:
             continue
-
-        # was particle data loaded in (insitu) 
-        decision=False
-
-        # was particle data loaded in (accreted) 
-        decision2=False
-        decl = False
     
         print('Current snapshot -->',outputs[i])
     
@@ -662,8 +798,6 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                 # if AHF centers are available then the priority is changed to the AHF catalogue (Which is 1 indexed)
                 pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
             
-            decision=True
-            
             # try to load in the data from this snapshot
             
             try:
@@ -673,10 +807,9 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                 print(simfn)
                 print('loading in DMO particles')
                 
-                DMOparticles = pynbody.load(simfn)
-                # once the data from the snapshot has been loaded, .physical_units()
-                # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                DMOparticles.physical_units()
+                # outputs already read for the parent (or a sibling) halo come straight from the snapshot cache
+                # (region loading relies on tangos centres, so it is only used without AHF catalogues)
+                DMOparticles = load_halo_snapshot(simfn, hDMO) if type(AHF_centers_filepath) == type(None) else load_snapshot(simfn)
                 #DMOparticles = DMOparticles.d 
                 print('loaded data insitu')
             
@@ -698,7 +831,11 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
         
             subhalo_iords = np.array([])
             
-            if type(AHF_centers_filepath) == type(None):
+            if is_region_snapshot(DMOparticles):
+                # halo catalogues index the full box, so the halo is cut out around the tangos centre instead
+                h = region_halo(DMOparticles, hDMO)
+
+            elif type(AHF_centers_filepath) == type(None):
                 print("Halonum:",int(halonums[i])-1)
                 
                 # if the AHF centers are unavailable, the default HOP catalogue is used (which is zero indexed)
@@ -759,7 +896,7 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
             #uncomment to remove subhalos from tagging insitu 
             ####DMOparticles_insitu_only = DMOparticles_insitu_only[np.logical_not(np.isin(DMOparticles_insitu_only['iord'],subhalo_iords))]
             
-            particles_sorted_by_angmom = rank_order_particles_by_angmom( DMOparticles_insitu_only)
+            particles_sorted_by_angmom = rank_order_particles_by_angmom( DMOparticles_insitu_only, tagging_fraction=float(free_param_value))
             
             if particles_sorted_by_angmom.shape[0] == 0:
                 continue
@@ -768,57 +905,42 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
             
             print('writing insitu particles to output file')
             
-            tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write[0])
-            tagged_types_to_write = np.append(tagged_types_to_write,np.repeat(tag_typ,len(array_to_write[0])))
-            tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write[1])
-            ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write[0])))
-            zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write[0])))
-
-            row_to_write = pd.DataFrame({'iords':array_to_write[0], 'mstar':array_to_write[1],'t':np.repeat(t_all[i],len(array_to_write[0])),'z':np.repeat(red_all[i],len(array_to_write[0])) , 'type':np.repeat(tag_typ,len(array_to_write[0])) })
-            if particle_storage_filename != None:
-                row_to_write.to_csv(particle_storage_filename+"_"+str(output[i])+".csv")
-
-            df_tagged_particles =  pd.concat([df_tagged_particles,row_to_write],ignore_index=True)
+            df_tagged_particles.append(array_to_write[0],array_to_write[1],t_all[i],red_all[i],tag_typ)
             
             insitu_only_particle_ids = np.append(insitu_only_particle_ids,np.asarray(array_to_write[0]))
 
             del DMOparticles_insitu_only
             
             #get mergers ----------------------------------------------------------------------------------------------------------------
-            # check whether current the snapshot has a the redshift just before the merger occurs.
+            # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
         
-        if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-                
-            decision2 = False if decision==True else True
-
-            decl=False
-            
-            t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
+        if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
 
             #print('chosen merger particles ----------------------------------------------',len(chosen_merger_particles))
             #loop over the merging halos and collect particles from each of them
     
             DMO_particles = 0 
             
-            for hDM in hmerge_added[t_id][0]:
+            for merger in merger_index.at_output(outputs[i+1]):
                 gc.collect()
+                hDM = merger_index.halo(merger)
                 print('halo:',hDM)
                 
                 #if (occupation_frac != 'all'):
-                try:
-                    prob_occupied = calculate_poccupied(hDM,2.5e7)
+                prob_occupied = merger_index.p_occupied(merger,2.5e7,hDM)
                     
-                    #prob_occupied = 1
-                except Exception as e:
-                    print(e)
+                #prob_occupied = 1
+                if prob_occupied == None:
                     print("poccupied couldn't be calculated")
+                    acc_halo_path_tagged.skip(merger['path'],'no occupation probability')
                     continue
                     
                 if (np.random.random() > prob_occupied):
                     print('Skipped')
+                    acc_halo_path_tagged.skip(merger['path'],'unoccupied')
                     continue
                 try:
-                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = DarkLight(hDM,DMO=True,mergers=True,n=config.get("darklight","n"))
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,DMO=True,mergers=True,n=config.get("darklight","n"))
 
                     mstar_merging = mstar_merging[0]
 
@@ -828,35 +950,45 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                 except Exception as e :
                     print(e)
                     print('there are no darklight stars')
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
 
                 if len(mstar_merging) == 0:
                     print("Darklight unable to make predictions")
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
                 
                 if len(np.where(np.asarray(mstar_merging) > 0)[0]) == 0:
                     print("Darklight predicts no stars in this halo")
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
                                                                                                                                     
-                tidx = np.where(np.asarray(DMOsim.timesteps[:]) ==  hDMO.timestep)[0][0]
-                acc_halo_path = hDM.calculate_for_progenitors('path()')
-                halonumber_hDM = hDM.calculate_for_progenitors('halo_number()')[0][0]
+                # timestep index and main branch of the merging halo from the simulation index
+                tidx = simulation_index(DMOsim).timestep_index(outputs[i])
+                acc_halo_path = [simulation_index(DMOsim).branch(hDM)['path']]
+                halonumber_hDM = simulation_index(DMOsim).branch(hDM)['halo_number'][0]
                 print('halonum merging:',halonumber_hDM)
                 
 
                 if type(main_halo_paths) != type(None): 
                     
-                    if ( len(np.where(np.isin(main_halo_paths,acc_halo_path_tagged) == True)[0]) != 0):
+                    if acc_halo_path_tagged.any_tagged(main_halo_paths):
+                        acc_halo_path_tagged.skip(merger['path'],'host already tagged')
                         continue
 
                 # if halo has not been tagged on before, we want to perform tagging over its full lifetime (upto the current snap)
-                if ( len(np.where(np.isin(acc_halo_path,acc_halo_path_tagged) == True)[0]) == 0 ):
+                if subtrees != None and subtrees.is_tagged(acc_halo_path[0],acc_halo_path_tagged) == False:
+
+                    print('---subtree submitted -----')
+                    subtrees.submit(angmom_tag_over_full_sim_recursive,DMOsim,tidx,halonumber_hDM,acc_halo_path[0],acc_halo_path_tagged, free_param_value = float(free_param_value_acc),free_param_value_acc = float(free_param_value_acc),pynbody_path = pynbody_path,AHF_centers_filepath=AHF_centers_filepath)
+
+                elif subtrees == None and acc_halo_path_tagged.any_tagged(acc_halo_path[0]) == False:
                     
                     
                     print('---recursion triggered -----')
                     
 
-                    df_tagged_particles,acc_halo_path_tagged = angmom_tag_over_full_sim_recursive(DMOsim,tidx,halonumber_hDM, free_param_value = float(free_param_value_acc),free_param_value_acc = float(free_param_value_acc),pynbody_path = pynbody_path, df_tagged_particles=df_tagged_particles,tag_typ='accreted',AHF_centers_filepath=AHF_centers_filepath,acc_halo_path_tagged=acc_halo_path_tagged)
+                    df_tagged_particles,acc_halo_path_tagged = angmom_tag_over_full_sim_recursive(DMOsim,tidx,halonumber_hDM, free_param_value = float(free_param_value_acc),free_param_value_acc = float(free_param_value_acc),pynbody_path = pynbody_path, df_tagged_particles=df_tagged_particles,tag_typ='accreted',AHF_centers_filepath=AHF_centers_filepath,acc_halo_path_tagged=acc_halo_path_tagged,return_catalog=True,processes=1)
                     
                     
         
@@ -878,26 +1010,20 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                     
                     simfn = join(config.get_path("pynbody_path"),DMOname,outputs[i])
 
-                    if ((float(mass_select_merge) >0) and (decision2==True)):
-                        # try to load in the data from this snapshot
-                        
-                        if (type(AHF_centers_filepath) != type(None)):
-                            pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
+                    # try to load in the data from this snapshot
+                    
+                    if (type(AHF_centers_filepath) != type(None)):
+                        pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
 
-                        try:
-                            DMOparticles = pynbody.load(simfn)
-                            DMOparticles.physical_units()
-                            #DMOparticles = DMOparticles.d
-                            print('loaded data in mergers')
-                        
-                        # where this data isn't available, notify the user.
-                        except:
-                            print('--> DMO particle data exists but failed to read it, skipping!')
-                            continue
-                        
-                        decision2 = False
-                        decl=True
+                    try:
+                        DMOparticles = load_halo_snapshot(simfn, hDM) if type(AHF_centers_filepath) == type(None) else load_snapshot(simfn)
+                        #DMOparticles = DMOparticles.d
+                        print('loaded data in mergers')
                     
+                    # where this data isn't available, notify the user.
+                    except:
+                        print('--> DMO particle data exists but failed to read it, skipping!')
+                        continue
                     
                     
                     if int(mass_select_merge) > 0:
@@ -912,6 +1038,10 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                                 h_merge = DMOparticles.halos(halo_numbers="v1")[AHF_halonum_accreted]
 
 
+                            elif is_region_snapshot(DMOparticles):
+
+                                h_merge = region_halo(DMOparticles, hDM)
+
                             else: 
                                 
                                 h_merge =  DMOparticles.halos()[HOP_halonum_acc - 1]
@@ -933,7 +1063,7 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                         DMOparticles_acc_only = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn_acc] 
                                                     
                         try:
-                            accreted_particles_sorted_by_angmom = rank_order_particles_by_angmom(DMOparticles_acc_only.dm)
+                            accreted_particles_sorted_by_angmom = rank_order_particles_by_angmom(DMOparticles_acc_only.dm, tagging_fraction=float(free_param_value_acc))
                         except:
                             continue
                         
@@ -943,32 +1073,40 @@ def angmom_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_valu
                         array_to_write_accreted = assign_stars_to_particles(mass_select_merge,accreted_particles_sorted_by_angmom,float(free_param_value_acc))
                         
     
-                        tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write_accreted[0])
-                        tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('accreted',len(array_to_write_accreted[0])))
-                        tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write_accreted[1])
-                        ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write_accreted[0])))
-                        zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write_accreted[0])))
-    
-            
                         accreted_only_particle_ids = np.append(accreted_only_particle_ids,np.asarray(array_to_write_accreted[0]))
-                        row_to_write_acc = pd.DataFrame({'iords':array_to_write_accreted[0], 'mstar':array_to_write_accreted[1],'t':np.repeat(t_all[i],len(array_to_write_accreted[0])),'z':np.repeat(red_all[i],len(array_to_write_accreted[0])) , 'type':np.repeat('accreted',len(array_to_write_accreted[0])) })
                         
-                        df_tagged_particles = pd.concat([df_tagged_particles,row_to_write_acc],ignore_index=True)            
-                        if particle_storage_filename != None: 
-                            row_to_write_acc.to_csv(particle_storage_filename+"_"+str(output[i])+".csv",mode='a',header=False) 
+                        df_tagged_particles.append(array_to_write_accreted[0],array_to_write_accreted[1],t_all[i],red_all[i],'accreted')
                         print('writing accreted particles to output file')
               
                         del DMOparticles_acc_only
-                  
-                            
-        if decision==True or decl==True:
-            del DMOparticles
     
     
         print("Done with iteration",i)
-        
+
+        if writer != None:
+            writer.append_catalog(df_tagged_particles)
+
+        if checkpoint != None:
+            checkpoint.save(outputs[i], df_tagged_particles, acc_halo_path_tagged, subtrees = subtrees.submitted if subtrees != None else [])
+
+    if subtrees != None:
+        df_tagged_particles,acc_halo_path_tagged = subtrees.merge(df_tagged_particles,acc_halo_path_tagged)
+
+        # the particles of the subtrees, once they are all merged
+        if writer != None:
+            writer.append_catalog(df_tagged_particles)
+
+    if writer != None:
+        writer.close()
+
+    # the whole run is done (and any subtrees merged)
+    if checkpoint != None and len(outputs) > 0:
+        checkpoint.save(outputs[-1], df_tagged_particles, acc_halo_path_tagged, subtrees = [])
+
+    if top_level == True:
+        print('halos tagged over their full lifetimes:',len(acc_halo_path_tagged),'skipped:',dict(acc_halo_path_tagged.skip_counts()))
             
-    return df_tagged_particles,acc_halo_path_tagged
+    return (df_tagged_particles if return_catalog == True else df_tagged_particles.to_dataframe()),acc_halo_path_tagged
 
 
 
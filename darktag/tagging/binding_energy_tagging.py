@@ -15,7 +15,7 @@ import sys
 import numpy as np 
 import pandas as pd 
 
-from darklight import DarkLight
+from .darklight_cache import cached_darklight
 
 import tangos 
 
@@ -25,6 +25,17 @@ from numpy import sqrt
 import random
 import pynbody
 from .utils import *
+from .snapshot_cache import load_snapshot, load_halo_snapshot, is_region_snapshot, region_halo
+from .extract import load_extract
+from .tagged_storage import TaggedCatalog, FreeParamSweep, TaggedParticleWriter
+from .potential import calculate_potential, potential_rank_agreement
+from .potential_store import potential_filename, load_halo_potential
+from .parallel import worker_settings, SubtreePool, resume_subtrees
+from .checkpoint import TaggingCheckpoint
+from .simulation_index import simulation_index
+from .halo_registry import TaggedHaloRegistry
+from .structure import ReffSweep
+from .angular_momentum_tagging import load_insitu_particles
 from ...config import config
 
 
@@ -39,7 +50,7 @@ def plum_const(hDMO,z_val,insitu):
 '''
 
 
-def rank_order_particles_by_BE(particles, hDMO,path_to_pe_file = None):
+def rank_order_particles_by_BE(particles, hDMO,path_to_pe_file = None, tagging_fraction = None, potential_method = 'direct', opening_angle = 0.7, potential_error_sample = None):
     
     print("tagging with BE")
 
@@ -48,6 +59,15 @@ def rank_order_particles_by_BE(particles, hDMO,path_to_pe_file = None):
     Inputs: 
 
     particles - Particle data (binding energies and positions) 
+    path_to_pe_file - stored potentials of this halo (see potential_store.potential_filename), used instead of calculating them
+                      when they cover all the particles within r200
+    tagging_fraction - if given, only the int(N*tagging_fraction) most bound particles (the ones
+                       assign_stars_to_particles tags) are put in order, the rest of the IDs follow unordered
+    potential_method - potential engine, one of potential.potential_backends ('direct' pynbody.gravity.direct,
+                       'tree' for the Barnes-Hut octree or 'shell' for the quick spherical approximation)
+    opening_angle - opening angle of the 'tree' engine
+    potential_error_sample - if given, the potential and the ranking of the most bound particles it gives are
+                             checked against direct summation on this many particles
     
     Returns: 
     a list of particle IDs ordered by their binding energies (highest to lowest).
@@ -61,34 +81,46 @@ def rank_order_particles_by_BE(particles, hDMO,path_to_pe_file = None):
     #particles_r200['vel']-= particles_r200['vel'].mean(axis=0)
     #softening_length = pynbody.array.SimArray(np.ones(len(particles_r200))*10.0, units='pc',sim=None)
         
-    '''
-    # This part of the function is only to be uncommented if potentials are to be read in from a file (rather than being calculated directly)
+    calculated_potentials = None
 
-    # pe_file contains cols : iord, potential. A separate file is assumed to exist for each output. 
-    print('Reading in potential from ',path_to_pe_file)
-        
-    potentials_df = pd.read_csv(path_to_pe_file)
-        
-    calculated_potentials = potentials_df[ np.isin(potentials_df['iord'],particles_inside_r200['iord'])]
-    
-    calculated_potentials = calculated_potentials.set_index(['iord']).loc[particles_inside_r200['iord']]
-    calculated_potentials = calculated_potentials['potential'].values
+    # potentials stored by compute_halo_potentials are looked up by particle ID (binary search of the memory-mapped store)
+    if path_to_pe_file != None:
+
+        print('Reading in potential from ',path_to_pe_file)
+
+        try:
+            calculated_potentials = load_halo_potential(path_to_pe_file).lookup(particles_r200['iord'])
+        except FileNotFoundError:
+            print('calculated potentials not found at path',path_to_pe_file)
+
+        if calculated_potentials is None:
+            print('stored potentials do not cover the particles within r200, calculating them')
 
-    pe = pynbody.array.SimArray(calculated_potentials,units='G Msol kpc**-1',sim=None)
-    
-    '''
     #particles_2r200 = particles[particles["r"] < 2*hDMO["r200c"]]
-    softening_length = pynbody.array.SimArray(np.ones(len(particles_r200))*10.0, units='pc',sim=None)
-    
-    calculated_potentials, calculated_force = pynbody.gravity.direct(particles_r200,np.asarray(particles_r200['pos']),eps=softening_length)
+    if calculated_potentials is None:
+        # 10 pc softening length
+        backend_kwargs = {'opening_angle':opening_angle} if potential_method == 'tree' else {}
+
+        calculated_potentials = calculate_potential(particles_r200, method=potential_method, eps=0.01, error_sample=potential_error_sample, **backend_kwargs)
 
     kinetic_energies = particles_r200['ke']
 
     # the in_units conversion here ensures that the potential and kinetic energies are in the same units 
     total_energy = np.asarray(calculated_potentials.in_units(kinetic_energies.units)) + np.asarray(kinetic_energies)
 
-    # value indicies sorted in ascending order (because we have negative energies, from most to least bound)
-    sorted_indicies = np.argsort(total_energy.flatten())
+    if potential_error_sample != None and potential_method != 'direct':
+
+        agreement = potential_rank_agreement(np.asarray(particles_r200['pos'].in_units('kpc')), np.asarray(particles_r200['mass'].in_units('Msol')),
+                                             np.asarray(kinetic_energies.in_units('km**2 s**-2')), calculated_potentials.in_units('km**2 s**-2'),
+                                             tagging_fraction=0.01 if tagging_fraction == None else tagging_fraction, n_sample=potential_error_sample)
+
+        print('BE ranking ('+potential_method+') against direct summation over', agreement['n_sample'], 'particles: Spearman',
+              agreement['spearman'], ', most bound particles selected by both', agreement['top_overlap'])
+
+    n_select = len(total_energy) if tagging_fraction == None else int(len(total_energy)*tagging_fraction)
+
+    # value indicies sorted in ascending order (because we have negative energies, from most to least bound), up to n_select
+    sorted_indicies = partial_argsort(total_energy, n_select)
 
     particles_ordered_by_BE = np.asarray(particles_r200['iord'])[sorted_indicies] if sorted_indicies.shape[0] != 0 else np.array([]) 
    
@@ -174,7 +206,7 @@ def tag(DMOparticles, hDMO, snapshot_stellar_mass,free_param_value = 0.01):
     
 
 # under construction
-def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=None,pynbody_path  = None, occupation_frac = 'edge1' ,particle_storage_filename=None, AHF_centers_file=None, mergers = True):
+def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=None,pynbody_path  = None, occupation_frac = 'edge1' ,particle_storage_filename=None, AHF_centers_file=None, mergers = True, extract_dir = None, potential_method = 'direct', opening_angle = 0.7, checkpoint_dir = None, compute_reffs = False):
 
     '''
 
@@ -184,13 +216,24 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
 
     DMOsim - tangos simulation 
     free_param_value - specifies the size of the 'tagging fraction' when tagging dm particles with stellar mass (bigger values correspond to a larger spread of angmom.)
+                       A list of values tags all of them in one pass over the simulation (see tagged_storage.FreeParamSweep)
     pynbody_path - path to particle data 
     occupation_frac - One of 'nadler20' , 'all' , 'edge1' or 'edgert' (controls the occupation regime followed by darklight)
     mergers - Whether to include merging/accreting halos or not. 
+    extract_dir - if given, particles are read from the halo extracts written by extract_halo_regions instead of the snapshots
+    PE_file - directory of potentials stored by potential_store.compute_halo_potentials, looked up instead of recalculated
+    potential_method, opening_angle - potential engine used to rank the particles (see rank_order_particles_by_BE)
+    checkpoint_dir - if given, the run is checkpointed there after every snapshot (see checkpoint.TaggingCheckpoint) and
+                     resumed from the checkpoint if there is one, after the last snapshot it had done
+    compute_reffs - if True, the projected half-mass, half-light and Kravtsov radii of the stars tagged so far are measured
+                    after each snapshot's tagging, on the particles of the main halo already in memory (see structure.ReffTable),
+                    and written next to particle_storage_filename (see structure.reffs_filename)
     
     Returns: 
     
-    dataframe with tagged particle masses at given times, redshifts and associated particle IDs  
+    dataframe with tagged particle masses at given times, redshifts and associated particle IDs 
+    (a dictionary of them keyed by value when free_param_value is a list), and with compute_reffs the dataframe
+    (or dictionary) of reffs
     
     '''
     
@@ -208,32 +251,20 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
 
     main_halo = DMOsim.timesteps[-1].halos[int(halonumber)]
 
-    halonums = main_halo.calculate_for_progenitors('halo_number()')[0][::-1]
-
-    t_all = main_halo.calculate_for_progenitors('t()')[0][::-1]
-    red_all = main_halo.calculate_for_progenitors('z()')[0][::-1]
-
-    outputs_all = np.array([DMOsim.timesteps[i].__dict__['extension'] for i in range(len(DMOsim.timesteps))])
-    times_tangos = np.array([ DMOsim.timesteps[i].__dict__['time_gyr'] for i in range(len(DMOsim.timesteps)) ])
-
-    outputs = outputs_all[np.isin(times_tangos, t_all)]
+    # halonums, time and redshift of each snapshot and the names of simulation output files (from the simulation index)
+    t_all, red_all, halonums, outputs = simulation_index(DMOsim).indexing_data(main_halo)
     
     
     # Get stellar masses at each redshift using darklight for insitu tagging (mergers = False excludes accreted mass)
-    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total =DarkLight(main_halo,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total =cached_darklight(main_halo,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
     
-    #calculate when the mergers took place and grab all the tangos halo objects involved in the merger (zmerge = merger redshift, hmerge = merging halo objects,qmerge = merger ratio)
-    zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+    # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+    # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
+    merger_index = simulation_index(DMOsim).merger_index(main_halo)
     
     if ( len(red_all) != len(outputs) ) : 
 
         print('output array length does not match redshift and time arrays')
-    
-    # group_mergers groups all merging objects by redshift.
-    # this array gets stored in hmerge_added in the form => len = no. of unique zmerges, 
-    # elements = all the hmerges of halos merging at each zmerge
-    
-    hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
 
     ##################################################### SECOND LOOP ###############################################################
         
@@ -249,37 +280,47 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
     # if an AHF centering file is provided use the centers stroed within it
     AHF_centers = pd.read_csv(str(AHF_centers_file)) if AHF_centers_file != None else None
 
-    tagged_iords_to_write = np.array([])
-    tagged_types_to_write = np.array([])
-    tagged_mstars_to_write = np.array([])
-    ts_to_write = np.array([])
-    zs_to_write = np.array([])
+    # all tagged particles (iords, mstars, times, redshifts and types) of each free parameter value,
+    # appended to particle_storage_filename snapshot by snapshot if it is given
+    tagged_particles = FreeParamSweep(free_param_value, particle_storage_filename)
+
+    checkpoint = TaggingCheckpoint(checkpoint_dir, run={'simulation':DMOname, 'halonumber':int(halonumber), 'method':'binding energy', 'free_param_value':tagged_particles.values}) if checkpoint_dir != None else None
+
+    # first snapshot to tag (after the last one done by a previous run)
+    i_start = 0
+
+    if checkpoint != None and checkpoint.exists():
+
+        resumed = checkpoint.load()
+
+        tagged_particles.restore(resumed['catalogs'])
+
+        i_start = checkpoint.resume_index(outputs, resumed['output'])
+
+        print('resuming from the checkpoint after',resumed['output'],':',len(outputs)-i_start,'snapshots left')
+
+    # reffs of the stars tagged so far, measured after each snapshot and written next to the tagged particles
+    reffs = ReffSweep(tagged_particles) if compute_reffs == True else None
+
+    if reffs != None:
+
+        # r200c of the main halo at each snapshot (for the Kravtsov radius), in the order of t_all
+        r200c_all = simulation_index(DMOsim).branch(main_halo)['r200c'][::-1]
+
+        reffs.restore(t_all[i_start-1] if i_start > 0 else -np.inf)
 
-    PE_dir_contents = np.asarray(os.listdir(PE_file)) if type(PE_file) != type(None) else []
     # looping over all snapshots  
-    for i in range(len(outputs)):
+    for i in range(i_start, len(outputs)):
 
         gc.collect()
         
-        # was particle data loaded in (insitu) 
-        decision=False
-
-        # was particle data loaded in (accreted) 
-        decision2=False
-        decl = False
-        
-        check_pe_file_exists = False
         print('Current snapshot -->',outputs[i])
-        
 
-        '''
-        if len(PE_dir_contents)>0:
-            path_to_pe_file = os.path.join(PE_file,str(outputs[i]+'.csv'))
-            check_pe_file_exists = np.isin(str(outputs[i]+'.csv'),PE_dir_contents)
-            #print(check_pe_file_exists,PE_dir_contents)
-            if check_pe_file_exists == False:    
-                print('calculated potentials not found at path',path_to_pe_file)
-        ''' 
+        # particles of the main halo, kept for the reffs when they are loaded for the in situ tagging
+        insitu_particles = None
+        
+        # potentials of the main halo stored by compute_halo_potentials
+        path_to_pe_file = potential_filename(PE_file,outputs[i],halonums[i]) if PE_file != None else None
          
         # loading in the main halo object at this snapshot from tangos 
         hDMO = tangos.get_halo(DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]))
@@ -321,9 +362,17 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
 
         # if stellar mass is to be tagged then load in particle data 
     
-        if mass_select>0:
-            
-            decision=True
+        if mass_select>0 and extract_dir != None:
+
+            # the extract is already centred on the halo
+            try:
+                DMOparticles = load_extract(extract_dir,outputs[i],halonums[i])
+            except Exception as e:
+                print(e)
+                print('--> halo extract unavailable, skipping!')
+                continue
+
+        elif mass_select>0:
             
             # try to load in the data from this snapshot
             
@@ -333,10 +382,8 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                 print(simfn)
                 print('loading in DMO particles')
                 
-                DMOparticles = pynbody.load(simfn)
-                # once the data from the snapshot has been loaded, .physical_units()
-                # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                DMOparticles.physical_units()
+                # shared with the merger branch below (and any other tagging run) through the snapshot cache
+                DMOparticles = load_halo_snapshot(simfn, hDMO)
                 
                 #print('total energy  ---------------------------------------------------->',DMOparticles['te'])
                 print('loaded data insitu')
@@ -354,7 +401,6 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                 hDMO['r200c']
             except:
                 print("Couldn't load in the R200 at timestep:" , i)
-                del DMOparticles 
                 continue
             
             print('the time is:',t_all[i])
@@ -364,7 +410,8 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
             #if AHF_centers_file == None:
              #   print(int(halonums[i])-1)
             
-            h = DMOparticles.halos()[int(halonums[i])-1]
+            # halo catalogues index the full box, so on region snapshots the halo is cut out around the tangos centre
+            h = region_halo(DMOparticles, hDMO) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(halonums[i])-1]
             
             '''
             elif AHF_centers_file != None:
@@ -401,34 +448,23 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                                                                                                                                                                             
                         
             DMOparticles_insitu_only = DMOparticles.dm[sqrt(DMOparticles.dm['pos'][:,0]**2 + DMOparticles.dm['pos'][:,1]**2 + DMOparticles.dm['pos'][:,2]**2) <= r200c_pyn ] 
-            
-            #DMOparticles_insitu_only = DMOparticles_insitu_only[np.logical_not(np.isin(DMOparticles_insitu_only['iord'],subhalo_iords))]
 
-            '''
-            if check_pe_file_exists == True: 
-                particles_sorted_by_BE = rank_order_particles_by_BE( DMOparticles_insitu_only, hDMO,path_to_pe_file=path_to_pe_file)
+            insitu_particles = DMOparticles_insitu_only if reffs != None else None
             
-            else: 
-            '''
+            #DMOparticles_insitu_only = DMOparticles_insitu_only[np.logical_not(np.isin(DMOparticles_insitu_only['iord'],subhalo_iords))]
 
+        if mass_select>0:
 
-            particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles,hDMO)
+            particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles,hDMO,path_to_pe_file=path_to_pe_file, tagging_fraction=tagged_particles.max_value, potential_method=potential_method, opening_angle=opening_angle)
 
             if particles_sorted_by_BE.shape[0] == 0:
                 print("NO PARTICLES IN THE SORTED BY BE ARRAY")
                 continue
             
-            array_to_write = assign_stars_to_particles(mass_select,particles_sorted_by_BE,float(free_param_value))
+            array_to_write = tagged_particles.tag(assign_stars_to_particles,mass_select,particles_sorted_by_BE,t_all[i],red_all[i],'insitu')
 
             print('writing insitu particles to output file')
             
-            tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write[0])
-            tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('insitu',len(array_to_write[0])))
-            tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write[1])
-            ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write[0])))
-            zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write[0])))
-
-            
             insitu_only_particle_ids = np.append(insitu_only_particle_ids,np.asarray(array_to_write[0]))
             
             #pynbody.analysis.halo.center(h,mode='hyb').revert()
@@ -437,28 +473,21 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
             
             #print('moving onto mergers loop')
             #get mergers ----------------------------------------------------------------------------------------------------------------
-            # check whether current the snapshot has a the redshift just before the merger occurs.
+            # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
         
-        if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-                
-            decision2 = False if decision==True else True
-
-            decl=False
-            
-            t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
+        if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
 
             DMO_particles = 0 
             
-            for hDM in hmerge_added[t_id][0]:
+            for merger in merger_index.at_output(outputs[i+1]):
                 gc.collect()
+                hDM = merger_index.halo(merger)
                 print('halo:',hDM)
                 
                 if (occupation_frac != 'all'):
-                    try:
-                        prob_occupied = calculate_poccupied(hDM,2.5e7)
+                    prob_occupied = merger_index.p_occupied(merger,2.5e7,hDM)
 
-                    except Exception as e:
-                        print(e)
+                    if prob_occupied == None:
                         print("poccupied couldn't be calculated")
                         continue
                     
@@ -467,7 +496,7 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                         continue
                 
                 try:
-                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = DarkLight(hDM,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
                     #DarkLight(hDM,DMO=True)#,poccupied=occupation_frac,mergers=True)
                     print(len(t_2))
                     print(mstar_merging)
@@ -493,24 +522,25 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                 
                 simfn = join(pynbody_path, outputs[i])
 
-                if float(mass_select_merge) >0 and decision2==True:
-                    # try to load in the data from this snapshot
-                    try:
-                        DMOparticles = pynbody.load(simfn)
-                        DMOparticles.physical_units()
-                        print('loaded data in mergers')
-                    # where this data isn't available, notify the user.
-                    except:
-                        print('--> DMO particle data exists but failed to read it, skipping!')
-                        continue
-                    decision2 = False
-                    decl=True
+                # try to load in the data from this snapshot (a cache hit if the insitu step already loaded it)
+                try:
+                    DMOparticles = load_extract(extract_dir,outputs[i],hDM.calculate('halo_number()')) if extract_dir != None else load_halo_snapshot(simfn, hDM)
+                    print('loaded data in mergers')
+                # where this data isn't available, notify the user.
+                except:
+                    print('--> DMO particle data exists but failed to read it, skipping!')
+                    continue
              
-                if int(mass_select_merge) > 0:
+                if int(mass_select_merge) > 0 and extract_dir != None:
+
+                    # the extract is already centred on the merging halo
+                    DMOparticles_acc_only = DMOparticles.within(hDM['r200c'])
+
+                elif int(mass_select_merge) > 0:
 
                     try:
                     
-                        h_merge = DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
+                        h_merge = region_halo(DMOparticles, hDM) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
                         print('loaded in merging halo')
 
                         pynbody.analysis.halo.center(h_merge.dm)
@@ -533,9 +563,13 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
                     DMOparticles_acc_only = DMOparticles.dm[sqrt(DMOparticles.dm['pos'][:,0]**2 + DMOparticles.dm['pos'][:,1]**2 + DMOparticles.dm['pos'][:,2]**2) <= r200c_pyn_acc] 
 
                     #DMOparticles_acc_only = DMOparticles[np.logical_not(np.isin(DMOparticles['iord'],insitu_only_particle_ids))]
+
+                if int(mass_select_merge) > 0:
                                             
                     try:
-                        accreted_particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles,hDM)
+                        path_to_pe_file_acc = potential_filename(PE_file,outputs[i],hDM.calculate('halo_number()')) if PE_file != None else None
+
+                        accreted_particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles,hDM,path_to_pe_file=path_to_pe_file_acc, tagging_fraction=tagged_particles.max_value, potential_method=potential_method, opening_angle=opening_angle)
                     except Exception as esort:
                         print(esort)
                         continue
@@ -543,39 +577,46 @@ def BE_tag_over_full_sim(DMOsim,halonumber ,free_param_value = 0.01, PE_file=Non
         
                     print('assinging stars to accreted particles')
 
-                    array_to_write_accreted = assign_stars_to_particles(mass_select_merge,accreted_particles_sorted_by_BE,float(free_param_value))
-                    
-
-                    tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write_accreted[0])
-                    tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('accreted',len(array_to_write_accreted[0])))
-                    tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write_accreted[1])
-                    ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write_accreted[0])))
-                    zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write_accreted[0])))
-
+                    array_to_write_accreted = tagged_particles.tag(assign_stars_to_particles,mass_select_merge,accreted_particles_sorted_by_BE,t_all[i],red_all[i],'accreted')
         
                     accreted_only_particle_ids = np.append(accreted_only_particle_ids,np.asarray(array_to_write_accreted[0]))
                     print('writing accreted particles to output file')
           
                     del DMOparticles_acc_only
-        
-                  
-                            
-        if decision==True or decl==True:
-            del DMOparticles
     
+        if reffs != None:
+
+            # the reffs are measured about the centre of the tagged stars, so the particles loaded for the in situ
+            # tagging can still be used after centring on the merging halos
+            if type(insitu_particles) == type(None):
+                insitu_particles = load_insitu_particles(join(pynbody_path,outputs[i]), DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]), halonums[i], outputs[i], extract_dir)
+
+            reffs.measure(insitu_particles, t_all[i], red_all[i], r200c_all[i])
+
+            del insitu_particles
     
         print("Done with iteration",i)
 
-        df_tagged_particles = pd.DataFrame({'iords':tagged_iords_to_write, 'mstar':tagged_mstars_to_write,'t':ts_to_write,'z':zs_to_write,'type':tagged_types_to_write})
+        if checkpoint != None:
+            checkpoint.save(outputs[i], tagged_particles.named_catalogs())
+
+            if reffs != None:
+                reffs.write()
+
+    if checkpoint != None and len(outputs) > 0:
+        checkpoint.save(outputs[-1], tagged_particles.named_catalogs())
 
-        if particle_storage_filename != None:
-            df_tagged_particles.to_csv(particle_storage_filename)
+    tagged_particles.close()
+
+    if reffs != None:
+        reffs.write()
+        return tagged_particles.to_dataframes(), reffs.to_dataframes()
             
-    return df_tagged_particles
+    return tagged_particles.to_dataframes()
 
 
 
-def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value = 0.01, PE_file=None, pynbody_path  = None, particle_storage_filename=None, AHF_centers_filepath=None, mergers = True,main_halo_paths=None,acc_halo_path_tagged=None,df_tagged_particles=None,tag_typ='insitu'):
+def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value = 0.01, PE_file=None, pynbody_path  = None, particle_storage_filename=None, AHF_centers_filepath=None, mergers = True,main_halo_paths=None,acc_halo_path_tagged=None,df_tagged_particles=None,tag_typ='insitu',return_catalog=False, potential_method = 'direct', opening_angle = 0.7, processes = None, memory_per_worker_gb = None, checkpoint_dir = None):
 
     '''
 
@@ -589,10 +630,24 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
     pynbody_path - path to particle data 
     occupation_frac - One of 'nadler20' , 'all' , 'edge1' or 'edgert' (controls the occupation regime followed by darklight)
     mergers - Whether to include merging/accreting halos or not. 
+    df_tagged_particles - particles tagged so far (TaggedCatalog or dataframe), new particles are appended to it
+    particle_storage_filename - if given (top level call only), the tagged particles are written here as they are tagged, the new rows
+                                appended after every snapshot (a columnar store, or CSV if the name ends in .csv, see tagged_storage)
+    return_catalog - return the TaggedCatalog itself rather than a dataframe (used by the recursive calls)
+    PE_file - directory of potentials stored by potential_store.compute_halo_potentials, looked up instead of recalculated
+    potential_method, opening_angle - potential engine used to rank the particles (see rank_order_particles_by_BE)
+    processes - number of worker processes the accreted halos are tagged over (defaults to the "parallel" section of config.json).
+                With more than one, each accreted halo not tagged yet is tagged over its full lifetime as a separate task
+                (see parallel.SubtreePool) and the results are appended after the halo's own particles.
+    memory_per_worker_gb - memory cap of each worker process in GB (0 for none, defaults to config)
+    checkpoint_dir - if given (top level call only), the run is checkpointed there after every snapshot (see checkpoint.TaggingCheckpoint)
+                     and resumed from the checkpoint if there is one, after the last snapshot it had done
+    acc_halo_path_tagged - TaggedHaloRegistry of the halos tagged and skipped so far, shared down the merger tree (recursive calls)
     
     Returns: 
     
-    dataframe with tagged particle masses at given times, redshifts and associated particle IDs  
+    dataframe (or TaggedCatalog) with tagged particle masses at given times, redshifts and associated particle IDs,
+    and the TaggedHaloRegistry of the halos tagged over their full lifetimes and of the merging halos skipped (with the reason)
     
     '''
 
@@ -614,36 +669,21 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
     # load-in tangos data 
     main_halo = DMOsim.timesteps[tstep].halos[int(halonumber) - 1]
 
-    # halonums for all snapshots 
-    halonums = main_halo.calculate_for_progenitors('halo_number()')[0][::-1]
-
-    # time and redshift of each snapshot 
-    t_all = main_halo.calculate_for_progenitors('t()')[0][::-1]
-    red_all = main_halo.calculate_for_progenitors('z()')[0][::-1]
-
-    outputs_all = np.array([DMOsim.timesteps[i].__dict__['extension'] for i in range(len(DMOsim.timesteps))])
-    times_tangos = np.array([ DMOsim.timesteps[i].__dict__['time_gyr'] for i in range(len(DMOsim.timesteps)) ])
-
-    # names of simulation output files 
-    outputs = outputs_all[np.isin(times_tangos, t_all)]
-
-    outputs.sort()
+    # halonums, time and redshift of each snapshot and the names of simulation output files (from the simulation index)
+    t_all, red_all, halonums, outputs = simulation_index(DMOsim).indexing_data(main_halo)
                                     
     # Get stellar masses at each redshift using darklight for insitu tagging (mergers = False excludes accreted mass)
-    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = DarkLight(main_halo,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = cached_darklight(main_halo,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=False,DMO=True,occupation=2.5e7,fn_vmax=None)
 
 
-    #calculate when the mergers took place and grab all the tangos halo objects involved in the merger (zmerge = merger redshift, hmerge = merging halo objects,qmerge = merger ratio)
-    zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+    # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+    # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
+    merger_index = simulation_index(DMOsim).merger_index(main_halo)
 
     # check time and output array have same size 
     if ( len(red_all) != len(outputs) ) : 
         print('output array length does not match redshift and time arrays')
     
-    # group_mergers groups all merging halo objects by redshift.
-    
-    hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
-    
     # number of stars left over after selection (per iteration)
     leftover=0
 
@@ -660,41 +700,68 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
     #if (tag_typ != "insitu"):
     #    AHF_centers = AHF_centers_acc
 
-    tagged_iords_to_write = np.array([])
-    tagged_types_to_write = np.array([])
-    tagged_mstars_to_write = np.array([])
-    ts_to_write = np.array([])
-    zs_to_write = np.array([])
+    # one catalog is passed down the merger tree and appended to in place
+    if  type(df_tagged_particles) == type(None):    
+        df_tagged_particles = TaggedCatalog()
+
+    elif isinstance(df_tagged_particles, pd.DataFrame):
+        df_tagged_particles = TaggedCatalog.from_dataframe(df_tagged_particles)
     
-    acc_halo_path_tagged = np.array([]) if (type(acc_halo_path_tagged) == type(None)) else acc_halo_path_tagged
+    # record of tagged (and skipped) objects, shared down the merger tree
+    acc_halo_path_tagged = TaggedHaloRegistry.from_paths(acc_halo_path_tagged)
 
+    # the top level call starts from an empty registry
+    top_level = len(acc_halo_path_tagged) == 0
 
     if len(acc_halo_path_tagged) > 0:
 
-        halo_path = main_halo.calculate_for_progenitors('path()')
+        halo_path = [simulation_index(DMOsim).branch(main_halo)['path']]
         print("halopath:",halo_path)
-        main_halo_paths = np.array([])
-        main_halo_paths = np.append(main_halo_paths,halo_path[0][0])
+        main_halo_paths = [halo_path[0][0]]
 
-        if ( len(np.where(np.isin(main_halo_paths,acc_halo_path_tagged) == True)[0]) > 0):
+        if acc_halo_path_tagged.any_tagged(main_halo_paths):
             
-            print("overlap at : ",main_halo_paths[np.where(np.isin(main_halo_paths,acc_halo_path_tagged) == True)])
+            print("overlap at : ",main_halo_paths[0])
             print("for halo : ",acc_halo_path_tagged )
-            return df_tagged_particles,acc_halo_path_tagged
+            acc_halo_path_tagged.skip(main_halo_paths[0],'already tagged')
+            return (df_tagged_particles if return_catalog == True else df_tagged_particles.to_dataframe()),acc_halo_path_tagged
 
     
-    halo_path = main_halo.calculate_for_progenitors('path()')
-    acc_halo_path_tagged = np.append(acc_halo_path_tagged,halo_path[0][0])
+    halo_path = [simulation_index(DMOsim).branch(main_halo)['path']]
+    acc_halo_path_tagged.add(halo_path[0][0])
 
+    processes, memory_per_worker_gb = worker_settings(processes, memory_per_worker_gb)
 
+    # in parallel mode the accreted halos are handed to worker processes rather than recursed into
+    subtrees = SubtreePool(processes, memory_per_worker_gb) if processes > 1 else None
 
-    if  type(df_tagged_particles) == type(None):    
-        df_tagged_particles = pd.DataFrame({'iords':tagged_iords_to_write, 'mstar':tagged_mstars_to_write,'t':ts_to_write,'z':zs_to_write,'type':tagged_types_to_write})
+    checkpoint = TaggingCheckpoint(checkpoint_dir, run={'simulation':DMOname, 'halonumber':int(halonumber), 'method':'binding energy recursive', 'free_param_value':float(free_param_value)}) if checkpoint_dir != None else None
 
+    # first snapshot to tag (after the last one done by a previous run)
+    i_start = 0
+
+    if checkpoint != None and checkpoint.exists():
+
+        resumed = checkpoint.load()
+
+        df_tagged_particles = resumed['catalogs']['catalog']
+        acc_halo_path_tagged = resumed['acc_halo_path_tagged']
+
+        i_start = checkpoint.resume_index(outputs, resumed['output'])
+
+        print('resuming from the checkpoint after',resumed['output'],':',len(outputs)-i_start,'snapshots left')
+
+        # accreted halos that were still being tagged by worker processes
+        df_tagged_particles,acc_halo_path_tagged = resume_subtrees(subtrees,BE_tag_over_full_sim_recursive,DMOsim,resumed['state']['subtrees'],df_tagged_particles,acc_halo_path_tagged)
+
+    # the particles tagged so far are written once, then each snapshot's new rows are appended to the same store
+    writer = TaggedParticleWriter(particle_storage_filename) if particle_storage_filename != None else None
+
+    if writer != None:
+        writer.append_catalog(df_tagged_particles)
 
-    
     # looping over all snapshots  
-    for i in range(len(outputs)):
+    for i in range(i_start, len(outputs)):
 
         gc.collect()
         
@@ -702,13 +769,6 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
         if len(t) == 0:
             print("No darklight predictions")
             continue
-
-        # was particle data loaded in (insitu) 
-        decision=False
-        
-        # was particle data loaded in (accreted) 
-        decision2=False
-        decl = False
     
         print('Current snapshot -->',outputs[i])
     
@@ -754,8 +814,6 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
     
         if mass_select>0:
             
-            decision=True
-            
             # try to load in the data from this snapshot
             
             try:
@@ -764,11 +822,9 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                 print(simfn)
                 print('loading in DMO particles')
                 
-                DMOparticles = pynbody.load(simfn)
-
-                # once the data from the snapshot has been loaded, .physical_units()
-                # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                DMOparticles.physical_units()
+                # outputs already read for the parent (or a sibling) halo come straight from the snapshot cache
+                # (region loading relies on tangos centres, so it is only used without AHF catalogues)
+                DMOparticles = load_halo_snapshot(simfn, hDMO) if AHF_centers_filepath == None else load_snapshot(simfn)
                 
                 print('loaded data insitu')
             
@@ -791,7 +847,11 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
         
             subhalo_iords = np.array([])
             
-            if AHF_centers_filepath == None:
+            if is_region_snapshot(DMOparticles):
+                # halo catalogues index the full box, so the halo is cut out around the tangos centre instead
+                h = region_halo(DMOparticles, hDMO)
+
+            elif AHF_centers_filepath == None:
                 
                 h = DMOparticles.halos()[int(halonums[i])-1]
 
@@ -841,97 +901,91 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                 r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')                                                                                            
             except:
                 print('could not calculate R200c')
-                del DMOparticles
-            
                 continue                                                                                                                                                                                      
             
             
             DMOparticles_insitu_only = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn ] 
             
-            particles_sorted_by_BE = rank_order_particles_by_BE( DMOparticles_insitu_only,hDMO)
+            path_to_pe_file = potential_filename(PE_file,outputs[i],halonums[i]) if PE_file != None else None
+
+            particles_sorted_by_BE = rank_order_particles_by_BE( DMOparticles_insitu_only,hDMO,path_to_pe_file=path_to_pe_file, tagging_fraction=float(free_param_value), potential_method=potential_method, opening_angle=opening_angle)
             
             if particles_sorted_by_BE.shape[0] == 0:
                 print("No sorted particles")
                 del DMOparticles_insitu_only 
-                del DMOparticles
                 continue
             
             array_to_write = assign_stars_to_particles(mass_select,particles_sorted_by_BE,float(free_param_value))
             
             print('writing '+str(tag_typ)+' particles to dataframe')
             
-            tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write[0])
-            tagged_types_to_write = np.append(tagged_types_to_write,np.repeat(tag_typ,len(array_to_write[0])))
-            tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write[1])
-            ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write[0])))
-            zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write[0])))
-
-            row_to_write = pd.DataFrame({'iords':array_to_write[0], 'mstar':array_to_write[1],'t':np.repeat(t_all[i],len(array_to_write[0])),'z':np.repeat(red_all[i],len(array_to_write[0])) , 'type':np.repeat(tag_typ,len(array_to_write[0]))})
-
-            df_tagged_particles =  pd.concat([df_tagged_particles,row_to_write],ignore_index=True)
+            df_tagged_particles.append(array_to_write[0],array_to_write[1],t_all[i],red_all[i],tag_typ)
             
             insitu_only_particle_ids = np.append(insitu_only_particle_ids,np.asarray(array_to_write[0]))
 
             del DMOparticles_insitu_only
             
             #get mergers ----------------------------------------------------------------------------------------------------------------
-            # check whether current the snapshot has a the redshift just before the merger occurs.
+            # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
         
-        if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-                
-            decision2 = False if decision==True else True
-
-            decl=False
-            
-            t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
+        if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
 
             #print('chosen merger particles ----------------------------------------------',len(chosen_merger_particles))
             #loop over the merging halos and collect particles from each of them
     
             DMO_particles = 0 
             
-            for hDM in hmerge_added[t_id][0]:
+            for merger in merger_index.at_output(outputs[i+1]):
                 gc.collect()
+                hDM = merger_index.halo(merger)
                 print('halo:',hDM)
                 
-                try:
-                    prob_occupied = calculate_poccupied(hDM,2.5e7)
+                prob_occupied = merger_index.p_occupied(merger,2.5e7,hDM)
 
-                except Exception as e:
-                    print(e)
+                if prob_occupied == None:
                     print("poccupied couldn't be calculated")
+                    acc_halo_path_tagged.skip(merger['path'],'no occupation probability')
                     continue
                     
                 if (np.random.random() > prob_occupied):
                     print('Skipped')
+                    acc_halo_path_tagged.skip(merger['path'],'unoccupied')
                     continue
                 try:
-                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = DarkLight(hDM,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=True,DMO=True,occupation=2.5e7,fn_vmax=None)
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,nscatter=0,vthres=26.3,zre=4.,pre_method='fiducial',post_method='schechter',post_scatter_method='increasing',binning='3bins',timesteps='sim',mergers=True,DMO=True,occupation=2.5e7,fn_vmax=None)
                     
                     
                 except Exception as e :
                     print(e)
                     print('there are no darklight stars')
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
 
                 if len(mstar_merging) == 0:
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
                 
                 if len(np.where(np.asarray(mstar_merging) > 0)[0]) == 0:
+                    acc_halo_path_tagged.skip(merger['path'],'no stars')
                     continue
                                                                                                                                     
-                tidx = np.where(np.asarray(DMOsim.timesteps[:]) ==  hDMO.timestep)[0][0]
-                acc_halo_path = hDM.calculate_for_progenitors('path()')
-                halonumber_hDM = hDM.calculate_for_progenitors('halo_number()')[0][0]
+                # timestep index and main branch of the merging halo from the simulation index
+                tidx = simulation_index(DMOsim).timestep_index(outputs[i])
+                acc_halo_path = [simulation_index(DMOsim).branch(hDM)['path']]
+                halonumber_hDM = simulation_index(DMOsim).branch(hDM)['halo_number'][0]
 
                 print('halonum merging:',halonumber_hDM)
                 
                 # if halo has not been tagged on before, we want to perform tagging over its full lifetime (upto the current snap)
-                if ( len(np.where(np.isin(acc_halo_path,acc_halo_path_tagged) == True)[0]) == 0 ):
-                    #acc_halo_path_tagged = np.append(acc_halo_path_tagged,acc_halo_path[0][0])
+                if subtrees != None and subtrees.is_tagged(acc_halo_path[0],acc_halo_path_tagged) == False:
+
+                    print('---subtree submitted -----')
+                    subtrees.submit(BE_tag_over_full_sim_recursive,DMOsim,tidx,halonumber_hDM,acc_halo_path[0],acc_halo_path_tagged, free_param_value = float(free_param_value),PE_file=PE_file,pynbody_path = pynbody_path,AHF_centers_filepath=AHF_centers_filepath,potential_method=potential_method,opening_angle=opening_angle)
+
+                elif subtrees == None and acc_halo_path_tagged.any_tagged(acc_halo_path[0]) == False:
 
                     print('---recursion triggered -----')
-                    df_tagged_particles,acc_halo_path_tagged = BE_tag_over_full_sim_recursive(DMOsim,tidx,halonumber_hDM, free_param_value = float(free_param_value),pynbody_path = pynbody_path, df_tagged_particles=df_tagged_particles,AHF_centers_filepath=AHF_centers_filepath,acc_halo_path_tagged = acc_halo_path_tagged,tag_typ='accreted')
+                    df_tagged_particles,acc_halo_path_tagged = BE_tag_over_full_sim_recursive(DMOsim,tidx,halonumber_hDM, free_param_value = float(free_param_value),PE_file=PE_file,pynbody_path = pynbody_path, df_tagged_particles=df_tagged_particles,AHF_centers_filepath=AHF_centers_filepath,acc_halo_path_tagged = acc_halo_path_tagged,tag_typ='accreted',return_catalog=True,potential_method=potential_method,opening_angle=opening_angle,processes=1)
                                                             
                     print('---recursion end -----')
                                 
@@ -951,18 +1005,14 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                     
                     simfn = join(pynbody_path, outputs[i])
     
-                    if float(mass_select_merge) >0 and decision2==True:
-                        # try to load in the data from this snapshot
-                        try:
-                            DMOparticles = pynbody.load(simfn)
-                            DMOparticles.physical_units()
-                            print('loaded data in mergers')
-                        # where this data isn't available, notify the user.
-                        except:
-                            print('--> DMO particle data exists but failed to read it, skipping!')
-                            continue
-                        decision2 = False
-                        decl=True
+                    # try to load in the data from this snapshot
+                    try:
+                        DMOparticles = load_halo_snapshot(simfn, hDM) if AHF_centers_filepath == None else load_snapshot(simfn)
+                        print('loaded data in mergers')
+                    # where this data isn't available, notify the user.
+                    except:
+                        print('--> DMO particle data exists but failed to read it, skipping!')
+                        continue
                  
                     if int(mass_select_merge) > 0:
     
@@ -973,6 +1023,8 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                                 HOP_halonum_acc = int(hDM.calculate('halo_number()'))
                                 AHF_halonum_accreted = AHF_halonum_acc[AHF_halonum_acc["HOP halonum"] == HOP_halonum_acc]["AHF halonum"].values[0]
                                 h_merge = DMOparticles.halos(halo_numbers="v1")[AHF_halonum_accreted]
+                            elif is_region_snapshot(DMOparticles):
+                                h_merge = region_halo(DMOparticles, hDM)
                             else: 
                                 h_merge = DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
                             
@@ -993,7 +1045,9 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                                                 
                         
                         if "iord" in DMOparticles_acc_only.loadable_keys(): 
-                            accreted_particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles_acc_only)
+                            path_to_pe_file_acc = potential_filename(PE_file,outputs[i],hDM.calculate('halo_number()')) if PE_file != None else None
+
+                            accreted_particles_sorted_by_BE = rank_order_particles_by_BE(DMOparticles_acc_only,hDM,path_to_pe_file=path_to_pe_file_acc, tagging_fraction=float(free_param_value), potential_method=potential_method, opening_angle=opening_angle)
                         else:
                             del DMOparticles_acc_only
                             continue
@@ -1004,34 +1058,41 @@ def BE_tag_over_full_sim_recursive(DMOsim,tstep, halonumber, free_param_value =
                         array_to_write_accreted = assign_stars_to_particles(mass_select_merge,accreted_particles_sorted_by_BE,float(free_param_value))
                         
     
-                        tagged_iords_to_write = np.append(tagged_iords_to_write,array_to_write_accreted[0])
-                        tagged_types_to_write = np.append(tagged_types_to_write,np.repeat('accreted',len(array_to_write_accreted[0])))
-                        tagged_mstars_to_write = np.append(tagged_mstars_to_write,array_to_write_accreted[1])
-                        ts_to_write = np.append(ts_to_write,np.repeat(t_all[i],len(array_to_write_accreted[0])))
-                        zs_to_write = np.append(zs_to_write,np.repeat(red_all[i],len(array_to_write_accreted[0])))
-    
-                
-                        row_to_write_acc = pd.DataFrame({'iords':array_to_write_accreted[0], 'mstar':array_to_write_accreted[1],'t':np.repeat(t_all[i],len(array_to_write_accreted[0])),'z':np.repeat(red_all[i],len(array_to_write_accreted[0])) , 'type':np.repeat('accreted',len(array_to_write_accreted[0])) })
-                        
-                        df_tagged_particles = pd.concat([df_tagged_particles,row_to_write_acc],ignore_index=True)            
+                        df_tagged_particles.append(array_to_write_accreted[0],array_to_write_accreted[1],t_all[i],red_all[i],'accreted')
 
                         print('writing accreted particles to output file')
               
                         del DMOparticles_acc_only
-        
-                  
-                            
-        if decision==True or decl==True:
-            del DMOparticles
     
     
         print("Done with iteration",i)
 
 
-        if particle_storage_filename != None:
-            df_tagged_particles.to_csv(particle_storage_filename)
+        if writer != None:
+            writer.append_catalog(df_tagged_particles)
+
+        if checkpoint != None:
+            checkpoint.save(outputs[i], df_tagged_particles, acc_halo_path_tagged, subtrees = subtrees.submitted if subtrees != None else [])
+
+    if subtrees != None:
+        
+        df_tagged_particles,acc_halo_path_tagged = subtrees.merge(df_tagged_particles,acc_halo_path_tagged)
+
+        # the particles of the subtrees, once they are all merged
+        if writer != None:
+            writer.append_catalog(df_tagged_particles)
+
+    if writer != None:
+        writer.close()
+
+    # the whole run is done (and any subtrees merged)
+    if checkpoint != None and len(outputs) > 0:
+        checkpoint.save(outputs[-1], df_tagged_particles, acc_halo_path_tagged, subtrees = [])
+
+    if top_level == True:
+        print('halos tagged over their full lifetimes:',len(acc_halo_path_tagged),'skipped:',dict(acc_halo_path_tagged.skip_counts()))
             
-    return df_tagged_particles,acc_halo_path_tagged
+    return (df_tagged_particles if return_catalog == True else df_tagged_particles.to_dataframe()),acc_halo_path_tagged
 
 
 
@@ -1203,16 +1264,17 @@ DMOname = DMOsim.path
         else:
 
             dfnew = data_particles_tagged[data_particles_tagged['t']<=t_all[i]].groupby(['iords']).sum()
+
+            # stellar masses of the selected particles, gathered by iord
+            mass_index = IordIndex.from_frame(dfnew, ['mstar'])
     
-            masses = [dfnew.loc[n]['mstar'] for n in particle_selection_reff_tot['iord']]
+            masses = mass_index.gather('mstar', particle_selection_reff_tot['iord'])
 
-            masses_insitu = [data_insitu.loc[iord]['mstar'] for iord in particles_only_insitu['iord']]
+            masses_insitu = IordIndex.from_frame(data_insitu, ['mstar']).gather('mstar', particles_only_insitu['iord'])
                 
             cen_stars = calc_3D_cm(particles_only_insitu,masses_insitu)
             
             particle_selection_reff_tot['pos'] -= cen_stars
-            
-            masses = [dfnew.loc[n]['mstar'] for n in particle_selection_reff_tot['iord']]
 
             #particle_selection_reff_tot['pos'] -= cen_stars 
 
@@ -1230,7 +1292,7 @@ DMOname = DMOsim.path
             
             print('array lengths',len(set(distance_ordered_iords)),len(distance_ordered_iords))
 
-            sorted_massess = [dfnew.loc[n]['mstar'] for n in distance_ordered_iords]
+            sorted_massess = mass_index.gather('mstar', distance_ordered_iords)
             
             cumilative_sum = np.cumsum(sorted_massess)
 
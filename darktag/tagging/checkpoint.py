@@ -0,0 +1,182 @@
+
+import os
+import json
+import random
+from collections import OrderedDict
+
+import numpy as np
+
+from .tagged_storage import TaggedCatalog
+from .halo_registry import TaggedHaloRegistry
+
+
+state_filename = 'state.json'
+
+
+def _rng_state_to_json():
+
+    # saved in state.json, so that it is replaced together with the rest of the checkpoint
+    bit_generator, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal_state, gauss_next = random.getstate()
+
+    return {'numpy':[bit_generator, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)],
+            'python':[version, list(internal_state), gauss_next]}
+
+
+def _rng_state_from_json(rng):
+
+    bit_generator, keys, pos, has_gauss, cached_gaussian = rng['numpy']
+    version, internal_state, gauss_next = rng['python']
+
+    np.random.set_state((bit_generator, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+
+class TaggingCheckpoint:
+
+    '''
+
+    Checkpoint of a tagging run, saved after every snapshot so that a run killed part of the way through
+    (a crash or the queue's walltime) can be restarted where it stopped.
+
+    The checkpoint directory holds the tagged particle catalogs at full precision (one raw binary file per
+    column and catalog, appended to with the rows tagged since the previous save) and a state.json recording
+    the last snapshot done, the number of rows of each catalog, the accreted halos tagged and skipped so far
+    (the TaggedHaloRegistry of the recursive taggers), the state of the numpy and python random number
+    generators (the occupation of merging halos is drawn at random) and which run the checkpoint belongs to.
+    state.json is replaced last, so a run killed during a save resumes from the previous snapshot.
+
+    Since the run is resumed after the last snapshot done (by name), re-running it once the tangos database
+    has gained later timesteps carries on from there rather than starting over.
+
+    '''
+
+    def __init__(self, checkpoint_dir, run=None):
+
+        '''
+
+        Inputs:
+
+        checkpoint_dir - directory of the checkpoint
+        run - dictionary identifying the run (simulation, halo number, method ...), a checkpoint of another run is not resumed from
+
+        '''
+
+        self.checkpoint_dir = str(checkpoint_dir)
+        self.run = {} if run == None else dict(run)
+
+        # rows of each catalog already saved
+        self.n_saved = {}
+
+    def __repr__(self):
+        return '<TaggingCheckpoint '+self.checkpoint_dir+'>'
+
+    def _column_filename(self, name, column):
+        return os.path.join(self.checkpoint_dir, str(name)+'.'+column+'.bin')
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.checkpoint_dir, state_filename))
+
+    def save(self, output, catalogs, acc_halo_path_tagged=None, **state):
+
+        '''
+
+        Inputs:
+
+        output - name of the last snapshot done
+        catalogs - TaggedCatalog, or a dictionary of them (e.g. one per free parameter value)
+        acc_halo_path_tagged - TaggedHaloRegistry (or paths) of the accreted halos tagged so far (recursive taggers)
+        state - any further (json serialisable) values to restore on resuming
+
+        '''
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        catalogs = catalogs if isinstance(catalogs, dict) else {'catalog':catalogs}
+
+        for name, catalog in catalogs.items():
+
+            n_saved = self.n_saved.get(str(name), 0)
+
+            for column, dtype in TaggedCatalog.dtypes.items():
+
+                filename = self._column_filename(name, column)
+
+                # rows beyond those recorded in state.json (from a save that was interrupted) are overwritten
+                with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as f:
+                    f.seek(n_saved * np.dtype(dtype).itemsize)
+                    np.ascontiguousarray(catalog[column][n_saved:], dtype=dtype).tofile(f)
+                    f.truncate()
+
+        header = {'run':self.run,
+                  'output':str(output),
+                  'n_rows':OrderedDict((str(name), len(catalog)) for name, catalog in catalogs.items()),
+                  'acc_halo_path_tagged':TaggedHaloRegistry.from_paths(acc_halo_path_tagged).to_dict(),
+                  'rng':_rng_state_to_json(),
+                  'state':state}
+
+        tmp_filename = os.path.join(self.checkpoint_dir, state_filename+'.tmp')
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(header, f, indent=1)
+
+        os.replace(tmp_filename, os.path.join(self.checkpoint_dir, state_filename))
+
+        self.n_saved = dict(header['n_rows'])
+
+    def load(self, restore_rng=True):
+
+        '''
+
+        Reads the checkpoint back (and by default restores the random number generators).
+
+        Returns:
+
+        dictionary with the last snapshot done ('output'), the catalogs ('catalogs', a dictionary of TaggedCatalogs
+        keyed as they were saved), 'acc_halo_path_tagged' (a TaggedHaloRegistry) and the further values saved ('state')
+
+        '''
+
+        with open(os.path.join(self.checkpoint_dir, state_filename)) as f:
+            header = json.load(f)
+
+        if header['run'] != json.loads(json.dumps(self.run)):
+            raise ValueError('checkpoint in '+self.checkpoint_dir+' belongs to another run: '+str(header['run']))
+
+        catalogs = OrderedDict()
+
+        for name, n_rows in header['n_rows'].items():
+
+            catalog = TaggedCatalog(capacity=max(n_rows, 1))
+
+            columns = [np.fromfile(self._column_filename(name, column), dtype=dtype, count=n_rows) for column, dtype in TaggedCatalog.dtypes.items()]
+
+            catalog.append(*columns)
+
+            catalogs[name] = catalog
+
+        self.n_saved = dict(header['n_rows'])
+
+        if restore_rng:
+
+            _rng_state_from_json(header['rng'])
+
+        return {'output':header['output'],
+                'catalogs':catalogs,
+                'acc_halo_path_tagged':TaggedHaloRegistry.from_dict(header['acc_halo_path_tagged']),
+                'state':header['state']}
+
+    def resume_index(self, outputs, output):
+
+        '''
+
+        Returns the index in outputs of the snapshot after output (the last one done)
+
+        '''
+
+        outputs = [str(o) for o in outputs]
+
+        if str(output) not in outputs:
+            raise ValueError('last snapshot of the checkpoint ('+str(output)+') is not one of the outputs of this run')
+
+        return outputs.index(str(output)) + 1
@@ -0,0 +1,181 @@
+
+import os
+import json
+import pickle
+import hashlib
+import inspect
+from os.path import join
+from collections import OrderedDict
+
+import darklight
+from darklight import DarkLight
+
+from ...config import config
+
+
+# results kept in memory (most recently used last), on top of the files in darklight_cache_path
+memory_cache_size = 256
+
+_memory_cache = OrderedDict()
+
+
+def darklight_version():
+    return str(getattr(darklight, '__version__', 'unknown'))
+
+
+def darklight_defaults():
+
+    # DarkLight's own default arguments, so that leaving one out and passing its default give the same key
+    try:
+        return {name:parameter.default for name, parameter in inspect.signature(DarkLight).parameters.items() if parameter.default is not inspect.Parameter.empty}
+    except (TypeError, ValueError):
+        return {}
+
+
+def darklight_key(halo_path, darklight_kwargs):
+
+    '''
+
+    Returns the cache key of a DarkLight run: a hash of the halo path, the DarkLight arguments (with DarkLight's
+    defaults filled in) and the darklight version
+
+    '''
+
+    arguments = darklight_defaults()
+    arguments.update(darklight_kwargs)
+
+    description = json.dumps({'halo':str(halo_path), 'arguments':arguments, 'version':darklight_version()}, sort_keys=True, default=str)
+
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def is_deterministic(darklight_kwargs):
+
+    # the star formation histories are only reproducible without scatter
+    arguments = darklight_defaults()
+    arguments.update(darklight_kwargs)
+
+    return arguments.get('nscatter', 0) == 0
+
+
+def _cache_dir():
+    return config.get("paths", "darklight_cache_path", "")
+
+
+def _evict(cache_dir, budget_bytes):
+
+    # least recently used files first (hits touch their file)
+    files = [join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pkl')]
+
+    files = sorted(((os.path.getmtime(f), os.path.getsize(f), f) for f in files))
+
+    total = sum(size for mtime, size, f in files)
+
+    for mtime, size, f in files:
+
+        if total <= budget_bytes:
+            break
+
+        try:
+            os.remove(f)
+            total -= size
+        except OSError:
+            pass
+
+
+def cached_darklight(halo, memoise=None, **darklight_kwargs):
+
+    '''
+
+    DarkLight(halo, **darklight_kwargs), memoised by halo path, DarkLight arguments and darklight version.
+
+    The taggers run DarkLight on the main halo and on every merging halo, and the recursive taggers again on
+    each accreted halo they recurse into, with the same arguments every time. Results are kept in memory and,
+    given a darklight_cache_path in config.json, written there, so that later runs (and other processes) reuse
+    them. The files on disk are evicted least recently used first once they take more than cache_size_mb
+    (the "darklight" section of config.json).
+
+    Inputs:
+
+    halo - tangos halo object
+    memoise - whether to cache the result (defaults to caching only deterministic runs, i.e. nscatter=0)
+    darklight_kwargs - arguments of DarkLight
+
+    Returns:
+
+    the output of DarkLight (t, redshift, vsmooth, sfh_insitu, mstar_s_insitu, mstar_total)
+
+    '''
+
+    if memoise == None:
+        memoise = is_deterministic(darklight_kwargs)
+
+    if memoise == False:
+        return DarkLight(halo, **darklight_kwargs)
+
+    key = darklight_key(halo.path, darklight_kwargs)
+
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        return _memory_cache[key]
+
+    cache_dir = _cache_dir()
+
+    filename = join(cache_dir, key+'.pkl') if cache_dir != "" else None
+
+    result = None
+
+    if filename != None and os.path.isfile(filename):
+
+        try:
+            with open(filename, 'rb') as f:
+                result = pickle.load(f)
+
+            # marks the file as recently used
+            os.utime(filename)
+
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print('could not read cached darklight result', filename, e)
+            result = None
+
+    if result == None:
+
+        result = tuple(DarkLight(halo, **darklight_kwargs))
+
+        if filename != None:
+
+            os.makedirs(cache_dir, exist_ok=True)
+
+            tmp_filename = filename+'.'+str(os.getpid())+'.tmp'
+
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(result, f)
+
+            os.replace(tmp_filename, filename)
+
+            _evict(cache_dir, float(config.get("darklight", "cache_size_mb", 1024))*1024**2)
+
+    _memory_cache[key] = result
+
+    while len(_memory_cache) > memory_cache_size:
+        _memory_cache.popitem(last=False)
+
+    return result
+
+
+def clear_darklight_cache(disk=False):
+
+    '''
+
+    Empties the in-memory cache (and the files in darklight_cache_path with disk=True)
+
+    '''
+
+    _memory_cache.clear()
+
+    cache_dir = _cache_dir()
+
+    if disk == True and cache_dir != "" and os.path.isdir(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.pkl'):
+                os.remove(join(cache_dir, f))
@@ -0,0 +1,346 @@
+
+import os
+import json
+from os.path import join
+
+import numpy as np
+import pynbody
+import tangos
+
+from .utils import load_indexing_data
+from .simulation_index import simulation_index
+from .snapshot_cache import load_halo_snapshot, is_region_snapshot, region_halo, snapshot_cache
+from ...config import config
+
+
+# one record per particle, radially sorted (positions and velocities relative to the halo centre / bulk velocity)
+extract_dtype = np.dtype([('iord', np.int64),
+                          ('pos', np.float32, 3),
+                          ('vel', np.float32, 3),
+                          ('mass', np.float32),
+                          ('r', np.float32),
+                          ('sub', np.uint8)])
+
+extract_units = {'pos':'kpc', 'vel':'km s**-1', 'mass':'Msol', 'r':'kpc'}
+
+
+def extract_filename(extract_dir, output, halonumber):
+
+    '''
+
+    Returns the path (without extension) of the extract of halo number halonumber at the given output.
+    The particles are stored in <path>.npy and the halo properties in <path>.json
+
+    '''
+
+    return join(extract_dir, str(output), 'halo_'+str(int(halonumber)))
+
+
+class HaloExtract:
+
+    '''
+
+    Particles of one halo at one output, read back from an extract written by extract_halo_regions.
+
+    Supports the subset of the pynbody SimSnap interface used by the tagging and reff code:
+    arrays ('iord', 'pos', 'vel', 'mass', 'x', 'y', 'z', 'vx', 'vy', 'vz', 'r', 'rxy', 'j', 'ke')
+    come back as pynbody SimArrays in physical units ('sub' flags particles in subhalos of the
+    main halo), and indexing with a mask, index array,
+    slice or pynbody filter returns another HaloExtract. The particles are already centred on the
+    halo (and its bulk velocity subtracted), so no further centering is needed.
+
+    '''
+
+    def __init__(self, data, meta, sorted_by_r=True):
+
+        self._data = data
+        self.meta = meta
+        self._sorted_by_r = sorted_by_r
+
+        # 'pos' / 'vel' are copied out of the (read only) file on first use so they can be shifted in place
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<HaloExtract '+str(self.meta['output'])+' halo_'+str(self.meta['halonumber'])+' len='+str(len(self))+'>'
+
+    @property
+    def d(self):
+        # extracts only hold dark matter
+        return self
+
+    dm = d
+
+    @property
+    def r200(self):
+        return self.meta['r200']
+
+    def within(self, radius):
+
+        '''
+
+        Returns the particles with r <= radius (a slice of the file for radially sorted extracts).
+
+        '''
+
+        if self._sorted_by_r:
+            n = np.searchsorted(self._data['r'], radius, side='right')
+            return HaloExtract(self._data[:n], self.meta)
+
+        return self[np.asarray(self._data['r']) <= radius]
+
+    def _stored(self, key):
+
+        if key not in self._arrays:
+            self._arrays[key] = pynbody.array.SimArray(np.array(self._data[key], dtype=np.float64), extract_units[key])
+
+        return self._arrays[key]
+
+    def keys(self):
+        return ['iord', 'pos', 'vel', 'mass']
+
+    def __setitem__(self, key, value):
+
+        # only the in-place shifts of 'pos' / 'vel' (e.g. particles['pos'] -= cen) are supported
+        if key not in ('pos', 'vel'):
+            raise KeyError(key)
+
+        self._arrays[key] = pynbody.array.SimArray(np.asarray(value, dtype=np.float64), extract_units[key])
+
+    def __getitem__(self, key):
+
+        if isinstance(key, str):
+
+            if key in ('iord', 'sub'):
+                return np.asarray(self._data[key])
+
+            if key in ('pos', 'vel'):
+                return self._stored(key)
+
+            if key == 'mass':
+                return pynbody.array.SimArray(np.asarray(self._data['mass'], dtype=np.float64), 'Msol')
+
+            if key in ('x', 'y', 'z'):
+                return self['pos'][:, 'xyz'.index(key)]
+
+            if key in ('vx', 'vy', 'vz'):
+                return self['vel'][:, 'xyz'.index(key[1])]
+
+            if key == 'r':
+                pos = self['pos']
+                return pynbody.array.SimArray(np.sqrt((np.asarray(pos)**2).sum(axis=1)), 'kpc')
+
+            if key == 'rxy':
+                pos = self['pos']
+                return pynbody.array.SimArray(np.sqrt(np.asarray(pos[:, 0])**2 + np.asarray(pos[:, 1])**2), 'kpc')
+
+            if key == 'j':
+                return pynbody.array.SimArray(np.cross(np.asarray(self['pos']), np.asarray(self['vel'])), 'kpc km s**-1')
+
+            if key == 'ke':
+                return pynbody.array.SimArray(0.5*(np.asarray(self['vel'])**2).sum(axis=1), 'km**2 s**-2')
+
+            raise KeyError(key)
+
+        # pynbody filters are evaluated on the extract to give a mask
+        if isinstance(key, pynbody.filt.Filter):
+            key = key(self)
+
+        key = np.asarray(key) if not isinstance(key, slice) else key
+
+        subset = HaloExtract(self._data[key], self.meta, sorted_by_r=self._sorted_by_r and (isinstance(key, slice) or key.dtype == bool))
+
+        # carry over in-place shifts of the parent
+        for array, values in self._arrays.items():
+            subset._arrays[array] = values[key]
+
+        return subset
+
+
+def load_extract(extract_dir, output, halonumber, mmap=True):
+
+    '''
+
+    Inputs:
+
+    extract_dir - directory the extracts were written to
+    output - name of the snapshot (e.g. output_00100)
+    halonumber - tangos halo number of the halo at this output
+    mmap - memory-map the particle file rather than reading it in
+
+    Returns:
+
+    HaloExtract of the halo (raises FileNotFoundError if it was not extracted)
+
+    '''
+
+    filename = extract_filename(extract_dir, output, halonumber)
+
+    with open(filename+'.json') as f:
+        meta = json.load(f)
+
+    data = np.load(filename+'.npy', mmap_mode='r' if mmap else None)
+
+    return HaloExtract(data, meta)
+
+
+def has_extract(extract_dir, output, halonumber):
+    return os.path.exists(extract_filename(extract_dir, output, halonumber)+'.npy')
+
+
+def extract_halo(DMOparticles, h, filename, radius_factor=3.0, children_iords=None, **properties):
+
+    '''
+
+    Writes the extract of one halo.
+
+    Inputs:
+
+    DMOparticles - snapshot (from the snapshot cache) the halo belongs to
+    h - particles of the halo used for centering (catalogue halo or region_halo)
+    filename - output path without extension (see extract_filename)
+    radius_factor - particles out to radius_factor*r200 are kept
+    children_iords - iords of particles in subhalos, flagged in the 'sub' column
+    properties - additional entries for the json file (output, halonumber, t, z ...)
+
+    Returns:
+
+    the halo properties written to the json file
+
+    '''
+
+    pynbody.analysis.halo.center(h, vel=False)
+
+    r200 = float(pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical'))
+
+    vel_center = np.asarray(pynbody.analysis.halo.vel_center(h, retcen=True))
+
+    particles = DMOparticles.d[pynbody.filt.Sphere(radius_factor*r200)]
+
+    r = np.asarray(particles['r'].in_units('kpc'))
+
+    order = np.argsort(r)
+
+    data = np.empty(len(order), dtype=extract_dtype)
+
+    data['iord'] = np.asarray(particles['iord'])[order]
+    data['pos'] = np.asarray(particles['pos'].in_units('kpc'))[order]
+    data['vel'] = (np.asarray(particles['vel'].in_units('km s**-1')) - vel_center)[order]
+    data['mass'] = np.asarray(particles['mass'].in_units('Msol'))[order]
+    data['r'] = r[order]
+    data['sub'] = np.isin(data['iord'], children_iords) if children_iords is not None else 0
+
+    meta = dict(properties)
+
+    # centre and bulk velocity in the frame of the simulation (undoing earlier centering of the cached snapshot)
+    meta['center'] = (-snapshot_cache.offset(DMOparticles)).tolist()
+    meta['vel_center'] = (vel_center - snapshot_cache.offset(DMOparticles, 'vel')).tolist()
+    meta['r200'] = r200
+    meta['radius_factor'] = radius_factor
+    meta['n_particles'] = len(data)
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    np.save(filename+'.npy', data)
+
+    with open(filename+'.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return meta
+
+
+def extract_halo_regions(DMOsim, halonumber=1, extract_dir=None, radius_factor=3.0, mergers=True, overwrite=False, pynbody_path=None):
+
+    '''
+
+    Walks the main progenitor branch of a halo once and writes an extract (see extract_halo) of the
+    halo at every output, and of the halos merging into it at the outputs where the taggers select
+    accreted particles. Tagging, reff and plotting functions given extract_dir read these instead of
+    the raw snapshots.
+
+    Inputs:
+
+    DMOsim - tangos simulation
+    halonumber - halo number of the main halo at the final timestep
+    extract_dir - directory to write the extracts to (defaults to the extract_path in config.json)
+    radius_factor - particles out to radius_factor*r200 are kept (in 'region' loading mode, the region read around
+                    each halo is widened to at least this many r200c, so the extracts are not cut short)
+    mergers - whether to extract the merging halos as well
+    overwrite - re-extract halos that already have an extract
+    pynbody_path - path to particle data (defaults to config)
+
+    Returns:
+
+    list of the properties (as written to the json files) of every halo extracted
+
+    '''
+
+    if extract_dir == None:
+        extract_dir = config.get_path("extract_path")
+
+    if pynbody_path == None:
+        pynbody_path = config.get_path("pynbody_path")
+
+    DMOname = DMOsim.path
+
+    t_all,red_all,main_halo,halonums,outputs = load_indexing_data(DMOsim,halonumber)
+
+    merger_index = simulation_index(DMOsim).merger_index(main_halo) if mergers == True else None
+
+    extracted = []
+
+    for i in range(len(outputs)):
+
+        simfn = join(pynbody_path,DMOname,outputs[i])
+
+        hDMO = tangos.get_halo(DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]))
+
+        halos_to_extract = [(hDMO, int(halonums[i]), 'main')]
+
+        # halos that have merged by the next snapshot are tagged (and so extracted) in this one
+        if ((i+1 < len(outputs)) and (merger_index != None)):
+
+            for merger in merger_index.at_output(outputs[i+1]):
+                halos_to_extract.append((merger_index.halo(merger), merger['halo_number'], 'merger'))
+
+        for halo, halo_number, role in halos_to_extract:
+
+            filename = extract_filename(extract_dir, outputs[i], halo_number)
+
+            if overwrite == False and has_extract(extract_dir, outputs[i], halo_number):
+                continue
+
+            try:
+                DMOparticles = load_halo_snapshot(simfn, halo, radius_factor=radius_factor)
+
+                children_iords = None
+
+                if is_region_snapshot(DMOparticles):
+                    h = region_halo(DMOparticles, halo)
+
+                else:
+                    h = DMOparticles.halos()[halo_number-1]
+
+                    if role == 'main':
+                        # subhalos are flagged so the reff calculation can exclude them
+                        from .tagging_wrapper_func import get_child_iords
+
+                        try:
+                            children_iords = get_child_iords(h, DMOparticles.halos(), DMO_state='DMO')[0]
+                        except Exception as e:
+                            print('could not find the subhalos of', halo, e)
+
+                meta = extract_halo(DMOparticles, h, filename, radius_factor=radius_factor, children_iords=children_iords,
+                                    output=str(outputs[i]), halonumber=halo_number, t=float(t_all[i]), z=float(red_all[i]), role=role)
+
+            except Exception as e:
+                print('could not extract', halo, e)
+                continue
+
+            print('extracted', halo, meta['n_particles'], 'particles')
+
+            extracted.append(meta)
+
+    return extracted
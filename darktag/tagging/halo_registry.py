@@ -0,0 +1,141 @@
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TaggedHaloRegistry:
+
+    '''
+
+    Registry of the halos a recursive tagging run has visited: the tangos paths of the halos tagged over their
+    full lifetimes (acc_halo_path_tagged of the recursive taggers), in the order they were tagged, and the
+    merging halos that were skipped with the reason why (e.g. 'unoccupied', 'no stars', 'already tagged').
+
+    The paths are kept in dictionaries, so checking whether a merging halo (or any of its progenitors) has been
+    tagged costs a lookup per progenitor rather than a pass over every halo tagged so far. The registry is
+    passed to the worker processes tagging accreted subtrees and saved with the checkpoints as plain lists and
+    dictionaries (to_dict / from_dict).
+
+    '''
+
+    def __init__(self, tagged=None, skipped=None):
+
+        # tangos path -> None, in the order the halos were tagged
+        self.tagged = OrderedDict()
+
+        # tangos path -> reason the halo was skipped
+        self.skipped = OrderedDict()
+
+        if tagged is not None:
+            for path in tagged:
+                self.add(path)
+
+        if skipped is not None:
+            for path, reason in skipped.items():
+                self.skip(path, reason)
+
+    @classmethod
+    def from_paths(cls, acc_halo_path_tagged):
+
+        '''
+
+        Returns acc_halo_path_tagged as a registry: a registry is returned as it is, None gives an empty one and
+        an array or list of paths (as returned by earlier versions of the recursive taggers) is registered in order
+
+        '''
+
+        if isinstance(acc_halo_path_tagged, cls):
+            return acc_halo_path_tagged
+
+        return cls(acc_halo_path_tagged)
+
+    @classmethod
+    def from_dict(cls, registry):
+        return cls(registry.get('tagged'), registry.get('skipped'))
+
+    def to_dict(self):
+        return {'tagged':list(self.tagged), 'skipped':dict(self.skipped)}
+
+    def __repr__(self):
+        return '<TaggedHaloRegistry '+str(len(self.tagged))+' tagged, '+str(len(self.skipped))+' skipped>'
+
+    def __len__(self):
+        return len(self.tagged)
+
+    def __iter__(self):
+        return iter(self.tagged)
+
+    def __contains__(self, path):
+        return str(path) in self.tagged
+
+    @property
+    def paths(self):
+        return np.array(list(self.tagged))
+
+    def add(self, path):
+
+        '''
+
+        Registers the halo at path as tagged (over its full lifetime)
+
+        '''
+
+        self.tagged[str(path)] = None
+
+    def any_tagged(self, paths):
+
+        '''
+
+        Returns True if any of paths (e.g. the progenitor paths of a merging halo) has been tagged
+
+        '''
+
+        return any(str(path) in self.tagged for path in paths)
+
+    def skip(self, path, reason):
+
+        '''
+
+        Records that the merging halo at path was skipped and why
+
+        '''
+
+        self.skipped[str(path)] = str(reason)
+
+    def skip_counts(self):
+
+        '''
+
+        Returns the number of halos skipped for each reason
+
+        '''
+
+        counts = OrderedDict()
+
+        for reason in self.skipped.values():
+            counts[reason] = counts.get(reason, 0) + 1
+
+        return counts
+
+    def copy(self):
+        return TaggedHaloRegistry(self.tagged, self.skipped)
+
+    def update(self, other):
+
+        '''
+
+        Adds the halos tagged and skipped in another registry (e.g. that of a subtree tagged by a worker process),
+        after the ones already registered
+
+        '''
+
+        other = TaggedHaloRegistry.from_paths(other)
+
+        for path in other.tagged:
+            self.add(path)
+
+        for path, reason in other.skipped.items():
+            self.skip(path, reason)
+
+        return self
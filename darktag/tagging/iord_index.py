@@ -0,0 +1,118 @@
+
+import numpy as np
+
+
+class IordIndex:
+
+    '''
+
+    Index of per-particle values (stellar mass, luminosity ...) keyed by particle iord. The iords are sorted once
+    and the values of any set of particles are gathered with a binary search (np.searchsorted) over them, in the
+    order the particles are given.
+
+    This replaces looking up the tagged particles one at a time (data_grouped.loc[iord], np.where(tagged_iords == iord))
+    in the reff and plotting code.
+
+    '''
+
+    def __init__(self, iords, **columns):
+
+        '''
+
+        Inputs:
+
+        iords - particle iords (unique)
+        columns - arrays of values with one entry per iord, e.g. mstar=...
+
+        '''
+
+        iords = np.asarray(iords)
+
+        order = np.argsort(iords, kind='stable')
+
+        self.iords = iords[order]
+
+        self.columns = {name:np.asarray(values)[order] for name, values in columns.items()}
+
+    @classmethod
+    def from_frame(cls, df, columns=None):
+
+        '''
+
+        Returns the index of a dataframe indexed by iord (e.g. the tagged particles grouped by iords), with the
+        given columns (defaults to all of them)
+
+        '''
+
+        columns = list(df.columns) if columns == None else columns
+
+        return cls(df.index.values, **{column:df[column].values for column in columns})
+
+    @classmethod
+    def from_series(cls, series, name=None):
+
+        # a series indexed by iord (e.g. a single column of a groupby)
+        return cls(series.index.values, **{(series.name if name == None else name):series.values})
+
+    def __repr__(self):
+        return '<IordIndex '+str(len(self))+' particles, columns '+str(list(self.columns))+'>'
+
+    def __len__(self):
+        return len(self.iords)
+
+    def positions(self, iords):
+
+        '''
+
+        Returns the positions of iords in the index and a mask of the ones found there
+
+        '''
+
+        iords = np.asarray(iords)
+
+        if len(self.iords) == 0:
+            return np.zeros(iords.shape, dtype=int), np.zeros(iords.shape, dtype=bool)
+
+        idx = np.clip(np.searchsorted(self.iords, iords), 0, len(self.iords)-1)
+
+        return idx, self.iords[idx] == iords
+
+    def contains(self, iords):
+
+        '''
+
+        Returns a mask of the iords that are in the index (as np.isin(iords, index.iords))
+
+        '''
+
+        return self.positions(iords)[1]
+
+    def gather(self, column, iords, fill=None):
+
+        '''
+
+        Inputs:
+
+        column - name of the column
+        iords - particle iords
+        fill - value given to the iords missing from the index (by default they raise a KeyError, like .loc)
+
+        Returns:
+
+        array of the values of column for iords, in the order of iords
+
+        '''
+
+        idx, found = self.positions(iords)
+
+        values = self.columns[column]
+
+        if np.all(found):
+            return values[idx] if len(values) > 0 else np.zeros(idx.shape, dtype=values.dtype)
+
+        if fill == None:
+            raise KeyError(str(np.asarray(iords)[np.logical_not(found)][:10])+' not in the iord index')
+
+        gathered = np.where(found, values[idx] if len(values) > 0 else fill, fill)
+
+        return gathered
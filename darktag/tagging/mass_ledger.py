@@ -0,0 +1,195 @@
+
+import numpy as np
+
+from .tagged_storage import encode_types
+from .iord_index import IordIndex
+
+
+class MassLedger:
+
+    '''
+
+    Ledger of the tagging events of a catalogue (the rows of a tagged particle dataframe), sorted once by iord and
+    time with the running sum of their stellar mass. The stellar mass a particle has been given up to a time t is
+    then the difference of two running sums, found with a binary search (np.searchsorted) of (iord, t) over the
+    sorted events, for any number of particles and times at once.
+
+    This replaces tagged_by(df, t).groupby(['iords']).sum() over the whole catalogue at each snapshot of the reff
+    and plotting time series. As with tagged_by, t is compared at the precision the 't' column is stored at
+    (float32 in columnar stores).
+
+    '''
+
+    def __init__(self, iords, mstar, t, **columns):
+
+        '''
+
+        Inputs:
+
+        iords, mstar, t - particle iord, stellar mass and time (Gyr) of each tagging event
+        columns - other values of each event (e.g. type=...), see last
+
+        '''
+
+        iords = np.asarray(iords)
+        t = np.asarray(t)
+
+        # by iord, then time (events at the same time keep their order)
+        order = np.lexsort((t, iords))
+
+        iords = iords[order]
+        t = t[order]
+
+        self.iords, self.starts, segments = np.unique(iords, return_index=True, return_inverse=True)
+
+        # distinct tagging times, at the precision they are stored at
+        self.times = np.unique(t)
+
+        # (iord, t) of each event as one sorted integer key: position of the iord * (number of times + 1) + rank of t
+        self.stride = len(self.times)+1
+
+        self.keys = segments.ravel().astype(np.int64)*self.stride + np.searchsorted(self.times, t)
+
+        self.cumulative = np.cumsum(np.asarray(mstar, dtype=np.float64)[order])
+
+        # running sum before the first event of each iord
+        self.offsets = np.concatenate([[0.0], self.cumulative])[self.starts]
+
+        self.first_times = t[self.starts]
+
+        self.columns = {name:np.asarray(values)[order] for name, values in columns.items()}
+
+    @classmethod
+    def from_frame(cls, df, columns=None, types=None):
+
+        '''
+
+        Returns the ledger of a tagged particle dataframe (or TaggedCatalog), with the given extra columns
+        (e.g. ['type']), and only the events of the given types (e.g. ['insitu']) if types is given
+
+        '''
+
+        columns = [] if type(columns) == type(None) else columns
+
+        rows = slice(None) if type(types) == type(None) else np.isin(encode_types(np.asarray(df['type'])), encode_types(types))
+
+        return cls(np.asarray(df['iords'])[rows], np.asarray(df['mstar'])[rows], np.asarray(df['t'])[rows],
+                   **{column:np.asarray(df[column])[rows] for column in columns})
+
+    def __repr__(self):
+        return '<MassLedger '+str(len(self.keys))+' events, '+str(len(self.iords))+' particles, '+str(len(self.times))+' tagging times>'
+
+    def __len__(self):
+        return len(self.iords)
+
+    def _segments(self, iords):
+
+        # positions of iords in the ledger (all of them by default)
+        if type(iords) == type(None):
+            return np.arange(len(self.iords))
+
+        iords = np.asarray(iords)
+
+        if len(iords) == 0:
+            return np.zeros(0, dtype=int)
+
+        idx = np.clip(np.searchsorted(self.iords, iords), 0, max(len(self.iords)-1, 0))
+
+        if len(self.iords) == 0 or np.any(self.iords[idx] != iords):
+            missing = iords if len(self.iords) == 0 else iords[self.iords[idx] != iords]
+            raise KeyError(str(missing[:10])+' were never tagged')
+
+        return idx
+
+    def last_events(self, t, iords=None):
+
+        '''
+
+        Inputs:
+
+        t - time or array of times (Gyr)
+        iords - particle iords (all the particles of the ledger by default)
+
+        Returns:
+
+        the positions (in the sorted events) of the last event of each particle at or before each time, and a mask of
+        the particles tagged by then, as (len(iords), len(t)) arrays
+
+        '''
+
+        return self._last_events(t, self._segments(iords))
+
+    def _last_events(self, t, segments):
+
+        # number of distinct tagging times at or before each t
+        ranks = np.searchsorted(self.times, np.asarray(np.atleast_1d(t), dtype=self.times.dtype), side='right')
+
+        positions = np.searchsorted(self.keys, segments[:, None]*self.stride + ranks[None, :]) - 1
+
+        return positions, positions >= self.starts[segments][:, None]
+
+    def mass_at(self, t, iords=None):
+
+        '''
+
+        Inputs:
+
+        t - time (Gyr), or array of times
+        iords - particle iords (all the particles of the ledger by default)
+
+        Returns:
+
+        the stellar mass given to each particle at or before t (0 for particles only tagged later), in the order of
+        iords, as an array of len(iords) or, for an array of times, (len(iords), len(t))
+
+        '''
+
+        segments = self._segments(iords)
+
+        positions, tagged = self._last_events(t, segments)
+
+        masses = np.where(tagged, self.cumulative[np.maximum(positions, 0)] - self.offsets[segments][:, None], 0.0)
+
+        return masses if np.ndim(t) > 0 else masses[:, 0]
+
+    def last(self, column, t, iords=None, fill=None):
+
+        '''
+
+        Returns the value of column at the last event of each particle at or before t (e.g. the type it was last
+        tagged as), with fill for the particles not tagged by then
+
+        '''
+
+        positions, tagged = self.last_events(t, iords)
+
+        values = self.columns[column][np.maximum(positions[:, 0], 0)]
+
+        return values if np.all(tagged) else np.where(tagged[:, 0], values, fill)
+
+    def tagged_iords(self, t):
+
+        '''
+
+        Returns the (sorted) iords of the particles tagged at or before t
+
+        '''
+
+        return self.iords[self.first_times <= np.asarray(t, dtype=self.times.dtype)]
+
+    def index_at(self, t):
+
+        '''
+
+        Returns the IordIndex of the stellar mass (column 'mstar') of the particles tagged at or before t, as
+        built from tagged_by(df, t).groupby(['iords'])[['mstar']].sum()
+
+        '''
+
+        tagged = self.first_times <= np.asarray(t, dtype=self.times.dtype)
+
+        segments = np.flatnonzero(tagged)
+
+        positions, found = self._last_events(t, segments)
+
+        return IordIndex(self.iords[segments], mstar=self.cumulative[positions[:, 0]] - self.offsets[segments])
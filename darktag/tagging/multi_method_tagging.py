@@ -0,0 +1,314 @@
+
+import gc
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+from numpy import sqrt
+import pynbody
+import tangos
+
+from .darklight_cache import cached_darklight
+from tangos.examples.mergers import *
+
+from .utils import *
+from .simulation_index import simulation_index
+from .snapshot_cache import load_halo_snapshot, is_region_snapshot, region_halo
+from .extract import load_extract
+from .tagged_storage import TaggedCatalog, TaggedParticleWriter, FreeParamSweep, method_filename
+from .angular_momentum_tagging import rank_order_particles_by_angmom, assign_stars_to_particles as assign_stars_by_angmom
+from .binding_energy_tagging import rank_order_particles_by_BE, assign_stars_to_particles as assign_stars_by_BE
+from .spatial_tagging import plum_const, prod_binned_df, get_bins
+from ...config import config
+
+
+tagging_methods = ['angular momentum', 'binding energy', 'spatial']
+
+# stellar mass of one spatially tagged particle (see spatial_tagging.prod_binned_df)
+spatial_particle_mass = 1112
+
+
+def rank_particles(method, particles, hDMO, tagging_fraction=None, potential_method='direct'):
+
+    '''
+
+    Inputs:
+
+    method - 'angular momentum' (lowest |j| first) or 'binding energy' (most bound first)
+    particles - particles of the halo, centred on it
+    hDMO - tangos halo object of the halo
+    tagging_fraction - only the int(N*tagging_fraction) first particles need to be in order
+    potential_method - potential engine of the binding energy ranking (see potential.calculate_potential)
+
+    Returns:
+
+    the particle IDs ranked by the method
+
+    '''
+
+    if method == 'angular momentum':
+        return rank_order_particles_by_angmom(particles, tagging_fraction=tagging_fraction)
+
+    if method == 'binding energy':
+        return rank_order_particles_by_BE(particles, hDMO, tagging_fraction=tagging_fraction, potential_method=potential_method)
+
+    raise ValueError('no ranking for tagging method '+str(method))
+
+
+def spatial_select(particles, hDMO, z_val, snapshot_stellar_mass, chosen_parts, insitu, r200, i, t_all, red_all):
+
+    '''
+
+    Selects spatially tagged particles (Plummer profile binned in radius, see spatial_tagging) from particles centred on the halo.
+
+    Inputs:
+
+    particles - particles of the halo, centred on it
+    hDMO - tangos halo object of the halo
+    z_val - redshift of the snapshot
+    snapshot_stellar_mass - stellar mass to be tagged
+    chosen_parts - IDs of the particles spatially tagged so far (these are not chosen again)
+    insitu - 'insitu' or 'accreted'
+    r200 - virial radius of the halo used for the Plummer radius
+    i, t_all, red_all - index of the snapshot and the times / redshifts of all snapshots
+
+    Returns:
+
+    IDs of the chosen particles (each carries spatial_particle_mass of stars)
+
+    '''
+
+    a_check = plum_const(hDMO, z_val, insitu, r200)
+
+    if len(particles[sqrt(particles['pos'][:,0]**2 + particles['pos'][:,1]**2 + particles['pos'][:,2]**2) <= 10*a_check]) == 0:
+        print('no particles in the selection radius')
+        return np.array([])
+
+    binned_df, bins, a, a_coeff, selection_mass = prod_binned_df(z_val, snapshot_stellar_mass, snapshot_stellar_mass, chosen_parts, particles, hDMO, insitu, np.array([a_check]), r200)
+
+    choose_parts = get_bins(bins, binned_df, snapshot_stellar_mass, a, a_coeff, 0, red_all, t_all, i, insitu, selection_mass)[0]
+
+    return choose_parts
+
+
+def multi_method_tag_over_full_sim(DMOsim, halonumber = 1, methods = None, free_param_value = 0.01, pynbody_path = None, particle_storage_filename=None, mergers = True, extract_dir = None, potential_method = 'direct'):
+
+    '''
+
+    Tags the halo with several tagging methods in one pass over the simulation. Every snapshot is loaded once, the
+    halo (and each merging halo) is centred and its r200 sphere cut out once, and each method then selects from the
+    same particles, so comparing methods costs one pass rather than one per method. All methods share the
+    darklight stellar mass history of the main halo and of the merging halos.
+
+    Inputs:
+
+    DMOsim - tangos simulation
+    halonumber - halo number of the main halo at the final timestep
+    methods - list of tagging methods out of tagging_methods (defaults to all of them)
+    free_param_value - tagging fraction of the angular momentum and binding energy methods (a list of values
+                       tags all of them, see tagged_storage.FreeParamSweep)
+    pynbody_path - path to particle data
+    particle_storage_filename - if given, the particles tagged by each method are written to
+                                tagged_storage.method_filename(particle_storage_filename, method)
+    mergers - Whether to include merging/accreting halos or not.
+    extract_dir - if given, particles are read from the halo extracts written by extract_halo_regions instead of the snapshots
+    potential_method - potential engine of the binding energy method ('direct' or 'tree', see potential.calculate_potential)
+
+    Returns:
+
+    dictionary of the dataframes of tagged particles keyed by method (for a list of free_param_value values
+    the angular momentum and binding energy entries are themselves dictionaries keyed by value)
+
+    '''
+
+    methods = list(tagging_methods) if methods == None else list(OrderedDict.fromkeys(methods))
+
+    for method in methods:
+        if method not in tagging_methods:
+            raise ValueError('unknown tagging method '+str(method)+', choose from '+str(tagging_methods))
+
+    # Use config path if pynbody_path not provided
+    if pynbody_path is None:
+        pynbody_path = config.get_path("pynbody_path")
+
+    DMOname = DMOsim.path
+
+    t_all,red_all,main_halo,halonums,outputs = load_indexing_data(DMOsim,halonumber)
+
+    # Get stellar masses at each redshift using darklight for insitu tagging (mergers = False excludes accreted mass)
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = cached_darklight(main_halo,DMO=True,n=config.get("darklight","n"),mergers=False)
+
+    # the halos merging onto the main branch, keyed by the index of the snapshot they have merged by
+    merger_index = simulation_index(DMOsim).merger_index(main_halo) if mergers == True else None
+
+    rank_methods = [method for method in methods if method != 'spatial']
+
+    # tagged particles of the ranking methods (one catalog per free parameter value)
+    sweeps = OrderedDict((method, FreeParamSweep(free_param_value, method_filename(particle_storage_filename, method) if particle_storage_filename != None else None)) for method in rank_methods)
+
+    assign_stars = {'angular momentum':assign_stars_by_angmom, 'binding energy':assign_stars_by_BE}
+
+    # spatially tagged particles, and the writer they are appended to
+    spatial_catalog = TaggedCatalog()
+    spatial_writer = TaggedParticleWriter(method_filename(particle_storage_filename, 'spatial')) if ('spatial' in methods and particle_storage_filename != None) else None
+
+    def tag_halo(particles, halo, snapshot_stellar_mass, r200, insitu, i):
+
+        # runs every method on the particles of one (centred) halo
+        for method in rank_methods:
+
+            try:
+                particles_sorted = rank_particles(method, particles, halo, tagging_fraction=sweeps[method].max_value, potential_method=potential_method)
+            except Exception as e:
+                print(method, 'ranking failed:', e)
+                continue
+
+            if particles_sorted.shape[0] == 0:
+                continue
+
+            print('assigning stars to', insitu, 'particles by', method)
+
+            sweeps[method].tag(assign_stars[method], snapshot_stellar_mass, particles_sorted, t_all[i], red_all[i], insitu)
+
+        if 'spatial' in methods and snapshot_stellar_mass > spatial_particle_mass:
+
+            try:
+                choose_parts = spatial_select(particles, halo, red_all[i], snapshot_stellar_mass, spatial_catalog['iords'], insitu, r200, i, t_all, red_all)
+            except Exception as e:
+                print('spatial selection failed:', e)
+                return
+
+            if len(choose_parts) > 0:
+
+                mstar = np.repeat(float(spatial_particle_mass), len(choose_parts))
+
+                spatial_catalog.append(choose_parts, mstar, t_all[i], red_all[i], insitu)
+
+                if spatial_writer != None:
+                    spatial_writer.append(choose_parts, mstar, t_all[i], red_all[i], insitu)
+
+    # looping over all snapshots
+    for i in range(len(outputs)):
+        gc.collect()
+
+        print('Current snapshot -->',outputs[i])
+
+        hDMO = tangos.get_halo(DMOname+'/'+outputs[i]+'/halo_'+str(halonums[i]))
+
+        simfn = join(pynbody_path,DMOname,outputs[i])
+
+        # idrz is the index of the darklight mstar value calculated at the closest time to that of the snap
+        idrz = np.argmin(abs(t - t_all[i]))
+
+        # index of previous snap's mstar value in darklight array
+        idrz_previous = np.argmin(abs(t - t_all[i-1])) if idrz>0 else None
+
+        msn = mstar_s_insitu[idrz]
+
+        if msn == 0:
+            print('There is no stellar mass at current timestep')
+            continue
+
+        msp = 0 if idrz_previous == None else mstar_s_insitu[idrz_previous]
+
+        mass_select = int(msn-msp)
+        print('stellar mass to be tagged in this snap -->',mass_select)
+
+        if mass_select>0:
+
+            try:
+                if extract_dir != None:
+                    # the extract is already centred on the halo
+                    DMOparticles = load_extract(extract_dir,outputs[i],halonums[i])
+                    DMOparticles_insitu_only = DMOparticles.within(DMOparticles.r200)
+
+                else:
+                    # loaded once and shared by every method (and the merger branch below) through the snapshot cache
+                    DMOparticles = load_halo_snapshot(simfn, hDMO)
+
+                    # halo catalogues index the full box, so on region snapshots the halo is cut out around the tangos centre
+                    h = region_halo(DMOparticles, hDMO) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(halonums[i])-1]
+
+                    pynbody.analysis.halo.center(h)
+
+                    r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')
+
+                    DMOparticles_insitu_only = DMOparticles.d[sqrt(DMOparticles.d['pos'][:,0]**2 + DMOparticles.d['pos'][:,1]**2 + DMOparticles.d['pos'][:,2]**2) <= r200c_pyn]
+
+            except Exception as e:
+                print(e)
+                print('--> DMO particle data exists but failed to read it, skipping!')
+                DMOparticles_insitu_only = None
+
+            if DMOparticles_insitu_only is not None:
+
+                tag_halo(DMOparticles_insitu_only, hDMO, mass_select, hDMO['r200c'], 'insitu', i)
+
+                del DMOparticles_insitu_only
+
+        # check whether halos have merged by the next snapshot, in which case they are tagged in the current one
+        if (((i+1 < len(outputs)) and (mergers == True)) and (len(merger_index.at_output(outputs[i+1])) > 0)):
+
+            for merger in merger_index.at_output(outputs[i+1]):
+                gc.collect()
+                hDM = merger_index.halo(merger)
+                print('halo:',hDM)
+
+                try:
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,DMO=True,n=config.get("darklight","n"),mergers=True)
+
+                except Exception as e:
+                    print(e)
+                    print('there are no darklight stars')
+                    continue
+
+                if len(mstar_merging)==0 or int(mstar_merging[-1])<1:
+                    print("halo has not yet formed stars")
+                    continue
+
+                mass_select_merge = mstar_merging[-1]
+
+                print("tagging accreted Mstar = ",mass_select_merge)
+
+                try:
+                    if extract_dir != None:
+                        # the extract is already centred on the merging halo
+                        DMOparticles = load_extract(extract_dir,outputs[i],hDM.calculate('halo_number()'))
+                        DMOparticles_acc_only = DMOparticles.within(DMOparticles.r200)
+
+                    else:
+                        # a cache hit if the insitu step already loaded this snapshot
+                        DMOparticles = load_halo_snapshot(simfn, hDM)
+
+                        h_merge = region_halo(DMOparticles, hDM) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
+
+                        pynbody.analysis.halo.center(h_merge.dm)
+
+                        r200c_pyn_acc = pynbody.analysis.halo.virial_radius(h_merge.d, overden=200, r_max=None, rho_def='critical')
+
+                        DMOparticles_acc_only = DMOparticles.d[sqrt(DMOparticles.d['pos'][:,0]**2 + DMOparticles.d['pos'][:,1]**2 + DMOparticles.d['pos'][:,2]**2) <= r200c_pyn_acc]
+
+                    r200_merge = hDM['r200c']
+
+                except Exception as ex:
+                    print('centering data unavailable, skipping',ex)
+                    continue
+
+                tag_halo(DMOparticles_acc_only, hDM, mass_select_merge, r200_merge, 'accreted', i)
+
+                del DMOparticles_acc_only
+
+        print("Done with iteration",i)
+
+    for sweep in sweeps.values():
+        sweep.close()
+
+    if spatial_writer != None:
+        spatial_writer.close()
+
+    df_tagged = OrderedDict()
+
+    for method in methods:
+        df_tagged[method] = spatial_catalog.to_dataframe() if method == 'spatial' else sweeps[method].to_dataframes()
+
+    return df_tagged
@@ -0,0 +1,273 @@
+
+import random
+import resource
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tangos
+
+from .snapshot_cache import set_snapshot_cache_budget
+from .halo_registry import TaggedHaloRegistry
+from ...config import config
+
+
+def worker_settings(processes=None, memory_per_worker_gb=None):
+
+    '''
+
+    Returns the number of worker processes and the memory cap (GB) of each, taking the "parallel" section of
+    config.json for the ones not given.
+
+    '''
+
+    if processes == None:
+        processes = config.get("parallel", "processes", 1)
+
+    if memory_per_worker_gb == None:
+        memory_per_worker_gb = config.get("parallel", "memory_per_worker_gb", 0)
+
+    return int(processes), float(memory_per_worker_gb)
+
+
+def limit_worker_memory(memory_gb):
+
+    '''
+
+    Initialiser of the worker processes: caps the address space of the process at memory_gb (a worker that goes
+    over it gets a MemoryError rather than taking the node down) and gives the worker's snapshot cache half of it.
+    memory_gb <= 0 leaves the worker unlimited.
+
+    '''
+
+    if memory_gb <= 0:
+        return
+
+    nbytes = int(memory_gb * 1024**3)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    resource.setrlimit(resource.RLIMIT_AS, (nbytes if hard == resource.RLIM_INFINITY else min(nbytes, hard), hard))
+
+    set_snapshot_cache_budget(memory_gb/2.)
+
+
+def process_pool(processes=None, memory_per_worker_gb=None):
+
+    '''
+
+    Inputs:
+
+    processes - number of worker processes (defaults to the "parallel" section of config.json)
+    memory_per_worker_gb - memory cap of each worker in GB (0 for no cap, defaults to config)
+
+    Returns:
+
+    a concurrent.futures.ProcessPoolExecutor whose workers have their memory capped (see limit_worker_memory).
+    Every worker loads the snapshots it needs into its own snapshot cache.
+
+    '''
+
+    processes, memory_per_worker_gb = worker_settings(processes, memory_per_worker_gb)
+
+    return ProcessPoolExecutor(max_workers=processes, initializer=limit_worker_memory, initargs=(memory_per_worker_gb,))
+
+
+def subtree_seed(task):
+
+    '''
+
+    Returns the random seed of a submitted subtree (see SubtreePool.submit), or for subtrees recorded without one
+    (checkpoints written before seeds were stored) a seed derived from the tangos path of the halo
+
+    '''
+
+    if task.get('seed') != None:
+        return int(task['seed'])
+
+    return zlib.crc32(task['path'].encode())
+
+
+def seed_random_state(seed):
+
+    # the occupation draws of the recursive taggers use both np.random and random
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def tag_subtree_in_worker(recursive_tagger, simname, tstep, halonumber, acc_halo_path_tagged, kwargs, seed):
+
+    '''
+
+    Runs recursive_tagger (BE_tag_over_full_sim_recursive or angmom_tag_over_full_sim_recursive) over the full
+    lifetime of one accreted halo and its own mergers, in a worker process and starting from an empty catalog.
+    The tangos simulation is looked up again by name, since tangos objects are not passed between processes.
+    The random state is seeded with the seed of the subtree, as forked workers all start from the same state.
+
+    Returns:
+
+    the TaggedCatalog of the subtree and its TaggedHaloRegistry (the halos it tagged and skipped)
+
+    '''
+
+    seed_random_state(seed)
+
+    return recursive_tagger(tangos.get_simulation(simname), tstep, halonumber, df_tagged_particles=None, acc_halo_path_tagged=TaggedHaloRegistry.from_dict(acc_halo_path_tagged),
+                            tag_typ='accreted', return_catalog=True, processes=1, **kwargs)
+
+
+class SubtreePool:
+
+    '''
+
+    Accreted halo subtrees of a recursive tagging run, tagged as independent tasks on a process pool.
+
+    Halos merging into separate branches of the merger tree have disjoint histories, so the recursive taggers
+    hand each accreted halo that has not been tagged yet to a worker (submit) instead of recursing into it, and a
+    halo with dozens of accreted progenitors takes as long as its longest branch rather than the sum of them.
+    A halo is claimed when it is submitted, so it is never tagged twice, and merge() appends the results in
+    the order they were submitted, so the tagged particles come out in the same order on every run. Each subtree
+    is given its own random seed, drawn from the calling process's np.random state when it is submitted, so its
+    occupation draws do not depend on which worker runs it (and follow np.random.seed set before the run).
+
+    '''
+
+    def __init__(self, processes=None, memory_per_worker_gb=None):
+
+        self.pool = process_pool(processes, memory_per_worker_gb)
+
+        # (tangos path of the accreted halo, future) in submission order
+        self.tasks = []
+
+        # what was submitted, so the subtrees can be submitted again when resuming from a checkpoint
+        self.submitted = []
+
+    def __len__(self):
+        return len(self.tasks)
+
+    @property
+    def claimed(self):
+        return [path for path, task in self.tasks]
+
+    def is_tagged(self, acc_halo_path, acc_halo_path_tagged):
+
+        '''
+
+        Returns True if any of acc_halo_path (the progenitor paths of a merging halo) has been tagged (is in the
+        TaggedHaloRegistry acc_halo_path_tagged) or submitted already
+
+        '''
+
+        claimed = set(self.claimed)
+
+        return acc_halo_path_tagged.any_tagged(acc_halo_path) or any(str(path) in claimed for path in acc_halo_path)
+
+    def submit(self, recursive_tagger, DMOsim, tstep, halonumber, acc_halo_path, acc_halo_path_tagged, **kwargs):
+
+        '''
+
+        Inputs:
+
+        recursive_tagger - module level recursive tagging function to run
+        DMOsim - tangos simulation
+        tstep, halonumber - timestep index and halo number of the accreted halo (as passed to recursive_tagger)
+        acc_halo_path - progenitor paths of the accreted halo (the first one is claimed)
+        acc_halo_path_tagged - TaggedHaloRegistry of the calling tagger
+        kwargs - remaining keyword arguments of recursive_tagger
+
+        '''
+
+        # the subtree sees the halos submitted before it, as it would have in the serial recursion
+        # (but not its own path, or it would return straight away)
+        tagged_so_far = acc_halo_path_tagged.copy().update(self.claimed).to_dict()
+
+        seed = int(np.random.randint(0, 2**32, dtype=np.uint64))
+
+        self.tasks.append((str(acc_halo_path[0]), self.pool.submit(tag_subtree_in_worker, recursive_tagger, DMOsim.path, tstep, halonumber, tagged_so_far, kwargs, seed)))
+
+        self.submitted.append({'path':str(acc_halo_path[0]), 'tstep':int(tstep), 'halonumber':int(halonumber),
+                               'acc_halo_path_tagged':tagged_so_far, 'kwargs':kwargs, 'seed':seed})
+
+    def resubmit(self, recursive_tagger, DMOsim, submitted):
+
+        '''
+
+        Submits the subtrees of a checkpoint again (submitted as recorded by self.submitted), in their original order
+
+        '''
+
+        for task in submitted:
+
+            self.tasks.append((task['path'], self.pool.submit(tag_subtree_in_worker, recursive_tagger, DMOsim.path, task['tstep'], task['halonumber'], task['acc_halo_path_tagged'], task['kwargs'], subtree_seed(task))))
+
+            self.submitted.append(task)
+
+    def merge(self, df_tagged_particles, acc_halo_path_tagged):
+
+        '''
+
+        Waits for the submitted subtrees and appends their particles to df_tagged_particles (a TaggedCatalog)
+        in submission order. Subtrees that failed are reported and skipped.
+
+        Returns:
+
+        df_tagged_particles and acc_halo_path_tagged (TaggedHaloRegistry) including the halos tagged and
+        skipped by the subtrees
+
+        '''
+
+        for path, task in self.tasks:
+
+            try:
+                catalog, subtree_registry = task.result()
+            except Exception as e:
+                print(e)
+                print('--> tagging the subtree of',path,'failed in the worker process, skipping!')
+                continue
+
+            df_tagged_particles.append(catalog['iords'], catalog['mstar'], catalog['t'], catalog['z'], catalog['type'])
+
+            acc_halo_path_tagged.update(subtree_registry)
+
+            print('merged subtree of',path,':',len(catalog),'particles')
+
+        self.tasks = []
+        self.submitted = []
+
+        self.pool.shutdown()
+
+        return df_tagged_particles, acc_halo_path_tagged
+
+
+def resume_subtrees(subtrees, recursive_tagger, DMOsim, submitted, df_tagged_particles, acc_halo_path_tagged):
+
+    '''
+
+    Tags the accreted subtrees that had been handed to worker processes but not merged when a checkpoint was
+    saved (see checkpoint.TaggingCheckpoint): submitted again to subtrees, or, in a serial run (subtrees None),
+    tagged here one after the other.
+
+    Returns:
+
+    df_tagged_particles and acc_halo_path_tagged
+
+    '''
+
+    if subtrees != None:
+        subtrees.resubmit(recursive_tagger, DMOsim, submitted)
+        return df_tagged_particles, acc_halo_path_tagged
+
+    # each subtree draws from its own seed, as it would have in a worker, and the state of this run is put back after
+    np_state, py_state = np.random.get_state(), random.getstate()
+
+    for task in submitted:
+
+        seed_random_state(subtree_seed(task))
+
+        df_tagged_particles, acc_halo_path_tagged = recursive_tagger(DMOsim, task['tstep'], task['halonumber'], df_tagged_particles=df_tagged_particles, acc_halo_path_tagged=acc_halo_path_tagged,
+                                                                     tag_typ='accreted', return_catalog=True, processes=1, **task['kwargs'])
+
+    np.random.set_state(np_state)
+    random.setstate(py_state)
+
+    return df_tagged_particles, acc_halo_path_tagged
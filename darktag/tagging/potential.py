@@ -0,0 +1,484 @@
+
+import numpy as np
+import pynbody
+
+
+# gravitational constant in kpc (km/s)^2 Msol^-1, so potentials come out in km^2 s^-2
+G_constant = 4.30091e-6
+
+# levels of the octree (morton keys hold 3 bits per level in a 64 bit integer)
+octree_depth = 21
+
+# bound on the number of (target, node) / (target, particle) pairs held in memory at once
+max_pairs = 2**24
+
+
+def _spread_bits(v):
+
+    # spreads the lower 21 bits of v out so that there are two zero bits between each of them
+    v = v.astype(np.uint64) & np.uint64(0x1fffff)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+
+    return v
+
+
+def morton_keys(cells):
+
+    '''
+
+    Returns the morton (z-order) keys of integer cell coordinates (N x 3, each < 2**octree_depth).
+    Sorting by key groups the particles of every octree node together.
+
+    '''
+
+    return (_spread_bits(cells[:, 0]) << np.uint64(2)) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | _spread_bits(cells[:, 2])
+
+
+class Octree:
+
+    '''
+
+    Barnes-Hut octree of a set of particles.
+
+    The particles are sorted by morton key so that every node holds a contiguous range [start, end) of them, and
+    the tree is built a level at a time: nodes with more than leaf_size particles are split into their (non-empty)
+    octants, stored next to each other from first_child on. Each node carries the mass and centre of mass of its
+    particles, and the distance beyond which its monopole can stand in for them (open_dist, see potential).
+
+    '''
+
+    def __init__(self, pos, mass, leaf_size=16, opening_angle=0.7):
+
+        '''
+
+        Inputs:
+
+        pos - particle positions (N x 3, kpc)
+        mass - particle masses (N, Msol)
+        leaf_size - nodes with at most this many particles are not split
+        opening_angle - Barnes-Hut opening angle theta (smaller is more accurate and slower)
+
+        '''
+
+        pos = np.asarray(pos, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+
+        self.opening_angle = float(opening_angle)
+        self.leaf_size = int(leaf_size)
+
+        lo = pos.min(axis=0)
+        box_size = max(float((pos.max(axis=0) - lo).max()), 1e-10)*(1 + 1e-6)
+
+        n_cells = 2**octree_depth
+
+        cells = np.clip(((pos - lo)/box_size*n_cells).astype(np.int64), 0, n_cells-1)
+
+        keys = morton_keys(cells)
+
+        self.order = np.argsort(keys, kind='stable')
+
+        keys = keys[self.order]
+        cells = cells[self.order]
+
+        self.pos = pos[self.order]
+        self.mass = mass[self.order]
+
+        starts, ends, levels, first_child, n_children = [np.array([0])], [np.array([len(pos)])], [np.array([0])], [], []
+
+        prefixes = np.zeros(1, dtype=np.uint64)
+
+        n_nodes = 1
+
+        for level in range(octree_depth + 1):
+
+            start, end = starts[-1], ends[-1]
+
+            split = ((end - start) > self.leaf_size) & (level < octree_depth)
+
+            first = np.zeros(len(start), dtype=np.int64)
+            count = np.zeros(len(start), dtype=np.int64)
+
+            if not np.any(split):
+                first_child.append(first)
+                n_children.append(count)
+                break
+
+            # key boundaries of the 8 octants of every node that is split
+            shift = np.uint64(3*(octree_depth - level - 1))
+
+            octants = prefixes[split][:, None]*np.uint64(8) + np.arange(9, dtype=np.uint64)[None, :]
+
+            bounds = np.searchsorted(keys, octants << shift)
+
+            # the last octant of a node ends where the node does
+            bounds[:, 8] = end[split]
+
+            child_start, child_end = bounds[:, :8], bounds[:, 1:]
+
+            non_empty = child_end > child_start
+
+            count[split] = non_empty.sum(axis=1)
+            first[split] = n_nodes + np.cumsum(count[split]) - count[split]
+
+            first_child.append(first)
+            n_children.append(count)
+
+            prefixes = np.broadcast_to(octants[:, :8], non_empty.shape)[non_empty]
+
+            starts.append(child_start[non_empty])
+            ends.append(child_end[non_empty])
+            levels.append(np.repeat(level + 1, non_empty.sum()))
+
+            n_nodes += int(non_empty.sum())
+
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.level = np.concatenate(levels)
+        self.first_child = np.concatenate(first_child)
+        self.n_children = np.concatenate(n_children)
+
+        # node masses and centres of mass from cumulative sums over the sorted particles
+        cumulative_mass = np.concatenate([[0.], np.cumsum(self.mass)])
+        cumulative_moment = np.concatenate([np.zeros((1, 3)), np.cumsum(self.pos*self.mass[:, None], axis=0)])
+
+        self.node_mass = cumulative_mass[self.end] - cumulative_mass[self.start]
+
+        self.com = (cumulative_moment[self.end] - cumulative_moment[self.start])/np.where(self.node_mass > 0, self.node_mass, 1.)[:, None]
+
+        self.size = box_size/2.**self.level
+
+        # geometric centre of each node's cell (from the cell of its first particle)
+        node_cells = cells[self.start] >> (octree_depth - self.level)[:, None]
+        centre = lo + (node_cells + 0.5)*self.size[:, None]
+
+        # a node is not opened for targets further than size/theta from its centre of mass, plus the offset of
+        # the centre of mass from the centre of the cell (so a target inside the cell always opens it)
+        self.open_dist = self.size/self.opening_angle + np.sqrt(((self.com - centre)**2).sum(axis=1))
+
+    def __len__(self):
+        return len(self.start)
+
+    def __repr__(self):
+        return '<Octree '+str(len(self.pos))+' particles, '+str(len(self))+' nodes>'
+
+    def potential(self, targets=None, eps=0.01):
+
+        '''
+
+        Inputs:
+
+        targets - indices (into the original particle arrays) of the particles to calculate the potential at
+                  (defaults to all of them)
+        eps - Plummer softening length (kpc)
+
+        Returns:
+
+        the potential (km^2 s^-2) at the targets due to all the particles, leaving out each target's own mass
+
+        '''
+
+        n = len(self.pos)
+
+        targets = np.arange(n) if type(targets) == type(None) else np.asarray(targets, dtype=np.int64)
+
+        # position of each target in the sorted order, used to leave out its own contribution
+        rank = np.empty(n, dtype=np.int64)
+        rank[self.order] = np.arange(n)
+
+        # walking the targets in the sorted order keeps each chunk compact in space
+        target_order = np.argsort(rank[targets], kind='stable')
+
+        target_rank = rank[targets][target_order]
+
+        eps2 = float(eps)**2
+
+        phi = np.zeros(len(targets))
+
+        # the walk handles the targets a chunk at a time to bound the number of pairs in memory
+        chunk = max(1, min(len(targets), max_pairs//max(64, 8*int(np.log2(max(n, 2)))*self.leaf_size)))
+
+        for c in range(0, len(targets), chunk):
+
+            t_pos = self.pos[target_rank[c:c+chunk]]
+            t_rank = target_rank[c:c+chunk]
+
+            phi_chunk = np.zeros(len(t_pos))
+
+            # (target, node) pairs still to be resolved, starting from the root
+            p = np.arange(len(t_pos))
+            node = np.zeros(len(t_pos), dtype=np.int64)
+
+            while len(p) > 0:
+
+                d2 = ((t_pos[p] - self.com[node])**2).sum(axis=1)
+
+                accept = d2 > self.open_dist[node]**2
+
+                phi_chunk -= np.bincount(p[accept], weights=self.node_mass[node[accept]]/np.sqrt(d2[accept] + eps2), minlength=len(t_pos))
+
+                opened = ~accept
+
+                leaf = opened & (self.n_children[node] == 0)
+
+                # leaves that are too close are summed directly, particle by particle
+                leaf_p, leaf_node = p[leaf], node[leaf]
+
+                counts = self.end[leaf_node] - self.start[leaf_node]
+
+                pair_p = np.repeat(leaf_p, counts)
+                pair_j = np.repeat(self.start[leaf_node] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+                pair_d2 = ((t_pos[pair_p] - self.pos[pair_j])**2).sum(axis=1)
+
+                contribution = self.mass[pair_j]/np.sqrt(pair_d2 + eps2)
+                contribution[pair_j == t_rank[pair_p]] = 0.
+
+                phi_chunk -= np.bincount(pair_p, weights=contribution, minlength=len(t_pos))
+
+                # every other opened node hands its targets on to its children
+                inner = opened & ~leaf
+
+                inner_p, inner_node = p[inner], node[inner]
+
+                counts = self.n_children[inner_node]
+
+                p = np.repeat(inner_p, counts)
+                node = np.repeat(self.first_child[inner_node] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+            phi[target_order[c:c+chunk]] = phi_chunk
+
+        return G_constant*phi
+
+
+def direct_potential(pos, mass, targets=None, eps=0.01):
+
+    '''
+
+    Inputs:
+
+    pos - particle positions (N x 3, kpc)
+    mass - particle masses (N, Msol)
+    targets - indices of the particles to calculate the potential at (defaults to all of them)
+    eps - Plummer softening length (kpc)
+
+    Returns:
+
+    the potential (km^2 s^-2) at the targets by direct summation over all particles (O(N) per target),
+    leaving out each target's own mass
+
+    '''
+
+    pos = np.asarray(pos, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64)
+
+    targets = np.arange(len(pos)) if type(targets) == type(None) else np.asarray(targets, dtype=np.int64)
+
+    eps2 = float(eps)**2
+
+    phi = np.zeros(len(targets))
+
+    chunk = max(1, max_pairs//max(len(pos), 1))
+
+    for c in range(0, len(targets), chunk):
+
+        t = targets[c:c+chunk]
+
+        d2 = ((pos[t][:, None, :] - pos[None, :, :])**2).sum(axis=2)
+
+        inverse_distance = 1./np.sqrt(d2 + eps2)
+        inverse_distance[np.arange(len(t)), t] = 0.
+
+        phi[c:c+chunk] = -(inverse_distance*mass[None, :]).sum(axis=1)
+
+    return G_constant*phi
+
+
+def shell_potential(pos, mass, eps=0.01):
+
+    '''
+
+    Inputs:
+
+    pos - particle positions (N x 3, kpc) relative to the halo centre
+    mass - particle masses (N, Msol)
+    eps - softening length (kpc)
+
+    Returns:
+
+    the potential (km^2 s^-2) of each particle treating the halo as spherical: the mass inside its radius acts
+    as a point at the centre and every particle further out as a shell, -G (M(<r)/r + sum_{r_j>r} m_j/r_j).
+    Only needs the particles sorted by radius (O(N log N)).
+
+    '''
+
+    pos = np.asarray(pos, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64)
+
+    r = np.sqrt(np.einsum('ij,ij->i', pos, pos) + float(eps)**2)
+
+    order = np.argsort(r)
+
+    r_sorted, m_sorted = r[order], mass[order]
+
+    # mass inside each particle's radius (not counting itself)
+    enclosed_mass = np.cumsum(m_sorted) - m_sorted
+
+    # contribution of the shells further out (not counting itself)
+    shells = m_sorted/r_sorted
+    outer_shells = np.cumsum(shells[::-1])[::-1] - shells
+
+    phi = np.empty(len(r))
+    phi[order] = -(enclosed_mass/r_sorted + outer_shells)
+
+    return G_constant*phi
+
+
+def spearman_rank_correlation(a, b):
+
+    # Pearson correlation of the ranks of a and b
+    rank_a = np.empty(len(a))
+    rank_a[np.argsort(a)] = np.arange(len(a))
+
+    rank_b = np.empty(len(b))
+    rank_b[np.argsort(b)] = np.arange(len(b))
+
+    return float(np.corrcoef(rank_a, rank_b)[0, 1]) if len(a) > 1 else 1.
+
+
+def potential_rank_agreement(pos, mass, kinetic_energy, potential, tagging_fraction=0.01, n_sample=1000, eps=0.01, seed=0):
+
+    '''
+
+    Compares the binding energy ranking given by an approximate potential with the one from direct summation,
+    on a random subsample of the particles.
+
+    Inputs:
+
+    pos, mass - particle positions (kpc) and masses (Msol)
+    kinetic_energy - specific kinetic energy of each particle (km^2 s^-2)
+    potential - the (approximate) potential (km^2 s^-2) of every particle
+    tagging_fraction - fraction of the most bound particles whose selection is compared
+    n_sample - number of particles the direct summation is done for
+    eps - softening length (kpc) of the direct summation
+
+    Returns:
+
+    dictionary with the number of particles checked, the Spearman correlation of the two energy rankings of the
+    sample, and the fraction of the int(n_sample*tagging_fraction) most bound particles of the sample that both select
+
+    '''
+
+    sample = np.random.default_rng(seed).choice(len(pos), size=min(int(n_sample), len(pos)), replace=False)
+
+    kinetic_energy = np.asarray(kinetic_energy)[sample]
+
+    exact_energy = direct_potential(pos, mass, targets=sample, eps=eps) + kinetic_energy
+    approximate_energy = np.asarray(potential)[sample] + kinetic_energy
+
+    n_top = max(1, int(len(sample)*tagging_fraction))
+
+    selected_exact = np.argsort(exact_energy)[:n_top]
+    selected_approximate = np.argsort(approximate_energy)[:n_top]
+
+    return {'n_sample':len(sample),
+            'spearman':spearman_rank_correlation(exact_energy, approximate_energy),
+            'top_overlap':len(np.intersect1d(selected_exact, selected_approximate))/float(n_top)}
+
+
+def potential_error(pos, mass, potential, n_sample=1000, eps=0.01, seed=0):
+
+    '''
+
+    Compares a potential against direct summation on a random subsample of the particles.
+
+    Inputs:
+
+    pos, mass - particle positions (kpc) and masses (Msol)
+    potential - the potential (km^2 s^-2) of every particle to check
+    n_sample - number of particles the direct summation is done for
+    eps - softening length (kpc) the potential was calculated with
+
+    Returns:
+
+    dictionary with the number of particles checked and the median, 99th percentile and maximum of |dphi/phi|
+
+    '''
+
+    sample = np.random.default_rng(seed).choice(len(pos), size=min(int(n_sample), len(pos)), replace=False)
+
+    exact = direct_potential(pos, mass, targets=sample, eps=eps)
+
+    relative_error = np.abs(np.asarray(potential)[sample] - exact)/np.abs(exact)
+
+    return {'n_sample':len(sample),
+            'median':float(np.median(relative_error)),
+            'p99':float(np.percentile(relative_error, 99)),
+            'max':float(relative_error.max())}
+
+
+def _pynbody_direct(particles, eps):
+
+    softening_length = pynbody.array.SimArray(np.ones(len(particles))*eps, units='kpc', sim=None)
+
+    calculated_potentials, calculated_force = pynbody.gravity.direct(particles, np.asarray(particles['pos']), eps=softening_length)
+
+    return calculated_potentials.in_units('km**2 s**-2')
+
+
+def _tree(particles, eps, opening_angle=0.7, leaf_size=16):
+
+    pos = np.asarray(particles['pos'].in_units('kpc'))
+    mass = np.asarray(particles['mass'].in_units('Msol'))
+
+    return pynbody.array.SimArray(Octree(pos, mass, leaf_size=leaf_size, opening_angle=opening_angle).potential(eps=eps), 'km**2 s**-2')
+
+
+def _shell(particles, eps):
+
+    pos = np.asarray(particles['pos'].in_units('kpc'))
+    mass = np.asarray(particles['mass'].in_units('Msol'))
+
+    return pynbody.array.SimArray(shell_potential(pos, mass, eps=eps), 'km**2 s**-2')
+
+
+# potential engines available to calculate_potential (and the binding energy tagger)
+potential_backends = {'direct':_pynbody_direct, 'tree':_tree, 'shell':_shell}
+
+
+def calculate_potential(particles, method='direct', eps=0.01, error_sample=None, **backend_kwargs):
+
+    '''
+
+    Inputs:
+
+    particles - particles (pynbody snapshot or HaloExtract) to calculate the potential of, due to themselves
+    method - one of potential_backends: 'direct' (pynbody.gravity.direct, O(N^2)), 'tree' (Barnes-Hut octree,
+             O(N log N), see Octree; pass opening_angle / leaf_size to tune it) or 'shell' (spherical approximation
+             from the radial mass profile, O(N log N), see shell_potential; particles must be centred on the halo)
+    eps - softening length (kpc)
+    error_sample - if given, the result is checked against direct summation on this many particles
+                   and the error printed (see potential_error)
+
+    Returns:
+
+    SimArray of the potential of each particle in km^2 s^-2
+
+    '''
+
+    if method not in potential_backends:
+        raise ValueError('unknown potential method '+str(method)+', choose from '+str(list(potential_backends)))
+
+    potential = potential_backends[method](particles, eps, **backend_kwargs)
+
+    if error_sample != None and method != 'direct':
+
+        errors = potential_error(np.asarray(particles['pos'].in_units('kpc')), np.asarray(particles['mass'].in_units('Msol')), potential, n_sample=error_sample, eps=eps)
+
+        print('potential ('+method+') error against direct summation over', errors['n_sample'], 'particles: median',
+              errors['median'], '99th percentile', errors['p99'], 'max', errors['max'])
+
+    return potential
@@ -0,0 +1,333 @@
+
+import os
+import json
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+import pynbody
+import tangos
+from tangos.examples.mergers import *
+
+from .potential import calculate_potential
+from .snapshot_cache import load_halo_snapshot, is_region_snapshot, region_halo, snapshot_cache
+from .extract import load_extract
+from .parallel import process_pool
+from ...config import config
+
+
+def potential_filename(pe_dir, output, halonumber):
+
+    '''
+
+    Returns the path (without extension) of the stored potentials of halo number halonumber at the given output.
+    The particle IDs (sorted) are stored in <path>.iord.npy, their potentials in <path>.potential.npy and
+    how they were calculated in <path>.json
+
+    '''
+
+    return join(str(pe_dir), str(output), 'halo_'+str(int(halonumber)))
+
+
+def has_halo_potential(pe_dir, output, halonumber):
+    return os.path.exists(potential_filename(pe_dir, output, halonumber)+'.potential.npy')
+
+
+class HaloPotential:
+
+    '''
+
+    Potentials of the particles of one halo at one output, read back from the store written by
+    compute_halo_potentials. The arrays are memory-mapped and sorted by particle ID, so looking up
+    the potentials of a set of particles reads only the pages it needs.
+
+    '''
+
+    def __init__(self, iord, potential, meta):
+
+        self.iord = iord
+        self.potential = potential
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.iord)
+
+    def __repr__(self):
+        return '<HaloPotential '+str(self.meta.get('output'))+' halo_'+str(self.meta.get('halonumber'))+' len='+str(len(self))+'>'
+
+    def lookup(self, iords):
+
+        '''
+
+        Inputs:
+
+        iords - particle IDs
+
+        Returns:
+
+        SimArray of their potentials (km^2 s^-2), or None if any of them is not in the store
+
+        '''
+
+        iords = np.asarray(iords, dtype=np.int64)
+
+        if len(self.iord) == 0:
+            return None if len(iords) > 0 else pynbody.array.SimArray(np.array([]), 'km**2 s**-2')
+
+        # binary search of the sorted IDs
+        idx = np.minimum(np.searchsorted(self.iord, iords), len(self.iord) - 1)
+
+        if not np.all(self.iord[idx] == iords):
+            return None
+
+        return pynbody.array.SimArray(np.asarray(self.potential[idx], dtype=np.float64), 'km**2 s**-2')
+
+
+def load_halo_potential(filename, mmap=True):
+
+    '''
+
+    Inputs:
+
+    filename - path of the stored potentials without extension (see potential_filename)
+    mmap - memory-map the arrays rather than reading them in
+
+    Returns:
+
+    HaloPotential (raises FileNotFoundError if the potentials were not stored)
+
+    '''
+
+    with open(filename+'.json') as f:
+        meta = json.load(f)
+
+    mmap_mode = 'r' if mmap else None
+
+    return HaloPotential(np.load(filename+'.iord.npy', mmap_mode=mmap_mode), np.load(filename+'.potential.npy', mmap_mode=mmap_mode), meta)
+
+
+def write_halo_potential(filename, iords, potential, **properties):
+
+    '''
+
+    Writes the potentials of one halo, sorted by particle ID.
+
+    Inputs:
+
+    filename - output path without extension (see potential_filename)
+    iords - particle IDs
+    potential - their potentials (SimArray, or km^2 s^-2)
+    properties - additional entries for the json file (output, halonumber, method ...)
+
+    Returns:
+
+    the properties written to the json file
+
+    '''
+
+    iords = np.asarray(iords, dtype=np.int64)
+
+    potential = np.asarray(potential.in_units('km**2 s**-2') if isinstance(potential, pynbody.array.SimArray) else potential, dtype=np.float64)
+
+    order = np.argsort(iords)
+
+    meta = dict(properties)
+    meta['n_particles'] = len(iords)
+    meta['units'] = 'km**2 s**-2'
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    np.save(filename+'.iord.npy', iords[order])
+    np.save(filename+'.potential.npy', potential[order])
+
+    # the json file is written last, so a store interrupted mid-write is not picked up
+    with open(filename+'.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return meta
+
+
+def halos_needing_potentials(halo, mergers=True, recursive=False, paths=None):
+
+    '''
+
+    Inputs:
+
+    halo - tangos halo object (the main halo at the final timestep)
+    mergers - include the halos merging into its main progenitor branch (at the output before each merger,
+              where the taggers rank their particles)
+    recursive - also include the full main progenitor branches of the merging halos (and their mergers),
+                as tagged by BE_tag_over_full_sim_recursive
+
+    Returns:
+
+    ordered dictionary of output -> list of tangos paths of the halos at that output
+
+    '''
+
+    paths = OrderedDict() if paths == None else paths
+
+    for path in halo.calculate_for_progenitors('path()')[0][::-1]:
+        paths.setdefault(str(path), None)
+
+    if mergers == True:
+
+        zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(halo)
+
+        for merging_halos in hmerge:
+            for hDM in merging_halos[1:]:
+
+                if recursive == True and str(hDM.path) not in paths:
+                    halos_needing_potentials(hDM, mergers=mergers, recursive=recursive, paths=paths)
+
+                paths.setdefault(str(hDM.path), None)
+
+    by_output = OrderedDict()
+
+    for path in paths:
+        by_output.setdefault(path.split('/')[-2], []).append(path)
+
+    return by_output
+
+
+def compute_output_potentials(simfn, output, halo_paths, pe_dir, method='direct', eps=0.01, extract_dir=None, overwrite=False, backend_kwargs=None):
+
+    '''
+
+    Computes and stores the potentials of the particles within r200c of each of the given halos at one output
+    (the particles and r200c used by rank_order_particles_by_BE), loading the snapshot once.
+
+    Inputs:
+
+    simfn - path to the simulation output
+    output - name of the output
+    halo_paths - tangos paths of the halos at this output
+    pe_dir - directory of the potential store
+    method, eps, backend_kwargs - potential engine and softening length (see potential.calculate_potential)
+    extract_dir - if given, particles are read from the halo extracts written by extract_halo_regions
+    overwrite - recompute potentials that are already stored
+
+    Returns:
+
+    list of the properties (as written to the json files) of every halo stored
+
+    '''
+
+    backend_kwargs = {} if backend_kwargs == None else backend_kwargs
+
+    stored = []
+
+    for path in halo_paths:
+
+        halonumber = int(path.split('/')[-1].split('_')[-1])
+
+        filename = potential_filename(pe_dir, output, halonumber)
+
+        if overwrite == False and has_halo_potential(pe_dir, output, halonumber):
+            continue
+
+        try:
+            hDMO = tangos.get_halo(path)
+
+            if extract_dir != None:
+                # the extract is already centred on the halo
+                particles = load_extract(extract_dir, output, halonumber)
+
+            else:
+                DMOparticles = load_halo_snapshot(simfn, hDMO)
+
+                h = region_halo(DMOparticles, hDMO) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[halonumber-1]
+
+                pynbody.analysis.halo.center(h)
+
+                particles = DMOparticles.d
+
+            particles_r200 = particles[particles['r'] < hDMO['r200c']]
+
+            potential = calculate_potential(particles_r200, method=method, eps=eps, **backend_kwargs)
+
+            meta = write_halo_potential(filename, particles_r200['iord'], potential, output=str(output), halonumber=halonumber,
+                                        method=method, eps=eps, r200c=float(hDMO['r200c']))
+
+        except Exception as e:
+            print('could not calculate the potential of', path, e)
+            continue
+
+        print('stored potentials of', path, meta['n_particles'], 'particles')
+
+        stored.append(meta)
+
+    return stored
+
+
+def _compute_output_potentials_in_worker(args):
+
+    simfn = args[0]
+
+    try:
+        return compute_output_potentials(*args)
+
+    finally:
+        # each worker handles one output at a time, so its snapshot is not needed again
+        snapshot_cache.discard(simfn)
+
+
+def compute_halo_potentials(DMOsim, halonumber=1, pe_dir=None, method='direct', eps=0.01, pynbody_path=None, extract_dir=None, mergers=True, recursive=False, processes=1, overwrite=False, **backend_kwargs):
+
+    '''
+
+    Computes the potentials of the particles of the main halo at every output, and of the halos merging into it,
+    and stores them in pe_dir (memory-mapped arrays sorted by particle ID, see potential_filename). Given this
+    directory as PE_file, the binding energy taggers look the potentials up instead of recomputing them, so
+    re-running them with other tagging fractions or darklight settings does not recompute gravity.
+
+    Inputs:
+
+    DMOsim - tangos simulation
+    halonumber - halonumber as passed to the binding energy tagger the potentials are for: BE_tag_over_full_sim
+                 takes the tangos halo halos[halonumber] at the final timestep, BE_tag_over_full_sim_recursive (recursive=True)
+                 halos[halonumber-1]
+    pe_dir - directory to store the potentials in (defaults to the potential_path in config.json)
+    method, eps, backend_kwargs - potential engine and softening length (see potential.calculate_potential)
+    pynbody_path - directory holding the outputs of this simulation, as passed to the binding energy taggers (which read
+                   join(pynbody_path, output)); defaults to config
+    extract_dir - if given, particles are read from the halo extracts written by extract_halo_regions
+    mergers - whether to store the potentials of the merging halos as well
+    recursive - also store the full histories of the merging halos (for BE_tag_over_full_sim_recursive)
+    processes - number of outputs processed in parallel (each worker process loads its own snapshots)
+    overwrite - recompute potentials that are already stored
+
+    Returns:
+
+    list of the properties (as written to the json files) of every halo stored
+
+    '''
+
+    if pe_dir == None:
+        pe_dir = config.get_path("potential_path")
+
+    if pynbody_path == None:
+        pynbody_path = config.get_path("pynbody_path")
+
+    # the same main halo as the tagger, so the files are keyed by the halo numbers it looks up
+    main_halo = DMOsim.timesteps[-1].halos[int(halonumber) - 1 if recursive else int(halonumber)]
+
+    # the snapshots the binding energy taggers read, so the potentials are keyed off the same particles
+    jobs = [(join(pynbody_path, output), output, halo_paths, pe_dir, method, eps, extract_dir, overwrite, backend_kwargs)
+            for output, halo_paths in halos_needing_potentials(main_halo, mergers=mergers, recursive=recursive).items()]
+
+    print('calculating potentials of', sum(len(job[2]) for job in jobs), 'halos over', len(jobs), 'outputs')
+
+    stored = []
+
+    if processes > 1:
+
+        with process_pool(processes) as pool:
+            for result in pool.map(_compute_output_potentials_in_worker, jobs):
+                stored.extend(result)
+
+    else:
+        for job in jobs:
+            stored.extend(compute_output_potentials(*job))
+
+    return stored
@@ -0,0 +1,224 @@
+
+import os
+import re
+
+import numpy as np
+
+
+# RAMSES hilbert3d state diagram: for each of the 12 curve states, the next state and the
+# hilbert digit of each of the 8 octants (octant digit = x*4 + y*2 + z).
+_state_diagram = np.array([
+     1, 2, 3, 2, 4, 5, 3, 5,
+     0, 1, 3, 2, 7, 6, 4, 5,
+     2, 6, 0, 7, 8, 8, 0, 7,
+     0, 7, 1, 6, 3, 4, 2, 5,
+     0, 9,10, 9, 1, 1,11,11,
+     0, 3, 7, 4, 1, 2, 6, 5,
+     6, 0, 6,11, 9, 0, 9, 8,
+     2, 3, 1, 0, 5, 4, 6, 7,
+    11,11, 0, 7, 5, 9, 0, 7,
+     4, 3, 5, 2, 7, 0, 6, 1,
+     4, 4, 8, 8, 0, 6,10, 6,
+     6, 5, 1, 2, 7, 4, 0, 3,
+     5, 7, 5, 3, 1, 1,11,11,
+     4, 7, 3, 0, 5, 6, 2, 1,
+     6, 1, 6,10, 9, 4, 9,10,
+     6, 7, 5, 4, 1, 0, 2, 3,
+    10, 3, 1, 1,10, 3, 5, 9,
+     2, 5, 3, 4, 1, 6, 0, 7,
+     4, 4, 8, 8, 2, 7, 2, 3,
+     2, 1, 5, 6, 3, 0, 4, 7,
+     7, 2,11, 2, 7, 5, 8, 5,
+     4, 5, 7, 6, 3, 2, 0, 1,
+    10, 3, 2, 6,10, 3, 4, 4,
+     6, 1, 7, 0, 5, 2, 4, 3]).reshape(12, 2, 8)
+
+# 1 kpc in cm (RAMSES unit_l is given in cm)
+kpc_in_cm = 3.0856775814913673e21
+
+
+def hilbert3d(x, y, z, bit_length):
+
+    '''
+
+    Inputs:
+
+    x, y, z - integer cell coordinates (arrays of the same shape) on a grid of 2**bit_length cells per side
+    bit_length - number of refinement levels of the grid
+
+    Returns:
+
+    the position of each cell along the RAMSES hilbert curve (same ordering as hilbert3d.f90)
+
+    '''
+
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    z = np.asarray(z, dtype=np.int64)
+
+    order = np.zeros(x.shape, dtype=np.int64)
+    state = np.zeros(x.shape, dtype=np.int64)
+
+    for i in range(bit_length-1, -1, -1):
+
+        sdigit = ((x >> i) & 1)*4 + ((y >> i) & 1)*2 + ((z >> i) & 1)
+
+        hdigit = _state_diagram[state, 1, sdigit]
+        state = _state_diagram[state, 0, sdigit]
+
+        order = order*8 + hdigit
+
+    return order
+
+
+def read_ramses_info(simfn):
+
+    '''
+
+    Inputs:
+
+    simfn - path to a RAMSES output directory (output_XXXXX)
+
+    Returns:
+
+    dictionary with ncpu, levelmax, boxlen, unit_l, the ordering type and
+    bound_key (the ncpu+1 hilbert keys delimiting the CPU domains)
+
+    '''
+
+    output_num = os.path.basename(os.path.normpath(simfn)).split('_')[-1]
+
+    info_file = os.path.join(simfn, 'info_'+output_num+'.txt')
+
+    info = {}
+    bound_key = []
+
+    with open(info_file) as f:
+
+        for line in f:
+
+            fields = line.split()
+
+            if len(fields) == 0:
+                continue
+
+            if '=' in line:
+                key, value = [v.strip() for v in line.split('=', 1)]
+
+                if key == 'ordering type':
+                    info['ordering'] = value
+
+                elif key in ('ncpu', 'levelmax'):
+                    info[key] = int(value)
+
+                elif key in ('boxlen', 'unit_l'):
+                    info[key] = float(value)
+
+            # rows of the domain table: icpu  ind_min  ind_max
+            elif re.match(r'^\d+$', fields[0]) and len(fields) == 3:
+
+                if len(bound_key) == 0:
+                    bound_key.append(float(fields[1]))
+
+                bound_key.append(float(fields[2]))
+
+    info['bound_key'] = np.array(bound_key)
+
+    return info
+
+
+def get_cpu_list(info, center, radius):
+
+    '''
+
+    Inputs:
+
+    info - output of read_ramses_info
+    center - centre of the sphere in box units (the box spans [0,1) along each axis)
+    radius - radius of the sphere in box units
+
+    Returns:
+
+    sorted array of the (1-indexed) CPU domains whose hilbert key range overlaps the
+    cube enclosing the sphere, wrapping around the periodic box (as in RAMSES utils/f90)
+
+    '''
+
+    levelmax = info['levelmax']
+    ncpu = info['ncpu']
+    bound_key = info['bound_key']
+
+    center = np.asarray(center, dtype=float)
+
+    xmin = center - radius
+
+    dmax = 2*radius
+
+    if dmax >= 0.5:
+        return np.arange(1, ncpu+1)
+
+    # coarsest level whose cells are at least as wide as the cube, so that
+    # the 2x2x2 block of cells starting at the cube's corner covers it
+    ilevel = 0
+    deltax = dmax*2
+
+    while deltax >= dmax:
+        ilevel += 1
+        deltax = 0.5**ilevel
+
+    bit_length = ilevel - 1
+    maxdom = 2**bit_length
+
+    imin = np.floor(xmin*maxdom).astype(np.int64)
+
+    corners = np.array([[i, j, k] for k in (0, 1) for j in (0, 1) for i in (0, 1)])
+
+    cells = (imin + corners) % maxdom
+
+    order_min = hilbert3d(cells[:, 0], cells[:, 1], cells[:, 2], bit_length) if bit_length > 0 else np.zeros(8, dtype=np.int64)
+
+    dkey = (2.**(levelmax+1)/maxdom)**3
+
+    bounding_min = order_min*dkey
+    bounding_max = (order_min+1)*dkey
+
+    # domains icpu cover [bound_key[icpu-1], bound_key[icpu])
+    cpu_min = np.searchsorted(bound_key, bounding_min, side='right')
+    cpu_max = np.searchsorted(bound_key, bounding_max, side='left')
+
+    cpus = np.concatenate([np.arange(lo, hi+1) for lo, hi in zip(cpu_min, cpu_max)])
+
+    return np.unique(np.clip(cpus, 1, ncpu))
+
+
+def region_cpus(simfn, center, radius):
+
+    '''
+
+    Inputs:
+
+    simfn - path to a RAMSES output directory
+    center - centre of the region in physical kpc (e.g. the tangos shrink center)
+    radius - radius of the region in physical kpc
+
+    Returns:
+
+    sorted array of the 1-indexed CPU files to pass to pynbody.load(simfn, cpus=...), or
+    None when the output is not a hilbert-ordered RAMSES output (the full box must be read)
+
+    '''
+
+    info_file = os.path.join(simfn, 'info_'+os.path.basename(os.path.normpath(simfn)).split('_')[-1]+'.txt')
+
+    if not os.path.exists(info_file):
+        return None
+
+    info = read_ramses_info(simfn)
+
+    if info.get('ordering') != 'hilbert' or len(info['bound_key']) != info['ncpu']+1:
+        return None
+
+    # unit_l is the physical size of one code length unit at this output
+    box_kpc = info['boxlen']*info['unit_l']/kpc_in_cm
+
+    return get_cpu_list(info, np.asarray(center)/box_kpc, float(radius)/box_kpc)
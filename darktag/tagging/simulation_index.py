@@ -0,0 +1,405 @@
+
+import os
+import json
+import hashlib
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+import tangos
+from tangos.examples.mergers import get_mergers_of_major_progenitor
+
+from ...config import config
+
+
+# in-process indexes, keyed by database and simulation
+_indexes = {}
+
+
+def halo_key(halo):
+
+    # timestep id and halo number are columns of the halo row, so the key costs no query
+    return str(halo.timestep_id)+'/'+str(halo.halo_number)
+
+
+def database_path():
+
+    '''
+
+    Returns the path of the tangos database in use (None if it is not a file)
+
+    '''
+
+    try:
+        path = tangos.core.get_default_session().get_bind().url.database
+    except Exception:
+        path = None
+
+    return path if (path != None and os.path.isfile(path)) else None
+
+
+class SimulationIndex:
+
+    '''
+
+    Index of a tangos simulation: the output names, times and redshifts of all its timesteps and, for each
+    halo asked for, the halo numbers, times, redshifts, tangos paths and r200c along its main progenitor branch.
+
+    The taggers need these for the main halo and for every merging halo, and each of them used to be a few
+    tangos queries (every one a round trip to an sqlite file on a shared filesystem). Here the timesteps are
+    read in one query and each branch once, and the index is kept for the rest of the process. Given an
+    index_path in config.json, it is also stored there (one small json file per simulation, tied to the
+    modification time of the database), so later runs do not query tangos for it at all.
+
+    '''
+
+    def __init__(self, simulation, timesteps=None, branches=None, mergers=None, db_path=None, db_mtime=None, filename=None):
+
+        self.simulation = simulation
+
+        # output, t and z of every timestep, in tangos order
+        self.timesteps = OrderedDict([('output',[]), ('t',[]), ('z',[])]) if timesteps == None else timesteps
+
+        # arrays of each main progenitor branch (latest first, as calculate_for_progenitors), keyed by halo_key
+        self.branches = OrderedDict() if branches == None else branches
+
+        # mergers onto each main progenitor branch (see MergerIndex), keyed by halo_key
+        self.mergers = OrderedDict() if mergers == None else mergers
+
+        self.db_path = db_path
+        self.db_mtime = db_mtime
+        self.filename = filename
+
+    def __repr__(self):
+        return '<SimulationIndex '+str(self.simulation)+' '+str(len(self.timesteps['output']))+' timesteps, '+str(len(self.branches))+' branches, '+str(len(self.mergers))+' merger trees>'
+
+    @property
+    def outputs(self):
+        return np.array(self.timesteps['output'])
+
+    @property
+    def times(self):
+        return np.array(self.timesteps['t'], dtype=np.float64)
+
+    @property
+    def redshifts(self):
+        return np.array(self.timesteps['z'], dtype=np.float64)
+
+    def timestep_index(self, output):
+
+        '''
+
+        Returns the index of output in DMOsim.timesteps
+
+        '''
+
+        return self.timesteps['output'].index(str(output))
+
+    def halo_path(self, output, halonumber):
+        return str(self.simulation)+'/'+str(output)+'/halo_'+str(int(halonumber))
+
+    def fetch_timesteps(self, DMOsim):
+
+        timesteps = [(ts.extension, ts.time_gyr, ts.redshift) for ts in DMOsim.timesteps]
+
+        self.timesteps = OrderedDict([('output',[str(ts[0]) for ts in timesteps]),
+                                      ('t',[float(ts[1]) for ts in timesteps]),
+                                      ('z',[float(ts[2]) for ts in timesteps])])
+
+    def branch(self, halo):
+
+        '''
+
+        Inputs:
+
+        halo - tangos halo object
+
+        Returns:
+
+        dictionary of the arrays halo_number, t, z, path and r200c (nan where it is not calculated) along the
+        main progenitor branch of halo, starting from halo itself (the order of calculate_for_progenitors)
+
+        '''
+
+        key = halo_key(halo)
+
+        if key not in self.branches:
+
+            halonums, t, z, paths = halo.calculate_for_progenitors('halo_number()', 't()', 'z()', 'path()')
+
+            r200c = np.full(len(paths), np.nan)
+
+            # r200c is missing for some halos, which calculate_for_progenitors leaves out
+            try:
+                r200c_paths, r200c_values = halo.calculate_for_progenitors('path()', 'r200c')
+                r200c_by_path = dict(zip(r200c_paths, r200c_values))
+                r200c = np.array([r200c_by_path.get(path, np.nan) for path in paths], dtype=np.float64)
+            except Exception as e:
+                print('r200c unavailable along the branch of', key, e)
+
+            self.branches[key] = {'halo_number':[int(n) for n in halonums],
+                                  't':[float(v) for v in t],
+                                  'z':[float(v) for v in z],
+                                  'path':[str(p) for p in paths],
+                                  'r200c':[float(v) for v in r200c]}
+
+            self.save()
+
+        branch = self.branches[key]
+
+        return {'halo_number':np.array(branch['halo_number'], dtype=int),
+                't':np.array(branch['t'], dtype=np.float64),
+                'z':np.array(branch['z'], dtype=np.float64),
+                'path':np.array(branch['path']),
+                'r200c':np.array(branch['r200c'], dtype=np.float64)}
+
+    def merger_index(self, halo):
+
+        '''
+
+        Inputs:
+
+        halo - tangos halo object
+
+        Returns:
+
+        MergerIndex of the halos merging onto the main progenitor branch of halo (get_mergers_of_major_progenitor,
+        walked once per halo and then kept with the rest of the index)
+
+        '''
+
+        key = halo_key(halo)
+
+        if key not in self.mergers:
+
+            zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(halo)
+
+            redshifts = self.redshifts
+
+            mergers = OrderedDict()
+
+            for z, ratio, merging_halos in zip(zmerge, qmerge, hmerge):
+
+                # zmerge is the redshift of the timestep the halos have merged by, read from the same database
+                # as the timesteps, so the nearest timestep is the one it was taken from
+                snapshot = int(np.argmin(np.abs(redshifts - z)))
+
+                for hDM in merging_halos[1:]:
+                    mergers.setdefault(str(snapshot), []).append({'path':str(hDM.path),
+                                                                  'halo_number':int(hDM.halo_number),
+                                                                  'ratio':float(ratio),
+                                                                  'p_occupied':OrderedDict()})
+
+            self.mergers[key] = mergers
+
+            self.save()
+
+        return MergerIndex(self, key)
+
+    def indexing_data(self, halo):
+
+        '''
+
+        Returns the times, redshifts, halo numbers and outputs of the main progenitor branch of halo, earliest
+        first (t_all, red_all, halonums, outputs as returned by utils.load_indexing_data)
+
+        '''
+
+        branch = self.branch(halo)
+
+        t_all = branch['t'][::-1]
+
+        outputs = self.outputs[np.isin(self.times, t_all)]
+
+        outputs.sort()
+
+        return t_all, branch['z'][::-1], branch['halo_number'][::-1], outputs
+
+    def prefetch(self, halo, mergers=True, recursive=False):
+
+        '''
+
+        Indexes the branch of halo and, with mergers, the branches of the halos merging into it (and with
+        recursive, those merging into them, as walked by the recursive taggers)
+
+        '''
+
+        self.branch(halo)
+
+        if mergers == True:
+
+            merger_index = self.merger_index(halo)
+
+            for snapshot in merger_index.snapshots():
+                for merger in merger_index.at(snapshot):
+
+                    hDM = merger_index.halo(merger)
+
+                    if recursive == True and halo_key(hDM) not in self.branches:
+                        self.prefetch(hDM, mergers=mergers, recursive=recursive)
+
+                    self.branch(hDM)
+
+    def save(self):
+
+        if self.filename == None:
+            return
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        tmp_filename = self.filename+'.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            json.dump({'simulation':self.simulation, 'db_path':self.db_path, 'db_mtime':self.db_mtime,
+                       'timesteps':self.timesteps, 'branches':self.branches, 'mergers':self.mergers}, f)
+
+        os.replace(tmp_filename, self.filename)
+
+
+class MergerIndex:
+
+    '''
+
+    Mergers onto the main progenitor branch of a halo, keyed by snapshot: the index (in DMOsim.timesteps) of the
+    timestep the halos have merged by, as an integer. Each merger is described by the tangos path and halo number
+    of the merging halo, the merger ratio and its occupation probability (per occupation regime, calculated
+    when first asked for and kept).
+
+    The taggers tag the merging halos at the snapshot before they have merged, i.e. at snapshot i of the main
+    branch when the mergers are at(timestep_index(outputs[i+1])). This replaces matching the redshifts of the
+    main branch against those of group_mergers as floats.
+
+    '''
+
+    def __init__(self, index, key):
+
+        self.index = index
+        self.key = key
+
+    def __repr__(self):
+        return '<MergerIndex '+str(self.key)+' '+str(len(self.snapshots()))+' snapshots with mergers>'
+
+    @property
+    def mergers(self):
+        return self.index.mergers[self.key]
+
+    def snapshots(self):
+
+        '''
+
+        Returns the (sorted) timestep indices with mergers
+
+        '''
+
+        return sorted(int(snapshot) for snapshot in self.mergers)
+
+    def __contains__(self, snapshot):
+        return str(int(snapshot)) in self.mergers
+
+    def at(self, snapshot):
+
+        '''
+
+        Returns the list of mergers (dictionaries of path, halo_number, ratio and p_occupied) at snapshot, the
+        index of a timestep in DMOsim.timesteps (empty if there are none)
+
+        '''
+
+        return self.mergers.get(str(int(snapshot)), [])
+
+    def at_output(self, output):
+        return self.at(self.index.timestep_index(output))
+
+    def halo(self, merger):
+
+        '''
+
+        Returns the tangos halo object of a merger
+
+        '''
+
+        return tangos.get_halo(merger['path'])
+
+    def p_occupied(self, merger, occupation_regime, hDM=None):
+
+        '''
+
+        Returns the occupation probability of the merging halo for occupation_regime (see utils.calculate_poccupied),
+        or None if it can't be calculated
+
+        '''
+
+        from .utils import calculate_poccupied
+
+        regime = str(occupation_regime)
+
+        if regime not in merger['p_occupied']:
+
+            try:
+                merger['p_occupied'][regime] = float(calculate_poccupied(self.halo(merger) if hDM == None else hDM, occupation_regime))
+            except Exception as e:
+                print(e)
+                merger['p_occupied'][regime] = None
+
+            self.index.save()
+
+        return merger['p_occupied'][regime]
+
+
+def index_filename(index_dir, simulation, db_path):
+    return join(str(index_dir), str(simulation)+'_'+hashlib.sha1(str(db_path).encode()).hexdigest()[:12]+'.json')
+
+
+def simulation_index(DMOsim, index_dir=None):
+
+    '''
+
+    Inputs:
+
+    DMOsim - tangos simulation
+    index_dir - directory the index is stored in (defaults to index_path in config.json, not stored if that is empty)
+
+    Returns:
+
+    the SimulationIndex of DMOsim: kept for the rest of the process, read back from index_dir if it was stored
+    since the database was last modified, and otherwise built (the timesteps now, the branches as they are asked for)
+
+    '''
+
+    db_path = database_path()
+
+    key = (db_path, str(DMOsim.path))
+
+    db_mtime = os.path.getmtime(db_path) if db_path != None else None
+
+    if key in _indexes and _indexes[key].db_mtime == db_mtime:
+        return _indexes[key]
+
+    if index_dir == None:
+        index_dir = config.get("paths", "index_path", "")
+
+    # an index is only stored when it can be tied to a database file
+    filename = index_filename(index_dir, DMOsim.path, db_path) if (index_dir != "" and db_path != None) else None
+
+    index = None
+
+    if filename != None and os.path.isfile(filename):
+
+        try:
+            with open(filename) as f:
+                stored = json.load(f, object_pairs_hook=OrderedDict)
+
+            if stored['db_mtime'] == db_mtime:
+                index = SimulationIndex(stored['simulation'], stored['timesteps'], stored['branches'], stored.get('mergers'), db_path, db_mtime, filename)
+
+        except (OSError, ValueError, KeyError) as e:
+            print('could not read the simulation index', filename, e)
+
+    if index == None:
+        index = SimulationIndex(str(DMOsim.path), db_path=db_path, db_mtime=db_mtime, filename=filename)
+        index.fetch_timesteps(DMOsim)
+        index.save()
+
+    _indexes[key] = index
+
+    return index
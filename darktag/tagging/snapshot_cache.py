@@ -0,0 +1,347 @@
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pynbody
+
+from .ramses_domains import region_cpus
+from ...config import config
+
+
+def _snapshot_key(simfn, cpus=None):
+
+    '''
+
+    Builds the cache key for a snapshot path: (simulation path, output name, CPU domains read).
+    cpus is None when the full box has been read.
+
+    '''
+
+    simfn = os.path.normpath(os.path.abspath(str(simfn)))
+
+    cpus = None if cpus is None else tuple(sorted(int(c) for c in cpus))
+
+    return os.path.dirname(simfn), os.path.basename(simfn), cpus
+
+
+def _snapshot_nbytes(snapshot):
+
+    '''
+
+    Returns the number of bytes held by the arrays that have been loaded into a
+    pynbody snapshot so far (pynbody loads arrays lazily, so this grows with use).
+
+    '''
+
+    nbytes = 0
+
+    for key in snapshot.keys():
+        nbytes += snapshot[key].nbytes
+
+    for fam in snapshot.families():
+        for key in snapshot.family_keys(fam):
+            nbytes += snapshot[fam][key].nbytes
+
+    return nbytes
+
+
+class SnapshotCache:
+
+    '''
+
+    Process-wide least-recently-used store of loaded pynbody snapshots.
+
+    Snapshots are keyed by (simulation path, output, CPU domains) and held in physical
+    units. A request for a subset of the RAMSES CPU domains is served by any cached
+    snapshot of the same output that already holds those domains (including the full box).
+    When the arrays held by all cached snapshots exceed max_bytes, the least recently used
+    snapshots are dropped until the cache fits the budget again (the snapshot that was
+    just requested is always kept).
+
+    Every caller gets the same snapshot object, so in-place changes to it (e.g. centering
+    on a halo) are seen by the next caller; callers center on their own halo before use.
+
+    '''
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = int(max_bytes)
+
+        self._snapshots = OrderedDict()
+
+        # position and velocity of the first particle at load time, used to recover the
+        # translations applied to a snapshot by centering since it was loaded
+        self._anchors = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, simfn):
+        return _snapshot_key(simfn) in self._snapshots
+
+    def _find(self, key):
+
+        if key in self._snapshots:
+            return key
+
+        full_key = key[:2] + (None,)
+
+        if full_key in self._snapshots:
+            return full_key
+
+        if key[2] is None:
+            return None
+
+        for cached_key in reversed(self._snapshots):
+            if cached_key[:2] == key[:2] and cached_key[2] is not None and set(key[2]).issubset(cached_key[2]):
+                return cached_key
+
+        return None
+
+    def _key_of(self, snapshot):
+
+        snapshot = snapshot.ancestor
+
+        for key, cached in self._snapshots.items():
+            if cached is snapshot:
+                return key
+
+        return None
+
+    @property
+    def nbytes(self):
+        return sum(_snapshot_nbytes(snapshot) for snapshot in self._snapshots.values())
+
+    def get(self, simfn, cpus=None, **load_kwargs):
+
+        '''
+
+        Returns the snapshot at simfn, loading it (and converting it to physical units) if
+        it is not already cached. If cpus is given only those RAMSES CPU domains are read.
+
+        '''
+
+        key = self._find(_snapshot_key(simfn, cpus))
+
+        if key is not None:
+            self.hits += 1
+            self._snapshots.move_to_end(key)
+            snapshot = self._snapshots[key]
+
+        else:
+            self.misses += 1
+            key = _snapshot_key(simfn, cpus)
+
+            if cpus is not None:
+                print('loading snapshot', simfn, 'from', len(key[2]), 'CPU domains')
+                load_kwargs['cpus'] = list(key[2])
+            else:
+                print('loading snapshot', simfn)
+
+            snapshot = pynbody.load(str(simfn), **load_kwargs)
+
+            # once the data from the snapshot has been loaded, .physical_units()
+            # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
+            snapshot.physical_units()
+
+            self._snapshots[key] = snapshot
+
+            if len(snapshot) > 0:
+                self._anchors[key] = {'pos':np.array(snapshot['pos'][0]), 'vel':np.array(snapshot['vel'][0])}
+
+        self._evict(keep=key)
+
+        return snapshot
+
+    def _evict(self, keep=None):
+
+        # arrays are loaded lazily, so the footprint is re-measured every time
+        sizes = OrderedDict((key, _snapshot_nbytes(snapshot)) for key, snapshot in self._snapshots.items())
+
+        total = sum(sizes.values())
+
+        for key in list(sizes.keys()):
+
+            if total <= self.max_bytes:
+                break
+
+            if key == keep:
+                continue
+
+            print('evicting snapshot from cache', os.path.join(*key[:2]))
+
+            total -= sizes[key]
+            del self._snapshots[key]
+            self._anchors.pop(key, None)
+
+    def cpus(self, snapshot):
+
+        '''
+
+        Returns the CPU domains read for a cached snapshot (or subsnap), None for a full box.
+
+        '''
+
+        key = self._key_of(snapshot)
+
+        return None if key is None else key[2]
+
+    def offset(self, snapshot, array='pos'):
+
+        '''
+
+        Returns the translation of 'pos' (physical kpc) or 'vel' (km/s) applied to a cached
+        snapshot since it was loaded, e.g. by pynbody.analysis.halo.center on a halo of a previous caller.
+
+        '''
+
+        key = self._key_of(snapshot)
+
+        if key not in self._anchors:
+            return np.zeros(3)
+
+        return np.array(snapshot.ancestor[array][0]) - self._anchors[key][array]
+
+    def discard(self, simfn):
+
+        for key in [k for k in self._snapshots if k[:2] == _snapshot_key(simfn)[:2]]:
+            del self._snapshots[key]
+            self._anchors.pop(key, None)
+
+    def clear(self):
+        self._snapshots.clear()
+        self._anchors.clear()
+
+
+snapshot_cache = SnapshotCache(config.get("cache", "snapshot_memory_gb", 32) * 1024**3)
+
+
+def load_snapshot(simfn, **load_kwargs):
+
+    '''
+
+    Inputs:
+
+    simfn - path to the simulation output
+    load_kwargs - passed on to pynbody.load when the snapshot is not cached
+
+    Returns:
+
+    the snapshot in physical units, shared with every other caller that asks for the same output
+
+    '''
+
+    return snapshot_cache.get(simfn, **load_kwargs)
+
+
+def halo_region(hDMO, radius_factor=None):
+
+    '''
+
+    Inputs:
+
+    hDMO - tangos halo object
+    radius_factor - if given, the region reaches at least radius_factor*r200c (e.g. the extent of a halo extract)
+
+    Returns:
+
+    centre (physical kpc) and radius (physical kpc) of the region read around the halo in
+    'region' loading mode: the tangos shrink center and r200c times the configured
+    snapshot_loading region_radius_factor (the safety factor)
+
+    '''
+
+    region_radius_factor = float(config.get("snapshot_loading", "region_radius_factor", 2.0))
+
+    if radius_factor != None:
+        region_radius_factor = max(region_radius_factor, float(radius_factor))
+
+    return np.asarray(hDMO['shrink_center'], dtype=float), float(hDMO['r200c'])*region_radius_factor
+
+
+def load_halo_snapshot(simfn, hDMO, radius_factor=None):
+
+    '''
+
+    Inputs:
+
+    simfn - path to the simulation output
+    hDMO - tangos halo object the snapshot is being loaded for
+    radius_factor - minimum extent of the region in r200c (see halo_region)
+
+    Returns:
+
+    the snapshot in physical units. With snapshot_loading mode 'region' in config.json only the
+    RAMSES CPU domains overlapping halo_region(hDMO) are read; the full box is read otherwise,
+    or when the output is not a hilbert ordered RAMSES output or the halo has no centre/r200c.
+
+    '''
+
+    if config.get("snapshot_loading", "mode", "full") != 'region':
+        return load_snapshot(simfn)
+
+    try:
+        centre, radius = halo_region(hDMO, radius_factor)
+        cpus = region_cpus(simfn, centre, radius)
+
+    except Exception as e:
+        print('could not work out the CPU domains of the halo, loading the full box:', e)
+        cpus = None
+
+    return snapshot_cache.get(simfn, cpus=cpus)
+
+
+def is_region_snapshot(snapshot):
+
+    '''
+
+    True if the (cached) snapshot holds only some of the RAMSES CPU domains of its output.
+
+    '''
+
+    return snapshot_cache.cpus(snapshot) is not None
+
+
+def region_halo(snapshot, hDMO):
+
+    '''
+
+    Inputs:
+
+    snapshot - snapshot returned by load_halo_snapshot
+    hDMO - tangos halo object
+
+    Returns:
+
+    the particles within halo_region(hDMO). This stands in for the halo catalogue entry on
+    region snapshots, whose particle indices no longer match the catalogues of the full box.
+
+    '''
+
+    centre, radius = halo_region(hDMO)
+
+    # account for any centering applied to the snapshot by earlier callers
+    centre = centre + snapshot_cache.offset(snapshot)
+
+    return snapshot[pynbody.filt.Sphere(radius, centre)]
+
+
+def set_snapshot_cache_budget(memory_gb):
+
+    '''
+
+    Changes the memory budget (in GB) of the shared snapshot cache, evicting snapshots if needed.
+
+    '''
+
+    snapshot_cache.max_bytes = int(memory_gb * 1024**3)
+    snapshot_cache._evict()
+
+
+def clear_snapshot_cache():
+
+    snapshot_cache.clear()
@@ -15,7 +15,7 @@ import sys
 import numpy as np 
 import pandas as pd 
 
-from darklight import DarkLight
+from .darklight_cache import cached_darklight
 
 import tangos 
 
@@ -25,6 +25,10 @@ from numpy import sqrt
 import random
 import pynbody
 from .utils import *
+from .snapshot_cache import load_halo_snapshot, is_region_snapshot, region_halo
+from .extract import load_extract
+from .simulation_index import simulation_index
+from .tagged_storage import write_tagged_particles
 import random
 from ...config import config
 
@@ -237,7 +241,7 @@ def get_bins(bins, binned_df, M_0, a, a_coeff, msp, red_all, t_all, i, insitu,sm
     return ch_parts_2,out_num,tgyr_of_choice,r_of_choice,p_typ,a_storage,m_storage
 
 
-def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'all', particle_storage_filename=None, mergers=True):
+def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'all', particle_storage_filename=None, mergers=True, extract_dir=None):
     
     # Use config path if pynbody_path is not provided
     if pynbody_path is None:
@@ -247,6 +251,7 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
 
     Given a tangos simulation, the function tags particles with stellar mass based on the Plummer profile in each snapshot. 
     In doing so it 'grows' the tagged stellar population over the full simulation. 
+    If extract_dir is given, particles are read from the halo extracts written by extract_halo_regions instead of the snapshots.
 
     '''
     
@@ -259,10 +264,11 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
     # iterating over all the simulations in the 'sims' list
    
     #darklight stellar masses used for the selection of insitu particles
-    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = DarkLight(main_halo,DMO=True,mergers=False,poccupied=occupation_frac)
+    t,redshift,vsmooth,sfh_insitu,mstar_s_insitu,mstar_total = cached_darklight(main_halo,DMO=True,mergers=False,poccupied=occupation_frac)
     
-    #calculate when the mergers took place (zmerge) and grab all the halo objects involved in the merger (hmerge)
-    zmerge, qmerge, hmerge = get_mergers_of_major_progenitor(main_halo)
+    # the halos merging onto the main branch (path, halo number, merger ratio and occupation probability),
+    # keyed by the index of the snapshot they have merged by (see simulation_index.MergerIndex)
+    merger_index = simulation_index(DMOsim).merger_index(main_halo)
     
     red_all = main_halo.calculate_for_progenitors('z()')[0][::-1]
    
@@ -272,12 +278,6 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
 
         print('output array length does not match redshift and time arrays')
 
-    # group_mergers() groups all the non-main halo objects that take part in mergers according to the merger redshift.
-    # this array gets stored in hmerge_added in the form -> len = no. of unique zmerges (redshifts of mergers),
-    # elements = all the halo objects of halos merging at this redshift
-    
-    hmerge_added, z_set_vals = group_mergers(zmerge,hmerge)
-
     #print the total amount of the (insitu) stellar mass that is to be associated with particles at this snap
     print('dkl',np.array(mstar_s_insitu))
 
@@ -298,13 +298,6 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
         # take a tally of all the particles chosen before this snap
         print('This is how many particles have been chosen:',len(chosen_parts))
         
-        # was particle data loaded in the insitu cycle of tagging ?
-        decision=False
-    
-        # was particle data loaded in the accreted cycle of tagging ?
-        decision2=False
-        decl = False
-        
         # Garbage collection
         gc.collect()
         
@@ -360,14 +353,11 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
         mass_select = int(msn-msp) if msn > 0 else 0
         
         if mass_select>1112:
-            decision=True
             # try to load in the data from this snapshot
             
             try:
-                DMOparticles = pynbody.load(simfn)
-                # once the data from the snapshot has been loaded, .physical_units()
-                # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-                DMOparticles.physical_units()
+                # shared with the merger branch below (and any other tagging run) through the snapshot cache
+                DMOparticles = load_extract(extract_dir,outputs[i],halonums[i]) if extract_dir != None else load_halo_snapshot(simfn, hDMO)
                 #print('Mass units ----------------------------------------------------->',DMOparticles['mass'].in_units('1.00e+10 Msol h**-1'))
                 print('loaded data insitu')
                 
@@ -378,11 +368,14 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
        
             print('mass_select:',mass_select)
             
-            #the pynbody halo object of the main halo
-            h = DMOparticles.halos()[int(halonums[i])-1]
-            
-            #center the simulation snapshot on the main halo obtained above
-            pynbody.analysis.halo.center(h,mode='hyb')
+            # (extracts are already centred on the halo)
+            if extract_dir == None:
+                #the pynbody halo object of the main halo (cut out around the tangos centre on region snapshots,
+                # since the halo catalogues index the full box)
+                h = region_halo(DMOparticles, hDMO) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(halonums[i])-1]
+                
+                #center the simulation snapshot on the main halo obtained above
+                pynbody.analysis.halo.center(h,mode='hyb')
                
             r200 = hDMO['r200c']
             
@@ -421,32 +414,24 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
         #get mergers ----------------------------------------------------------------------------------------------------------------
         
             
-        # check whether current the snapshot has a the redshift just before the merger occurs.
-        if (((i+1 < len(red_all)) and (red_all[i+1] in z_set_vals)) and (mergers == True)):
-            
-            #if particles have already been loaded in, loading them in again is not required
-            decision2 = False if decision==True else True
+        # check whether halos have merged by the next snapshot, in which case they are tagged in the current one.
+        if (((i+1 < len(outputs)) and (len(merger_index.at_output(outputs[i+1])) > 0)) and (mergers == True)):
             
             # The chosen particles from the accreting halo
             chosen_merger_particles = np.array([])
             
-            decl=False
-            
-            # the index where the merger's redshift matches the redshift of the snapshot
-            # we perform the selection one redhshift after - so that the accretion has definately taken place
-            t_id = int(np.where(z_set_vals==red_all[i+1])[0][0])
-            
             print('chosen merger particles ----------------------------------------------',len(chosen_merger_particles))
             
             #loop over the merging halos and collect particles from each of them
-            for hDM in hmerge_added[t_id][0]:
+            for merger in merger_index.at_output(outputs[i+1]):
                 
                 gc.collect()
+                hDM = merger_index.halo(merger)
                 print('halo:',hDM)
 
-                if (np.isin('dm_mass_profile',hDM.keys())):
-                    
-                    prob_occupied = calculate_poccupied(hDM,occupation_frac)
+                prob_occupied = merger_index.p_occupied(merger,occupation_frac,hDM)
+
+                if prob_occupied != None:
                     print('successfully calculated poccupied')
                     
                 else:
@@ -459,7 +444,7 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
                                                                                                                                                                         
                 try:
                     # loading in the properties of the halo from darklight as above
-                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = DarkLight(hDM,DMO=True,mergers=True,poccupied=occupation_frac)
+                    t_2,redshift_2,vsmooth_2,sfh_in2,mstar_in2,mstar_merging = cached_darklight(hDM,DMO=True,mergers=True,poccupied=occupation_frac)
                     print(len(mstar_merging))
                     
                 except Exception as e :
@@ -477,31 +462,25 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
                     leftover+=mstar_merging[-1]
                     continue
                 
-                # if the particle data is to be loaded in abd halo is predicted to have stellar mass
-                if float(mass_select_merge) >=1 and decision2==True:
-                    
-                    # try to load in the data from this snapshot
-                    try:
-                        DMOparticles = pynbody.load(simfn).d
-                        DMOparticles.physical_units()
-                        print('loaded data in mergers')
-                    
-                    # where this data isn't available, notify the user.
-                    except:
-                        print('--> DMO particle data exists but failed to read it, skipping!')
-                        continue
-                        
-                    #reset the decision booleans (data has been loaded in now)
-                    decision2 = False
-                    decl=True
+                # try to load in the data from this snapshot (a cache hit if the insitu step already loaded it)
+                try:
+                    DMOparticles = load_extract(extract_dir,outputs[i],hDM.calculate('halo_number()')) if extract_dir != None else load_halo_snapshot(simfn, hDM).d
+                    print('loaded data in mergers')
+                
+                # where this data isn't available, notify the user.
+                except:
+                    print('--> DMO particle data exists but failed to read it, skipping!')
+                    continue
                     
                 
                 if int(mass_select_merge) > 0:
 
                     # load in the pynbody halo object of the main halo and center snapshot on it
                     try:
-                        h_merge = DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
-                        pynbody.analysis.halo.center(h_merge,mode='hyb')
+                        # (extracts are already centred on the merging halo)
+                        if extract_dir == None:
+                            h_merge = region_halo(DMOparticles, hDM) if is_region_snapshot(DMOparticles) else DMOparticles.halos()[int(hDM.calculate('halo_number()'))-1]
+                            pynbody.analysis.halo.center(h_merge,mode='hyb')
                                                                                         
                         r200_merge = hDM['r200c']
                     except:
@@ -542,10 +521,6 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
 
                     
                         print('triggered , -------------------------------------------------------------------------------------- we selected',len(choose_parts_merger),'particles ------------')
-             
-        # If particle data has been loaded in, delete this before the next snapshot is analysed
-        if decision==True or decl==True:
-            del DMOparticles
         
         
         print("Done with iteration",i)
@@ -558,7 +533,7 @@ def spatial_tag_over_full_sim(DMOsim, pynbody_path  = None, occupation_frac = 'a
     df_spatially_tagged_particles = pd.DataFrame({'iords':chosen_parts , 'z':redshift_of_choice, 't':time_of_choice, 'type':part_typ, 'mstar':1112*np.ones(len(chosen_parts))})
 
     if particle_storage_filename != None: 
-        df_spatially_tagged_particles.to_csv(particle_storage_filename)
+        write_tagged_particles(df_spatially_tagged_particles,particle_storage_filename)
     
     return df_spatially_tagged_particles
 
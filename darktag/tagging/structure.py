@@ -0,0 +1,345 @@
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .tagged_storage import is_csv_path, tagged_types
+
+
+def reffs_filename(path):
+
+    '''
+
+    Returns the file the reffs measured during a tagging run are written to, alongside the tagged particles at
+    path: path with _reffs.csv added (in place of the extension of .csv files)
+
+    '''
+
+    path = str(path)
+
+    return (path[:-4] if is_csv_path(path) else path)+'_reffs.csv'
+
+
+class TaggedTotals:
+
+    '''
+
+    Stellar mass (all of it and in situ) and V band luminosity of each particle tagged in a catalog that grows as a
+    tagging run goes. Each update only takes in the rows appended to the catalog since the previous one: the iords
+    are kept sorted with the row each was given when first tagged, so the masses are added to in place, and the
+    tagging events are kept as (row, tagging time, mass) for the luminosities, which are one weighted bincount of
+    the events at the luminosity per solar mass of each distinct tagging time.
+
+    '''
+
+    def __init__(self, capacity=4096):
+
+        # rows of the catalog taken in so far
+        self.n_read = 0
+
+        # sorted iords and the row of each
+        self.iords = np.zeros(0, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64)
+
+        # by row
+        self.mstar = np.zeros(0)
+        self.mstar_insitu = np.zeros(0)
+
+        # distinct tagging times (Gyr) in the order they were first seen, and the position of each
+        self.tagging_times = np.zeros(0)
+        self.tagging_time_idx = {}
+
+        # tagging events, grown by doubling
+        self.n_events = 0
+        self.event_rows = np.empty(capacity, dtype=np.int64)
+        self.event_times = np.empty(capacity, dtype=np.int64)
+        self.event_mstar = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.iords)
+
+    def __repr__(self):
+        return '<TaggedTotals '+str(len(self.iords))+' particles, '+str(self.n_events)+' events>'
+
+    def _reserve(self, n):
+
+        if self.n_events + n <= len(self.event_rows):
+            return
+
+        capacity = max(2*len(self.event_rows), self.n_events + n)
+
+        for name in ['event_rows', 'event_times', 'event_mstar']:
+            grown = np.empty(capacity, dtype=getattr(self, name).dtype)
+            grown[:self.n_events] = getattr(self, name)[:self.n_events]
+            setattr(self, name, grown)
+
+    def update(self, catalog):
+
+        '''
+
+        Takes in the rows appended to catalog (a TaggedCatalog) since the last update
+
+        '''
+
+        new = slice(self.n_read, len(catalog))
+
+        self.n_read = len(catalog)
+
+        iords = np.asarray(catalog['iords'][new])
+
+        if len(iords) == 0:
+            return
+
+        mstar = np.asarray(catalog['mstar'][new], dtype=np.float64)
+        t = np.asarray(catalog['t'][new], dtype=np.float64)
+        insitu = np.asarray(catalog['type'][new]) == tagged_types.index('insitu')
+
+        new_iords, event_idx = np.unique(iords, return_inverse=True)
+        event_idx = event_idx.ravel()
+
+        # iords tagged for the first time are given the next rows
+        pos = np.searchsorted(self.iords, new_iords)
+        seen = pos < len(self.iords)
+        seen[seen] = self.iords[pos[seen]] == new_iords[seen]
+
+        first = np.logical_not(seen)
+
+        self.iords = np.insert(self.iords, pos[first], new_iords[first])
+        self.rows = np.insert(self.rows, pos[first], len(self.mstar) + np.arange(np.sum(first)))
+
+        self.mstar = np.concatenate([self.mstar, np.zeros(np.sum(first))])
+        self.mstar_insitu = np.concatenate([self.mstar_insitu, np.zeros(np.sum(first))])
+
+        new_rows = self.rows[np.searchsorted(self.iords, new_iords)]
+
+        self.mstar[new_rows] += np.bincount(event_idx, weights=mstar, minlength=len(new_iords))
+        self.mstar_insitu[new_rows] += np.bincount(event_idx, weights=np.where(insitu, mstar, 0.0), minlength=len(new_iords))
+
+        # the few distinct tagging times of the new events (usually only the snapshot's)
+        new_times, time_idx = np.unique(t, return_inverse=True)
+
+        for time in new_times[[time not in self.tagging_time_idx for time in new_times]]:
+            self.tagging_time_idx[time] = len(self.tagging_times)
+            self.tagging_times = np.append(self.tagging_times, time)
+
+        self._reserve(len(iords))
+
+        events = slice(self.n_events, self.n_events + len(iords))
+
+        self.event_rows[events] = new_rows[event_idx]
+        self.event_times[events] = np.array([self.tagging_time_idx[time] for time in new_times])[time_idx.ravel()]
+        self.event_mstar[events] = mstar
+
+        self.n_events += len(iords)
+
+    def positions(self, iords):
+
+        '''
+
+        Returns the rows of iords and a mask of the ones that have been tagged
+
+        '''
+
+        iords = np.asarray(iords)
+
+        if len(self.iords) == 0:
+            return np.zeros(iords.shape, dtype=int), np.zeros(iords.shape, dtype=bool)
+
+        idx = np.clip(np.searchsorted(self.iords, iords), 0, len(self.iords)-1)
+
+        return self.rows[idx], self.iords[idx] == iords
+
+    def luminosities(self, t):
+
+        '''
+
+        Returns the V band luminosity (L_sun) of each row at time t (Gyr), as produce_lums_grouped
+
+        '''
+
+        # lazily imported, darktag.analysis imports the tagging utilities
+        from darktag.analysis.calculate import calc_luminosity
+
+        lums_per_msol = np.where(self.tagging_times <= t, calc_luminosity(np.maximum(t - self.tagging_times, 0.0), np.ones(len(self.tagging_times))), 0.0)
+
+        n = self.n_events
+
+        return np.bincount(self.event_rows[:n], weights=self.event_mstar[:n]*lums_per_msol[self.event_times[:n]], minlength=len(self.mstar))
+
+
+class ReffTable:
+
+    '''
+
+    Projected half-mass radius, half-light radius and Kravtsov radius of the tagged stars of one catalog, measured
+    snapshot by snapshot while a tagging run has the particles of the main halo in memory. The columns are those
+    written by calculate_reffs_over_full_sim (halflight, reff, z, t, kravtsov), so a run with compute_reffs=True
+    does not need the second pass over the snapshots. The masses and luminosities of the tagged particles are
+    kept up to date from the rows appended to the catalog at each snapshot (see TaggedTotals), and the table is
+    written to filename by write (at the checkpoints and the end of a run).
+
+    '''
+
+    columns = ['halflight', 'reff', 'z', 't', 'kravtsov']
+
+    def __init__(self, filename=None):
+
+        self.filename = filename
+
+        self.rows = []
+
+        self.totals = TaggedTotals()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return '<ReffTable '+str(len(self.rows))+' snapshots>'
+
+    def measure(self, particles, catalog, t, z, r200c):
+
+        '''
+
+        Inputs:
+
+        particles - dark matter particles of the main halo at this snapshot (within r200, subhalos removed)
+        catalog - TaggedCatalog of the particles tagged up to this snapshot
+        t, z - time (Gyr) and redshift of the snapshot
+        r200c - r200c of the main halo (tangos), the Kravtsov radius is 0.02 r200c
+
+        Returns:
+
+        the row added to the table (None if none of the tagged particles are in the halo)
+
+        '''
+
+        # lazily imported, darktag.analysis imports the tagging utilities
+        from darktag.analysis.calculate import calc_enclosed_light_radii
+
+        # stellar mass of each tagged particle (all of them and in situ only), summed over its tagging events
+        self.totals.update(catalog)
+
+        if len(self.totals) == 0:
+            return None
+
+        rows, selected = self.totals.positions(np.asarray(particles['iord']))
+
+        if np.any(selected) == False:
+            print('none of the tagged particles are in the halo, reffs skipped')
+            return None
+
+        rows = rows[selected]
+        pos = np.asarray(particles['pos'])[selected]
+
+        mstar = self.totals.mstar[rows]
+        mstar_insitu = self.totals.mstar_insitu[rows]
+
+        # centred on the in situ stars (on all the tagged stars if there are none in the halo), as calculate_reffs_over_full_sim
+        weights = mstar_insitu if np.sum(mstar_insitu) > 0 else mstar
+
+        pos = pos - np.sum(pos*weights[:, None], axis=0)/np.sum(weights)
+
+        # projected half-mass radius
+        distances = np.sqrt(pos[:, 0]**2 + pos[:, 1]**2)
+
+        order = np.argsort(distances)
+
+        cumilative_sum = np.cumsum(mstar[order])
+
+        R_half = distances[order][np.where(cumilative_sum >= (cumilative_sum[-1]/2))[0][0]]
+
+        # 3D half-light radius (calc_halflight with cylindrical=False)
+        lums = self.totals.luminosities(t)[rows]
+
+        hlight_r = calc_enclosed_light_radii(np.sqrt(np.sum(pos**2, axis=1)), lums, [0.5])[0]
+
+        row = OrderedDict([('halflight', float(hlight_r)), ('reff', float(R_half)), ('z', float(z)), ('t', float(t)), ('kravtsov', float(r200c)*0.02)])
+
+        print('halfmass radius:',R_half)
+        print('halflight radius:',hlight_r)
+
+        self.rows.append(row)
+
+        return row
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=self.columns)
+
+    def write(self):
+
+        if self.filename != None:
+            self.to_dataframe().to_csv(self.filename)
+
+    def restore(self, t):
+
+        '''
+
+        Keeps the rows written to filename by a previous run up to time t (the last snapshot of a checkpoint)
+
+        '''
+
+        self.rows = []
+
+        if self.filename != None and os.path.isfile(self.filename):
+
+            df = pd.read_csv(self.filename, index_col=0)
+
+            self.rows = [OrderedDict((column, float(row[column])) for column in self.columns) for _, row in df[df['t'] <= t].iterrows()]
+
+        self.write()
+
+
+class ReffSweep:
+
+    '''
+
+    ReffTable of every catalog of a FreeParamSweep, written next to its particle file (see reffs_filename) if
+    the particles are written to disk.
+
+    '''
+
+    def __init__(self, tagged_particles):
+
+        self.tagged_particles = tagged_particles
+
+        self.tables = OrderedDict((value, ReffTable(reffs_filename(tagged_particles.writers[value].path) if value in tagged_particles.writers else None))
+                                  for value in tagged_particles.values)
+
+    def measure(self, particles, t, z, r200c):
+
+        '''
+
+        Measures the reffs of each catalog of the sweep at this snapshot (see ReffTable.measure)
+
+        '''
+
+        if type(particles) == type(None):
+            print('halo particles unavailable, reffs skipped')
+            return
+
+        for value, table in self.tables.items():
+            table.measure(particles, self.tagged_particles.catalogs[value], t, z, r200c)
+
+    def restore(self, t):
+        for table in self.tables.values():
+            table.restore(t)
+
+    def write(self):
+        for table in self.tables.values():
+            table.write()
+
+    def to_dataframes(self):
+
+        '''
+
+        Returns the dataframe of reffs, or for a sweep over several values a dictionary of them keyed by value
+        (as FreeParamSweep.to_dataframes)
+
+        '''
+
+        if self.tagged_particles.sweep:
+            return OrderedDict((value, table.to_dataframe()) for value, table in self.tables.items())
+
+        return self.tables[self.tagged_particles.values[0]].to_dataframe()
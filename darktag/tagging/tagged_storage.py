@@ -0,0 +1,617 @@
+
+import os
+import json
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# columns of a tagged particle file and the type each is stored as
+tagged_columns = OrderedDict([('iords', np.int64),
+                              ('mstar', np.float32),
+                              ('t', np.float32),
+                              ('z', np.float32),
+                              ('type', np.uint8)])
+
+# 'type' is stored as an index into this list
+tagged_types = ['insitu', 'accreted']
+
+header_filename = 'header.json'
+
+
+def is_csv_path(path):
+
+    '''
+
+    True if tagged particles at path are (to be) stored as CSV. Paths ending in .csv keep the
+    CSV format, everything else is a columnar store (a directory, see TaggedParticleWriter).
+
+    '''
+
+    return str(path).endswith('.csv')
+
+
+def is_columnar_store(path):
+    return os.path.isfile(os.path.join(str(path), header_filename))
+
+
+def encode_types(types):
+
+    '''
+
+    Inputs:
+
+    types - 'insitu'/'accreted' labels (or their codes)
+
+    Returns:
+
+    uint8 array of the positions of the labels in tagged_types
+
+    '''
+
+    types = np.asarray(types)
+
+    if types.dtype.kind in 'iu':
+        return types.astype(np.uint8)
+
+    codes = np.full(len(types), 255, dtype=np.uint8)
+
+    for code, label in enumerate(tagged_types):
+        codes[types == label] = code
+
+    if np.any(codes == 255):
+        raise ValueError('unknown tagged particle types: '+str(np.unique(types[codes == 255])))
+
+    return codes
+
+
+def decode_types(codes):
+
+    '''
+
+    Returns the codes stored in the 'type' column as a pandas Categorical of the tagged_types labels.
+
+    '''
+
+    return pd.Categorical.from_codes(np.asarray(codes, dtype=np.int64), categories=tagged_types)
+
+
+class TaggedCatalog:
+
+    '''
+
+    In-memory store of tagged particles, filled in by the taggers as they go.
+
+    The columns (iords, mstar, t, z and the type code, see tagged_types) are held as separate numpy
+    arrays that grow by doubling, so appending a chunk costs the size of the chunk rather than a copy of
+    everything tagged so far. The recursive taggers pass one catalog down the merger tree and append to it
+    in place. Use to_dataframe() for the usual dataframe of tagged particles.
+
+    '''
+
+    # t and z are kept at full precision in memory (they are compared against the tangos times)
+    dtypes = OrderedDict([('iords', np.int64),
+                          ('mstar', np.float64),
+                          ('t', np.float64),
+                          ('z', np.float64),
+                          ('type', np.uint8)])
+
+    def __init__(self, capacity=4096):
+
+        self._arrays = OrderedDict((column, np.empty(capacity, dtype=dtype)) for column, dtype in self.dtypes.items())
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return '<TaggedCatalog '+str(self.n_rows)+' particles>'
+
+    def __getitem__(self, column):
+
+        # a view of the filled part of the column, valid until the next append
+        return self._arrays[column][:self.n_rows]
+
+    @property
+    def capacity(self):
+        return len(self._arrays['iords'])
+
+    def _reserve(self, n):
+
+        if self.n_rows + n <= self.capacity:
+            return
+
+        capacity = max(2*self.capacity, self.n_rows + n)
+
+        for column, values in self._arrays.items():
+            grown = np.empty(capacity, dtype=values.dtype)
+            grown[:self.n_rows] = values[:self.n_rows]
+            self._arrays[column] = grown
+
+    def append(self, iords, mstar, t, z, types):
+
+        '''
+
+        Appends one chunk of tagged particles. t, z and types may be given as a single value for the whole chunk.
+
+        '''
+
+        n = len(iords)
+
+        if n == 0:
+            return
+
+        self._reserve(n)
+
+        rows = slice(self.n_rows, self.n_rows + n)
+
+        self._arrays['iords'][rows] = iords
+        self._arrays['mstar'][rows] = mstar
+        self._arrays['t'][rows] = t
+        self._arrays['z'][rows] = z
+        self._arrays['type'][rows] = encode_types(np.broadcast_to(np.asarray(types), (n,)))
+
+        self.n_rows += n
+
+    def append_dataframe(self, df):
+        self.append(df['iords'].values, df['mstar'].values, df['t'].values, df['z'].values, np.asarray(df['type']))
+
+    @classmethod
+    def from_dataframe(cls, df):
+
+        catalog = cls(capacity=max(len(df), 1))
+        catalog.append_dataframe(df)
+
+        return catalog
+
+    def to_dataframe(self):
+
+        '''
+
+        Returns the tagged particles as a dataframe (columns iords, mstar, t, z, type), with 'type' as a
+        pandas Categorical of the tagged_types labels.
+
+        '''
+
+        df = pd.DataFrame({column:np.array(self[column]) for column in self.dtypes})
+
+        df['type'] = decode_types(df['type'].values)
+
+        return df
+
+    def write(self, path):
+
+        '''
+
+        Writes the catalog to path (a columnar store, or CSV if path ends in .csv, see TaggedParticleWriter).
+
+        '''
+
+        with TaggedParticleWriter(path) as writer:
+            writer.append(self['iords'], self['mstar'], self['t'], self['z'], self['type'])
+
+
+def _column_filename(path, column):
+    return os.path.join(path, column+'.bin')
+
+
+def _read_header(path):
+
+    with open(os.path.join(path, header_filename)) as f:
+        return json.load(f)
+
+
+def _write_header(path, header):
+
+    # written to a temporary file first so a reader never sees a half written header
+    tmp_filename = os.path.join(path, header_filename+'.tmp')
+
+    with open(tmp_filename, 'w') as f:
+        json.dump(header, f, indent=1)
+
+    os.replace(tmp_filename, os.path.join(path, header_filename))
+
+
+class TaggedParticleWriter:
+
+    '''
+
+    Appends tagged particles to a file chunk by chunk (e.g. once per snapshot).
+
+    Unless the path ends in .csv, the particles are written to a columnar store: a directory holding
+    one raw binary file per column (int64 iords, float32 mstar/t/z and the uint8 code of the
+    insitu/accreted type, see tagged_columns) and a header.json with the number of rows, the column types,
+    the type labels and the sizes of the appended chunks. The header is rewritten after every append, so a
+    store that is still being written to (or whose run crashed) can be read up to the last complete chunk.
+
+    '''
+
+    def __init__(self, path, mode='w'):
+
+        '''
+
+        Inputs:
+
+        path - directory of the columnar store, or a .csv file
+        mode - 'w' starts a new file (removing any existing one), 'a' appends to an existing one
+
+        '''
+
+        self.path = str(path)
+        self.csv = is_csv_path(self.path)
+
+        if self.csv:
+
+            if mode == 'w' or not os.path.exists(self.path):
+                pd.DataFrame({column:[] for column in tagged_columns}).to_csv(self.path, index=False)
+                self.n_rows = 0
+
+            else:
+                self.n_rows = len(pd.read_csv(self.path, usecols=['iords']))
+
+            return
+
+        if mode == 'a' and is_columnar_store(self.path):
+            self.header = _read_header(self.path)
+
+        else:
+            os.makedirs(self.path, exist_ok=True)
+
+            for column in tagged_columns:
+                open(_column_filename(self.path, column), 'wb').close()
+
+            self.header = {'format':'darktag tagged particles',
+                           'version':1,
+                           'n_rows':0,
+                           'columns':OrderedDict((column, np.dtype(dtype).str) for column, dtype in tagged_columns.items()),
+                           'types':tagged_types,
+                           'chunks':[],
+                           # rows are appended snapshot by snapshot, so t normally never decreases (see read_tagged_particles)
+                           't_sorted':True,
+                           't_max':None}
+
+            _write_header(self.path, self.header)
+
+        self.n_rows = self.header['n_rows']
+
+    def __len__(self):
+        return self.n_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, iords, mstar, t, z, types):
+
+        '''
+
+        Appends one chunk of tagged particles. t and z may be given as a single value for the whole chunk.
+
+        '''
+
+        n = len(iords)
+
+        if n == 0:
+            return
+
+        t = np.broadcast_to(np.asarray(t), (n,))
+        z = np.broadcast_to(np.asarray(z), (n,))
+        types = np.broadcast_to(np.asarray(types), (n,))
+
+        if self.csv:
+
+            if types.dtype.kind in 'iu':
+                types = np.asarray(tagged_types)[types]
+
+            pd.DataFrame({'iords':np.asarray(iords, dtype=np.int64), 'mstar':mstar, 't':t, 'z':z, 'type':types}).to_csv(self.path, mode='a', header=False, index=False)
+            self.n_rows += n
+            return
+
+        t = t.astype(np.float32)
+
+        chunk = {'iords':iords, 'mstar':mstar, 't':t, 'z':z, 'type':encode_types(types)}
+
+        for column, dtype in tagged_columns.items():
+            with open(_column_filename(self.path, column), 'ab') as f:
+                np.ascontiguousarray(chunk[column], dtype=dtype).tofile(f)
+
+        if self.header['t_max'] != None and float(t.min()) < self.header['t_max']:
+            self.header['t_sorted'] = False
+
+        self.header['t_max'] = float(t.max()) if self.header['t_max'] == None else max(self.header['t_max'], float(t.max()))
+
+        self.n_rows += n
+        self.header['n_rows'] = self.n_rows
+        self.header['chunks'].append(n)
+
+        _write_header(self.path, self.header)
+
+    def append_dataframe(self, df):
+        self.append(df['iords'].values, df['mstar'].values, df['t'].values, df['z'].values, np.asarray(df['type']))
+
+    def append_catalog(self, catalog):
+
+        '''
+
+        Appends the rows of catalog (a TaggedCatalog whose first len(self) rows are those already written) that have
+        not been written yet, e.g. the particles tagged at the last snapshot
+
+        '''
+
+        rows = slice(self.n_rows, len(catalog))
+
+        self.append(catalog['iords'][rows], catalog['mstar'][rows], catalog['t'][rows], catalog['z'][rows], catalog['type'][rows])
+
+    def close(self):
+
+        if not self.csv:
+            _write_header(self.path, self.header)
+
+
+def write_tagged_particles(df, path):
+
+    '''
+
+    Writes a dataframe of tagged particles (columns iords, mstar, t, z, type) to path,
+    as CSV if path ends in .csv and as a columnar store otherwise (see TaggedParticleWriter).
+
+    '''
+
+    with TaggedParticleWriter(path) as writer:
+        writer.append_dataframe(df)
+
+
+def tagged_by(df, t):
+
+    '''
+
+    Returns the particles of a tagged particle dataframe that were tagged at or before time t.
+    t is compared at the precision the 't' column is stored at (float32 in columnar stores), so the
+    particles tagged at a snapshot are kept when selecting on the time of that snapshot.
+
+    '''
+
+    return df[df['t'] <= np.asarray(t, dtype=df['t'].dtype)]
+
+
+def read_tagged_particles(path, columns=None, t_max=None, types=None):
+
+    '''
+
+    Inputs:
+
+    path - columnar store (see TaggedParticleWriter) or CSV file of tagged particles
+    columns - columns to read (all of iords, mstar, t, z, type by default)
+    t_max - only read particles tagged at t <= t_max (Gyr)
+    types - only read particles of these types (e.g. ['insitu'])
+
+    Returns:
+
+    dataframe of the tagged particles. From a columnar store 'type' is a pandas Categorical, the
+    columns are memory-mapped and only the selected rows are copied out; when the store was written in
+    time order (the normal case) the t_max cut is a binary search rather than a scan.
+
+    '''
+
+    path = str(path)
+
+    columns = list(tagged_columns.keys()) if columns == None else list(columns)
+
+    if not is_columnar_store(path):
+
+        # CSV files written by older versions also hold the dataframe index, which is dropped here
+        read_columns = set(columns) | ({'t'} if t_max != None else set()) | ({'type'} if types != None else set())
+
+        df = pd.read_csv(path, usecols=lambda column: column in read_columns)
+
+        if t_max != None:
+            df = df[df['t'] <= t_max]
+
+        if types != None:
+            df = df[df['type'].isin(list(types))]
+
+        return df[columns].reset_index(drop=True)
+
+    header = _read_header(path)
+
+    n_rows = header['n_rows']
+
+    def column_data(column):
+        if n_rows == 0:
+            return np.zeros(0, dtype=header['columns'][column])
+        return np.memmap(_column_filename(path, column), dtype=header['columns'][column], mode='r', shape=(n_rows,))
+
+    rows = slice(0, n_rows)
+
+    if t_max != None:
+
+        t = column_data('t')
+
+        if header['t_sorted']:
+            rows = slice(0, int(np.searchsorted(t, np.float32(t_max), side='right')))
+
+        else:
+            rows = np.where(t <= np.float32(t_max))[0]
+
+    if types != None:
+
+        codes = column_data('type')[rows]
+        selected = np.where(np.isin(codes, encode_types(list(types))))[0]
+
+        rows = selected if isinstance(rows, slice) else rows[selected]
+
+    df = pd.DataFrame({column:np.array(column_data(column)[rows]) for column in columns})
+
+    if 'type' in df:
+        df['type'] = decode_types(df['type'].values)
+
+    return df
+
+
+def ftag_filename(path, free_param_value):
+
+    '''
+
+    Returns the file the particles tagged with free_param_value are written to in a sweep over several
+    values (see FreeParamSweep): path with _ftag<value> added (before the extension of .csv files).
+
+    '''
+
+    path = str(path)
+
+    suffix = '_ftag'+str(float(free_param_value))
+
+    return path[:-4]+suffix+'.csv' if is_csv_path(path) else path+suffix
+
+
+def method_filename(path, method):
+
+    '''
+
+    Returns the file the particles tagged by one method of a multi-method run are written to (see
+    multi_method_tagging): path with _<method> added (before the extension of .csv files),
+    e.g. 'angular momentum' -> path_angular_momentum.
+
+    '''
+
+    path = str(path)
+
+    suffix = '_'+str(method).replace(' ', '_')
+
+    return path[:-4]+suffix+'.csv' if is_csv_path(path) else path+suffix
+
+
+class FreeParamSweep:
+
+    '''
+
+    Tagged particles of one or several free parameter (tagging fraction) values, tagged in the same pass over
+    the simulation. The particles are ranked once per snapshot (up to the largest value) and every value takes
+    its own fraction of that ranking, so each extra value costs only the selection and not another load,
+    centering and r200 calculation of every snapshot.
+
+    Holds a TaggedCatalog (and, given particle_storage_filename, a TaggedParticleWriter) per value. With a single
+    value the particles are written to particle_storage_filename itself, otherwise to ftag_filename(...) of each value.
+
+    '''
+
+    def __init__(self, free_param_value, particle_storage_filename=None):
+
+        self.sweep = isinstance(free_param_value, (list, tuple, np.ndarray))
+
+        self.values = list(OrderedDict.fromkeys(float(v) for v in np.atleast_1d(free_param_value)))
+
+        self.catalogs = OrderedDict((value, TaggedCatalog()) for value in self.values)
+
+        self.writers = {}
+
+        if particle_storage_filename != None:
+            for value in self.values:
+                self.writers[value] = TaggedParticleWriter(ftag_filename(particle_storage_filename, value) if self.sweep else particle_storage_filename)
+
+    @property
+    def max_value(self):
+
+        # the ranking needs to be in order up to the largest tagging fraction
+        return max(self.values)
+
+    def tag(self, assign_stars_to_particles, snapshot_stellar_mass, particles_sorted, t, z, types):
+
+        '''
+
+        Inputs:
+
+        assign_stars_to_particles - the tagger's assign_stars_to_particles function
+        snapshot_stellar_mass - stellar mass to be tagged
+        particles_sorted - particle IDs ranked (at least up to max_value) by the tagger
+        t, z, types - time, redshift and type ('insitu' or 'accreted') of the tagged particles
+
+        Returns:
+
+        the output of assign_stars_to_particles for the largest value (its particles include those of every other value)
+
+        '''
+
+        return self.record(self.select(assign_stars_to_particles, snapshot_stellar_mass, particles_sorted), t, z, types)
+
+    def select(self, assign_stars_to_particles, snapshot_stellar_mass, particles_sorted):
+
+        '''
+
+        Returns the output of assign_stars_to_particles for every value, keyed by value (without recording them)
+
+        '''
+
+        return OrderedDict((value, assign_stars_to_particles(snapshot_stellar_mass, particles_sorted, value)) for value in self.values)
+
+    def record(self, selections, t, z, types):
+
+        '''
+
+        Inputs:
+
+        selections - output of assign_stars_to_particles keyed by value (as returned by select, possibly in a worker process)
+        t, z, types - time, redshift and type ('insitu' or 'accreted') of the tagged particles
+
+        Returns:
+
+        the selection of the largest value (its particles include those of every other value)
+
+        '''
+
+        for value in self.values:
+
+            array_to_write = selections[value]
+
+            self.catalogs[value].append(array_to_write[0], array_to_write[1], t, z, types)
+
+            if value in self.writers:
+                self.writers[value].append(array_to_write[0], array_to_write[1], t, z, types)
+
+        return selections[self.max_value]
+
+    def named_catalogs(self):
+
+        # the catalogs keyed by str(value), as saved in a checkpoint
+        return OrderedDict((str(value), catalog) for value, catalog in self.catalogs.items())
+
+    def restore(self, catalogs):
+
+        '''
+
+        Replaces the catalogs with those saved in a checkpoint (keyed by str(value), see named_catalogs) and
+        rewrites the particle files from them, dropping anything written after the checkpoint.
+
+        '''
+
+        for value in self.values:
+
+            self.catalogs[value] = catalogs[str(value)]
+
+            if value in self.writers:
+
+                catalog = self.catalogs[value]
+
+                self.writers[value] = TaggedParticleWriter(self.writers[value].path)
+                self.writers[value].append(catalog['iords'], catalog['mstar'], catalog['t'], catalog['z'], catalog['type'])
+
+    def close(self):
+
+        for writer in self.writers.values():
+            writer.close()
+
+    def to_dataframes(self):
+
+        '''
+
+        Returns the dataframe of tagged particles, or for a sweep over several values a dictionary of them keyed by value.
+
+        '''
+
+        if self.sweep:
+            return OrderedDict((value, catalog.to_dataframe()) for value, catalog in self.catalogs.items())
+
+        return self.catalogs[self.values[0]].to_dataframe()
@@ -1,5 +1,13 @@
 from .spatial_tagging import *
 from .angular_momentum_tagging import *
+from .multi_method_tagging import multi_method_tag_over_full_sim
+from .binding_energy_tagging import BE_tag_over_full_sim
+from .snapshot_cache import load_snapshot
+from .extract import load_extract
+from .tagged_storage import read_tagged_particles, ftag_filename
+from .simulation_index import simulation_index
+from .mass_ledger import MassLedger
+from collections import OrderedDict
 from ...config import config
 
 def get_child_iords(halo,halo_catalog,DMO_state='fiducial'):
@@ -56,29 +64,57 @@ def get_child_iords(halo,halo_catalog,DMO_state='fiducial'):
 
 
 
-def tag_particles(DMO_database, path_to_particle_data = None, tagging_method = 'angular momentum', free_param_val = 0.01, include_mergers = True, halonumber = 1):
+def tag_particles(DMO_database, path_to_particle_data = None, tagging_method = 'angular momentum', free_param_val = 0.01, include_mergers = True, halonumber = 1, extract_dir = None, particle_storage_filename = None, processes = None, checkpoint_dir = None, compute_reffs = False):
 
     # Use config path if path_to_particle_data not provided
     if path_to_particle_data is None:
         path_to_particle_data = config.get_path("pynbody_path")
 
+    # a list of methods (e.g. ['angular momentum', 'binding energy', 'spatial']) tags with all of them in one
+    # pass over the simulation and returns a dictionary of tagged particles keyed by method
+    if isinstance(tagging_method, (list, tuple)):
+
+        # the multi method pass runs in one process and is neither checkpointed nor measures reffs
+        unsupported = [name for name, value in [('processes', processes != None and int(processes) > 1), ('checkpoint_dir', checkpoint_dir != None), ('compute_reffs', compute_reffs == True)] if value]
+
+        if len(unsupported) > 0:
+            raise ValueError(', '.join(unsupported)+' not supported when tagging with several methods ('+str(list(tagging_method))+'), tag with one method at a time')
+
+        return multi_method_tag_over_full_sim(DMO_database, halonumber, methods = tagging_method, free_param_value = free_param_val, pynbody_path = path_to_particle_data, particle_storage_filename = particle_storage_filename, mergers = include_mergers, extract_dir = extract_dir)
+
     if tagging_method == 'angular momentum':
         
-        df_tagged = angmom_tag_over_full_sim(DMO_database, halonumber, free_param_value = free_param_val, pynbody_path  = path_to_particle_data, mergers = include_mergers)
+        # with compute_reffs, a tuple of the tagged particles and the reffs measured during the run
+        df_tagged = angmom_tag_over_full_sim(DMO_database, halonumber, free_param_value = free_param_val, pynbody_path  = path_to_particle_data, particle_storage_filename = particle_storage_filename, mergers = include_mergers, extract_dir = extract_dir, processes = processes, checkpoint_dir = checkpoint_dir, compute_reffs = compute_reffs)
+
+    if tagging_method == 'binding energy':
+
+        # with compute_reffs, a tuple of the tagged particles and the reffs measured during the run
+        df_tagged = BE_tag_over_full_sim(DMO_database, halonumber, free_param_value = free_param_val, pynbody_path  = path_to_particle_data, particle_storage_filename = particle_storage_filename, mergers = include_mergers, extract_dir = extract_dir, checkpoint_dir = checkpoint_dir, compute_reffs = compute_reffs)
 
     if tagging_method == "angular momentum recursive":
 
-        df_tagged,l = angmom_tag_over_full_sim_recursive(DMO_database, -1, halonumber, free_param_value = free_param_val, pynbody_path  = path_to_particle_data )
+        # the recursive tagger assigns accreted particles inside the merger tree walk, so a list of
+        # free parameter values is tagged with one walk per value
+        if isinstance(free_param_val, (list, tuple, np.ndarray)):
+
+            df_tagged = OrderedDict()
+
+            for value in OrderedDict.fromkeys(float(v) for v in free_param_val):
+                df_tagged[value],l = angmom_tag_over_full_sim_recursive(DMO_database, -1, halonumber, free_param_value = value, pynbody_path  = path_to_particle_data, particle_storage_filename = ftag_filename(particle_storage_filename, value) if particle_storage_filename != None else None, processes = processes, checkpoint_dir = join(checkpoint_dir, 'ftag'+str(value)) if checkpoint_dir != None else None )
+
+        else:
+            df_tagged,l = angmom_tag_over_full_sim_recursive(DMO_database, -1, halonumber, free_param_value = free_param_val, pynbody_path  = path_to_particle_data, particle_storage_filename = particle_storage_filename, processes = processes, checkpoint_dir = checkpoint_dir )
 
     if tagging_method == 'spatial' : 
         
-        df_tagged = spatial_tag_over_full_sim(DMO_database, pynbody_path  = path_to_particle_data, occupation_frac = 'all', particle_storage_filename=None, mergers= include_mergers)
+        df_tagged = spatial_tag_over_full_sim(DMO_database, pynbody_path  = path_to_particle_data, occupation_frac = 'all', particle_storage_filename=particle_storage_filename, mergers= include_mergers, extract_dir = extract_dir)
     
     return df_tagged
 
 
 
-def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = None, path_AHF_halonums=None, from_file = False ,from_dataframe=False,save_to_file=True,AHF_centers_supplied=False,machine='astro',physics='edge1',halo_number=0):
+def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = None, path_AHF_halonums=None, from_file = False ,from_dataframe=False,save_to_file=True,AHF_centers_supplied=False,machine='astro',physics='edge1',halo_number=0,extract_dir=None):
     
     # Use config path if pynbody_path not provided
     if pynbody_path is None:
@@ -141,17 +177,7 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
                     
     main_halo = DMOsim.timesteps[-1].halos[int(halo_number)]
     
-    halonums = main_halo.calculate_for_progenitors('halo_number()')[0][::-1]
-   
-    t_all = main_halo.calculate_for_progenitors('t()')[0][::-1]
-    red_all = main_halo.calculate_for_progenitors('z()')[0][::-1] 
-    
-    outputs_all = np.array([DMOsim.timesteps[i].__dict__['extension'] for i in range(len(DMOsim.timesteps))])
-    times_tangos = np.array([ DMOsim.timesteps[i].__dict__['time_gyr'] for i in range(len(DMOsim.timesteps)) ])
-
-    outputs = outputs_all[np.isin(times_tangos, t_all)]
-    
-    outputs.sort()
+    t_all, red_all, halonums, outputs = simulation_index(DMOsim).indexing_data(main_halo)
 
     print(outputs)
 
@@ -159,11 +185,23 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
     if ( len(red_all) != len(outputs) ) : 
         print('output array length does not match redshift and time arrays')
 
-    data_particles = pd.read_csv(particles_tagged) if from_dataframe==False else particles_tagged
+    # particles_tagged can be a columnar store or a CSV file (see tagged_storage)
+    data_particles = read_tagged_particles(particles_tagged, columns=['iords','mstar','t','type']) if from_dataframe==False else particles_tagged
 
     #print('data parts',data_particles['t'])
 
     data_t = np.asarray(data_particles['t'].values)
+
+    # luminosities of the tagged particles at every output, evaluated once for the whole run
+    # (imported here, darktag.analysis imports the tagging utilities)
+    from darktag.analysis.calculate import LuminosityHistory, calc_enclosed_light_radii, calc_3D_cm
+
+    lum_history = LuminosityHistory(data_particles, t_all)
+
+    # stellar mass of each particle (all of it and in situ only) as of any time, instead of regrouping the
+    # particles tagged by each output
+    mass_ledger = MassLedger.from_frame(data_particles)
+    mass_ledger_insitu = MassLedger.from_frame(data_particles, types=['insitu'])
     
     stored_reff = np.array([])
     stored_reff_acc = np.array([])
@@ -185,24 +223,22 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
             continue
 
         
-        dt_all = data_particles[data_particles['t']<=t_all[i]]
-
-        
-        data_grouped = dt_all.groupby(['iords']).sum()
+        # stellar masses of the particles tagged by this output
+        mass_index = mass_ledger.index_at(t_all[i])
         
 
-        selected_iords_tot = data_grouped.index.values
+        selected_iords_tot = mass_index.iords
 
-        data_insitu = dt_all[dt_all['type'] == 'insitu'].groupby(['iords']).sum()
+        insitu_index = mass_ledger_insitu.index_at(t_all[i])
         
-        selected_iords_insitu_only = data_insitu.index.values
+        selected_iords_insitu_only = insitu_index.iords
         
         
         if selected_iords_tot.shape[0]==0:
             continue
         
 
-        mstars_at_current_time = data_grouped['mstar'].values
+        mstars_at_current_time = mass_index.columns['mstar']
         
         half_mass = float(mstars_at_current_time.sum())/2
         
@@ -213,87 +249,99 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
             
         print(hDMO)
         
-        pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
-        if type(AHF_halonums) == type(None):
-            pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
+        if extract_dir != None:
 
-        #for  the given path,entry,snapshot at given index generate a string that includes them
-        simfn = join(pynbody_path,outputs[i])
-        
-        # try to load in the data from this snapshot
-        try:  DMOparticles = pynbody.load(simfn)
+            # the extract is already centred on the halo, with the particles of its subhalos flagged
+            try:
+                DMOparticles = load_extract(extract_dir,outputs[i],halonums[i])
+            except Exception as e:
+                print(e)
+                print('--> halo extract unavailable, skipping!')
+                continue
 
-        # where this data isn't available, notify the user.
-        except:
-            print('--> DMO particle data exists but failed to read it, skipping!')
-            continue
+            DMOparticles = DMOparticles.within(DMOparticles.r200)
+            
+            DMOparticles = DMOparticles[DMOparticles['sub'] == 0]
+
+        else:
+
+            pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
+            if type(AHF_halonums) == type(None):
+                pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
+
+            #for  the given path,entry,snapshot at given index generate a string that includes them
+            simfn = join(pynbody_path,outputs[i])
         
-        # once the data from the snapshot has been loaded, .physical_units()
-        # converts all array’s units to be consistent with the distance, velocity, mass basis units specified.
-        #DMOparticles.physical_units()
+            # try to load in the data from this snapshot
+            try:  DMOparticles = load_snapshot(simfn)
 
-        try:
-            if AHF_centers_supplied==False:
+            # where this data isn't available, notify the user.
+            except:
+                print('--> DMO particle data exists but failed to read it, skipping!')
+                continue
+
+            try:
+                if AHF_centers_supplied==False:
                 
-                if type(AHF_halonums) != type(None):
-                    print('halonums cat', DMOparticles.halos(halo_numbers='v1'),DMOparticles.halos(halo_numbers='v1').keys())
-                    halonum_snap = AHF_halonums[AHF_halonums["snapshot"] == str(outputs[i])]["AHF halonum"].values
+                    if type(AHF_halonums) != type(None):
+                        print('halonums cat', DMOparticles.halos(halo_numbers='v1'),DMOparticles.halos(halo_numbers='v1').keys())
+                        halonum_snap = AHF_halonums[AHF_halonums["snapshot"] == str(outputs[i])]["AHF halonum"].values
                     
-                    h = DMOparticles.halos(halo_numbers='v1')[int(halonum_snap)]                        
+                        h = DMOparticles.halos(halo_numbers='v1')[int(halonum_snap)]                        
                     
-                else:
-                    #pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
-                    h = DMOparticles.halos(halo_numbers='v1')[int(halonums[i])-1]
+                    else:
+                        #pynbody.config["halo-class-priority"] = [pynbody.halo.hop.HOPCatalogue]
+                        h = DMOparticles.halos(halo_numbers='v1')[int(halonums[i])-1]
 
 
-            elif AHF_centers_supplied == True:
-                pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
+                elif AHF_centers_supplied == True:
+                    pynbody.config["halo-class-priority"] = [pynbody.halo.ahf.AHFCatalogue]
                 
                 
-                AHF_crossref = AHF_centers[AHF_centers['i'] == i]['AHF catalogue id'].values[0]
+                    AHF_crossref = AHF_centers[AHF_centers['i'] == i]['AHF catalogue id'].values[0]
                     
-                h = DMOparticles.halos()[int(AHF_crossref)] 
+                    h = DMOparticles.halos()[int(AHF_crossref)] 
                         
-                children_ahf = AHF_centers[AHF_centers['i'] == i]['children'].values[0]
+                    children_ahf = AHF_centers[AHF_centers['i'] == i]['children'].values[0]
                         
-                child_str_l = children_ahf[0][1:-1].split()
+                    child_str_l = children_ahf[0][1:-1].split()
 
-                children_ahf_int = list(map(float, child_str_l))
+                    children_ahf_int = list(map(float, child_str_l))
                 
                 
-                halo_catalogue = DMOparticles.halos()
+                    halo_catalogue = DMOparticles.halos()
                 
-                subhalo_iords = np.array([])
+                    subhalo_iords = np.array([])
                     
-                for i in children_ahf_int:
+                    for i in children_ahf_int:
                             
-                    subhalo_iords = np.append(subhalo_iords,halo_catalogue[int(i)].dm['iord'])
+                        subhalo_iords = np.append(subhalo_iords,halo_catalogue[int(i)].dm['iord'])
                                                                                                                                              
-                h = h[np.logical_not(np.isin(h['iord'],subhalo_iords))] if len(subhalo_iords) >0 else h
+                    h = h[np.logical_not(np.isin(h['iord'],subhalo_iords))] if len(subhalo_iords) >0 else h
                 
             
-            children_dm,children_st,sub_halonums = get_child_iords(h,DMOparticles.halos(halo_numbers='v1'),DMO_state='DMO')
+                children_dm,children_st,sub_halonums = get_child_iords(h,DMOparticles.halos(halo_numbers='v1'),DMO_state='DMO')
             
-            DMOparticles.physical_units()    
-            pynbody.analysis.halo.center(h)
+                DMOparticles.physical_units()    
+                pynbody.analysis.halo.center(h)
 
-        except Exception as e:
-            print('centering data unavailable',e)
-            continue
+            except Exception as e:
+                print('centering data unavailable',e)
+                continue
 
 
-        try:
-            r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')
+            try:
+                r200c_pyn = pynbody.analysis.halo.virial_radius(h.d, overden=200, r_max=None, rho_def='critical')
 
-        except:
-            print('could not calculate R200c')
-            continue
+            except:
+                print('could not calculate R200c')
+                continue
         
     
 
-        DMOparticles = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn ]        
+            DMOparticles = DMOparticles[sqrt(DMOparticles['pos'][:,0]**2 + DMOparticles['pos'][:,1]**2 + DMOparticles['pos'][:,2]**2) <= r200c_pyn ]        
         
-        DMOparticles = DMOparticles[np.logical_not(np.isin(DMOparticles['iord'],children_dm))]
+            DMOparticles = DMOparticles[np.logical_not(np.isin(DMOparticles['iord'],children_dm))]
 
         particle_selection_reff_tot = DMOparticles[np.isin(DMOparticles['iord'],selected_iords_tot)] if len(selected_iords_tot)>0 else []
         
@@ -307,16 +355,19 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
             continue
         else:
     
-            masses = [ data_grouped.loc[n]['mstar'] for n in particle_selection_reff_tot['iord']]
+            # stellar masses of the selected particles, gathered by iord
+            masses = mass_index.gather('mstar', particle_selection_reff_tot['iord'])
 
-            masses_insitu = [data_insitu.loc[iord]['mstar'] for iord in particles_only_insitu['iord']]
+            masses_insitu = insitu_index.gather('mstar', particles_only_insitu['iord'])
                 
             cen_stars = calc_3D_cm(particles_only_insitu,masses_insitu)
             
-            particle_selection_reff_tot['pos'] -= cen_stars
+            # positions about the in situ stars, as a copy: the particles are a view of the cached snapshot, which other
+            # halos and passes over this output share
+            pos = np.asarray(particle_selection_reff_tot['pos']) - cen_stars
             
             # new cutoff calc begins 
-            distances = np.sqrt(particle_selection_reff_tot['x']**2+particle_selection_reff_tot['y']**2) #+ particle_selection_reff_tot['z']**2)                
+            distances = np.sqrt(pos[:,0]**2+pos[:,1]**2) #+ pos[:,2]**2)                
                         
             idxs_distances_sorted = np.argsort(distances)
 
@@ -326,14 +377,14 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
             
             print('array lengths',len(set(distance_ordered_iords)),len(distance_ordered_iords))
 
-            sorted_massess = [data_grouped.loc[n]['mstar'] for n in distance_ordered_iords]
+            sorted_massess = mass_index.gather('mstar', distance_ordered_iords)
 
             cumilative_sum = np.cumsum(sorted_massess)
 
             R_half = sorted_distances[np.where(cumilative_sum >= (cumilative_sum[-1]/2))[0][0]]
 
-            lum_for_each_part = produce_lums_grouped( dt_all, particle_selection_reff_tot['iord'], t_all[i])
-            hlight_r = calc_halflight(particle_selection_reff_tot, lum_for_each_part, band='v', cylindrical=False)
+            lum_for_each_part = lum_history.gather(i, particle_selection_reff_tot['iord'])
+            hlight_r = calc_enclosed_light_radii(np.sqrt(np.sum(pos**2, axis=1)), lum_for_each_part, [0.5])[0]
             
             print(hlight_r)
             
@@ -346,8 +397,6 @@ def calculate_reffs_over_full_sim(DMOsim, particles_tagged,  pynbody_path  = Non
             kravtsov = hDMO['r200c']*0.02
             kravtsov_r = np.append(kravtsov_r,kravtsov)
 
-            particle_selection_reff_tot['pos'] += cen_stars
-
             print('halfmass radius:',R_half)
             print('Kravtsov_radius:',kravtsov)
             
@@ -4,6 +4,7 @@ import darklight
 from numpy import sqrt
 import random
 import pynbody
+from .simulation_index import simulation_index
 
 def initialize_arrays(n):
     x = []
@@ -18,6 +19,49 @@ def get_dist(pos):
     # a 3D 'pos' array 
 
     return np.sqrt(pos[:,0]**2+pos[:,1]**2+pos[:,2]**2)
+
+
+def get_dist2(vec):
+
+    # squared magnitude of each row of a 3D array (same ordering as get_dist, without the sqrt)
+
+    vec = np.asarray(vec)
+
+    return np.einsum('ij,ij->i', vec, vec)
+
+
+def partial_argsort(values, n_select):
+
+    '''
+
+    Inputs:
+
+    values - 1D array of values to rank
+    n_select - number of lowest values that are needed in order
+
+    Returns:
+
+    indices that put the n_select lowest values first, in ascending order. The remaining
+    indices follow in no particular order. This is a linear pass (np.argpartition) plus a sort of
+    the n_select selected values, rather than a sort of every value.
+
+    '''
+
+    values = np.asarray(values).flatten()
+
+    if n_select >= len(values):
+        return np.argsort(values)
+
+    if n_select <= 0:
+        return np.arange(len(values))
+
+    indices = np.argpartition(values, n_select-1)
+
+    head = indices[:n_select]
+
+    indices[:n_select] = head[np.argsort(values[head])]
+
+    return indices
                     
 
 
@@ -25,21 +69,56 @@ def load_indexing_data(DMOsim,halo_number):
     
     main_halo = DMOsim.timesteps[-1].halos[int(halo_number) - 1]
     
-    halonums = main_halo.calculate_for_progenitors('halo_number()')[0][::-1]
-   
-    t_all = main_halo.calculate_for_progenitors('t()')[0][::-1]
-    red_all = main_halo.calculate_for_progenitors('z()')[0][::-1] 
+    # halo numbers, times and redshifts of the main branch and the output names, from the simulation index
+    # (queried from tangos once and then kept, see simulation_index.py)
+    t_all, red_all, halonums, valid_outputs = simulation_index(DMOsim).indexing_data(main_halo)
     
-    outputs = np.array([DMOsim.timesteps[i].__dict__['extension'] for i in range(len(DMOsim.timesteps))])
-    times_tangos = np.array([ DMOsim.timesteps[i].__dict__['time_gyr'] for i in range(len(DMOsim.timesteps)) ])
-
-    valid_outputs = outputs[np.isin(times_tangos, t_all)]
-    
-    valid_outputs.sort()
     #snapshots = [ f for f in listdir(pynbody_path+DMOname) if (isdir(join(pynbody_path,DMOname,f)) and f[:6]=='output') ]
     return t_all, red_all, main_halo, halonums, valid_outputs
 
 
+def insitu_stellar_mass_to_tag(t, mstar_s_insitu, t_all):
+
+    '''
+
+    Inputs:
+
+    t - darklight time array
+    mstar_s_insitu - darklight in situ stellar masses at those times
+    t_all - times of the snapshots
+
+    Returns:
+
+    list of the stellar mass formed in situ since the previous snapshot (the difference of the darklight
+    stellar masses closest in time to the two snapshots) for each snapshot, None where there are no stars yet
+
+    '''
+
+    mass_selects = []
+
+    for i in range(len(t_all)):
+
+        # idrz is the index of the mstar value calculated at the closest time to that of the snap
+        idrz = np.argmin(abs(t - t_all[i]))
+
+        # index of previous snap's mstar value in darklight array
+        idrz_previous = np.argmin(abs(t - t_all[i-1])) if idrz>0 else None
+
+        # current snap's darklight calculated stellar mass
+        msn = mstar_s_insitu[idrz]
+
+        if msn == 0:
+            mass_selects.append(None)
+            continue
+
+        # msp = previous snap's darklight calculated stellar mass (0 if there wasn't a previous snap)
+        msp = 0 if idrz_previous == None else mstar_s_insitu[idrz_previous]
+
+        mass_selects.append(int(msn-msp))
+
+    return mass_selects
+
+
 
 
 def calculate_poccupied(halo_object,occupation_regime):